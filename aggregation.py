@@ -0,0 +1,205 @@
+from typing import Dict, Hashable, Iterable, Iterator, List, NamedTuple, \
+    Tuple, Union
+
+from incremental import TripChanges
+from lib.fenwick import FenwickTree
+from lib.timestamp import SECONDS_PER_DAY, format_timestamp, parse_timestamp
+from processor import Trip, waypoint_epoch
+
+Time = Union[int, str, None]
+
+
+class Totals(NamedTuple):
+    trips: int
+    distance: float
+
+
+class _DeviceRollup:
+    """
+    The number of trips and their distance per bucket of a device, from its
+    first bucket on.
+    """
+    __slots__ = ('first', 'trips', 'distances')
+
+    def __init__(self, first: int):
+        self.first = first
+        self.trips = FenwickTree()
+        self.distances = FenwickTree()
+
+    def index(self, bucket: int) -> int:
+        """
+        Return the index of a bucket, the trees are extended to hold it.
+        """
+        if bucket < self.first:
+            # rebuilt in O(n), trips arrive mostly in order of time
+            padding = [0] * (self.first - bucket)
+            self.trips = FenwickTree(padding + self.trips.values())
+            self.distances = FenwickTree(padding + self.distances.values())
+            self.first = bucket
+        index = bucket - self.first
+        while len(self.trips) <= index:
+            self.trips.append()
+            self.distances.append()
+        return index
+
+    def totals(self, start: int, end: int) -> Totals:
+        start, end = start - self.first, end - self.first
+        return Totals(self.trips.range_sum(start, end),
+                      self.distances.range_sum(start, end))
+
+
+class TripAggregator:
+    """
+    Running totals of the trips and their distance per device and bucket of
+    time, one day by default, fed with the trips of the processors as they
+    are produced. A trip counts for the bucket of its start. The buckets of
+    a device are kept in Fenwick trees, so adding a trip and the totals of
+    any range of buckets take O(log n) of the buckets of the device, and no
+    trip is kept.
+    Ranges are whole buckets, months are exact for buckets dividing a day.
+    Trips changed by the IncrementalTripExtractor are applied by apply().
+    """
+    BUCKET_SECONDS = SECONDS_PER_DAY
+
+    def __init__(self, bucket_seconds: int = BUCKET_SECONDS):
+        """
+        :param bucket_seconds: int
+        """
+        self._bucket_seconds = bucket_seconds
+        self._devices: Dict[Hashable, _DeviceRollup] = {}
+
+    @property
+    def devices(self) -> List[Hashable]:
+        return list(self._devices)
+
+    def _bucket(self, time: Union[int, str]) -> int:
+        if isinstance(time, str):
+            time = parse_timestamp(time)
+        return time // self._bucket_seconds
+
+    def add(self, trip: Trip, count: int = 1):
+        """
+        Add a trip to the totals of its device, a count of -1 removes it.
+
+        :param trip: Trip
+        :param count: int
+        """
+        device_id = trip.start.device_id
+        bucket = self._bucket(waypoint_epoch(trip.start))
+        rollup = self._devices.get(device_id)
+        if rollup is None:
+            rollup = self._devices[device_id] = _DeviceRollup(bucket)
+        index = rollup.index(bucket)
+        rollup.trips.add(index, count)
+        rollup.distances.add(index, count * trip.distance)
+
+    def remove(self, trip: Trip):
+        self.add(trip, -1)
+
+    def aggregate(self, trips: Iterable[Trip]) -> Iterator[Trip]:
+        """
+        Yield the trips to a writer and add each one.
+
+        :param trips: Iterable[Trip]
+        """
+        for trip in trips:
+            self.add(trip)
+            yield trip
+
+    def apply(self, changes: TripChanges):
+        """
+        Update the totals by the changes of an IncrementalTripExtractor.
+
+        :param changes: TripChanges
+        """
+        for trip in changes.removed:
+            self.add(trip, -1)
+        for old_trip, trip in changes.changed:
+            self.add(old_trip, -1)
+            self.add(trip)
+        for trip in changes.added:
+            self.add(trip)
+
+    def totals(self, device_id: Hashable, start: Time = None,
+               end: Time = None) -> Totals:
+        """
+        Return the trips and the distance of a device from the bucket of
+        start to the bucket of end, both included, of all buckets by default.
+
+        :param device_id: Hashable
+        :param start: int or str, epoch seconds or timestamp
+        :param end: int or str
+        """
+        rollup = self._devices.get(device_id)
+        if rollup is None:
+            return Totals(0, 0.0)
+        return rollup.totals(
+            rollup.first if start is None else self._bucket(start),
+            rollup.first + len(rollup.trips) if end is None
+            else self._bucket(end) + 1)
+
+    def bucket_totals(self, device_id: Hashable, start: Time = None,
+                      end: Time = None) -> Iterator[Tuple[int, Totals]]:
+        """
+        Yield the start epoch and the totals of every bucket of a device
+        with trips, from the bucket of start to the bucket of end.
+
+        :param device_id: Hashable
+        :param start: int or str
+        :param end: int or str
+        """
+        rollup = self._devices.get(device_id)
+        if rollup is None:
+            return
+        first, stop = rollup.first, rollup.first + len(rollup.trips)
+        if start is not None:
+            first = max(first, self._bucket(start))
+        if end is not None:
+            stop = min(stop, self._bucket(end) + 1)
+        for bucket in range(first, stop):
+            totals = rollup.totals(bucket, bucket + 1)
+            if totals.trips:
+                yield bucket * self._bucket_seconds, totals
+
+    def monthly_totals(self, device_id: Hashable
+                       ) -> Iterator[Tuple[str, Totals]]:
+        """
+        Yield the month as YYYY-MM and the totals of every month of a device
+        with trips.
+
+        :param device_id: Hashable
+        """
+        rollup = self._devices.get(device_id)
+        if rollup is None:
+            return
+        end_epoch = (rollup.first + len(rollup.trips)) * self._bucket_seconds
+        month = format_timestamp(rollup.first * self._bucket_seconds)[:7]
+        while True:
+            month_start = parse_timestamp(month + '-01T00:00:00Z')
+            if month_start >= end_epoch:
+                return
+            year, number = int(month[:4]), int(month[5:])
+            next_month = '%04d-%02d' % (year + number // 12,
+                                        number % 12 + 1)
+            totals = rollup.totals(
+                self._bucket(month_start),
+                self._bucket(parse_timestamp(next_month + '-01T00:00:00Z')))
+            if totals.trips:
+                yield month, totals
+            month = next_month
+
+    def as_dict(self) -> List[Dict]:
+        """
+        Return the totals of every bucket and month of every device, the
+        buckets by the timestamp of their start, distances in meters.
+        """
+        return [{
+            'device_id': device_id,
+            'buckets': [{'start': format_timestamp(epoch),
+                         'trips': totals.trips,
+                         'distance': round(totals.distance, 3)}
+                        for epoch, totals in self.bucket_totals(device_id)],
+            'months': [{'month': month, 'trips': totals.trips,
+                        'distance': round(totals.distance, 3)}
+                       for month, totals in self.monthly_totals(device_id)],
+        } for device_id in self._devices]
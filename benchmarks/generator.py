@@ -0,0 +1,136 @@
+import argparse
+import heapq
+import json
+import math
+import random
+import sys
+from typing import Iterator
+
+from lib.timestamp import format_timestamp, parse_timestamp
+
+START_TIMESTAMP = "2018-08-10T00:00:00Z"
+METERS_PER_DEGREE = 111320.0
+
+
+def _generate_device_waypoints(device_id, seed: int,
+                               start_epoch: int) -> Iterator[dict]:
+    """
+    Yield an endless, deterministic GPS trace of one vehicle: parked periods
+    with heartbeats and noise, driving segments with red light stops and
+    occasional GPS jumps.
+    """
+    rng = random.Random("%s-%s" % (seed, device_id))
+    epoch = start_epoch + rng.randint(0, 3600)
+    lat = 51.3 + rng.random() * 0.4
+    lng = 12.2 + rng.random() * 0.4
+
+    def waypoint(lat, lng):
+        point = {"timestamp": format_timestamp(epoch),
+                 "lat": round(lat, 5), "lng": round(lng, 5)}
+        if device_id is not None:
+            point["device_id"] = device_id
+        return point
+
+    while True:
+        # parked, heartbeats every minute with meter-level noise
+        for _ in range(rng.randint(5, 120)):
+            epoch += rng.randint(55, 65)
+            if rng.random() < 0.1:
+                yield waypoint(lat + rng.gauss(0, 2e-5),
+                               lng + rng.gauss(0, 2e-5))
+            else:
+                yield waypoint(lat, lng)
+
+        # driving
+        heading = rng.random() * 2 * math.pi
+        for _ in range(rng.randint(50, 1500)):
+            if rng.random() < 0.02:
+                # red light or traffic jam
+                for _ in range(rng.randint(2, 12)):
+                    epoch += rng.randint(5, 15)
+                    yield waypoint(lat, lng)
+
+            interval = rng.randint(1, 10)
+            epoch += interval
+            speed = rng.uniform(5, 30)
+            heading += rng.gauss(0, 0.2)
+            lat += math.cos(heading) * speed * interval / METERS_PER_DEGREE
+            lng += math.sin(heading) * speed * interval / (
+                METERS_PER_DEGREE * math.cos(math.radians(lat)))
+
+            if rng.random() < 0.005:
+                # GPS jump caused by a tunnel or reflections
+                yield waypoint(lat + rng.uniform(-0.02, 0.02),
+                               lng + rng.uniform(-0.02, 0.02))
+            else:
+                yield waypoint(lat, lng)
+
+
+def generate_waypoints(points: int, devices: int = 1, seed: int = 0,
+                       start_timestamp: str = START_TIMESTAMP
+                       ) -> Iterator[dict]:
+    """
+    Yield the given number of waypoints of one or many vehicles, ordered by
+    timestamp. Waypoints of many vehicles carry a device_id. The same
+    arguments always yield the same waypoints.
+
+    :param points: int
+    :param devices: int
+    :param seed: int
+    :param start_timestamp: str
+    """
+    start_epoch = parse_timestamp(start_timestamp)
+    if devices == 1:
+        traces = [_generate_device_waypoints(None, seed, start_epoch)]
+    else:
+        traces = [_generate_device_waypoints(device_id, seed, start_epoch)
+                  for device_id in range(devices)]
+
+    merged = heapq.merge(*(_sort_keys(index, trace)
+                           for index, trace in enumerate(traces)))
+    for _, (_, _, point) in zip(range(points), merged):
+        yield point
+
+
+def _sort_keys(index: int, trace: Iterator[dict]):
+    return ((point["timestamp"], index, point) for point in trace)
+
+
+def write_waypoints(waypoints: Iterator[dict], output, json_lines: bool):
+    if json_lines:
+        for point in waypoints:
+            output.write(json.dumps(point) + '\n')
+    else:
+        output.write('[')
+        separator = ''
+        for point in waypoints:
+            output.write(separator + json.dumps(point))
+            separator = ',\n'
+        output.write(']\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='generate synthetic GPS waypoints of a vehicle fleet.')
+    parser.add_argument('--points', type=int, required=True,
+                        help='number of waypoints')
+    parser.add_argument('--devices', type=int, default=1,
+                        help='number of vehicles')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random traces')
+    parser.add_argument('--json-lines', action='store_true',
+                        help='write newline delimited JSON instead of an '
+                             'array')
+    parser.add_argument('--output', help='output file, default is stdout')
+    args = parser.parse_args()
+
+    waypoints = generate_waypoints(args.points, args.devices, args.seed)
+    if args.output:
+        with open(args.output, 'w') as output:
+            write_waypoints(waypoints, output, args.json_lines)
+    else:
+        write_waypoints(waypoints, sys.stdout, args.json_lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.generator import generate_waypoints
+
+
+async def _connect(tcp: str = None, unix: str = None):
+    if unix:
+        return await asyncio.open_unix_connection(unix)
+    host, _, port = tcp.rpartition(':')
+    return await asyncio.open_connection(host, int(port))
+
+
+async def run_load(points: int, devices: int = 1, seed: int = 0,
+                   tcp: str = None, unix: str = None,
+                   batch_size: int = 1000) -> dict:
+    """
+    Send generated waypoints to a TripServer as fast as it accepts them and
+    return the number of waypoints sent and the seconds it took. The server
+    pushes back once its queues are full, so the rate is the one of the
+    server.
+    """
+    _, writer = await _connect(tcp, unix)
+    start = time.perf_counter()
+    lines = []
+    for point in generate_waypoints(points, devices, seed):
+        lines.append(json.dumps(point))
+        if len(lines) == batch_size:
+            writer.write(('\n'.join(lines) + '\n').encode())
+            lines = []
+            # waits while the server pushes back
+            await writer.drain()
+    writer.write(('\n'.join(lines) + '\n').encode())
+    await writer.drain()
+    writer.close()
+    seconds = time.perf_counter() - start
+    return {'points': points, 'seconds': seconds,
+            'points_per_second': points / seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='send generated waypoints to a trip server.')
+    parser.add_argument('--tcp', metavar='HOST:PORT')
+    parser.add_argument('--unix', metavar='PATH')
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not (args.tcp or args.unix):
+        parser.error('one of --tcp or --unix is required')
+
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(run_load(
+        args.points, args.devices, args.seed, args.tcp, args.unix))
+    print("sent %d waypoints in %.3fs: %.0f waypoints/sec" % (
+        result['points'], result['seconds'], result['points_per_second']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+from benchmarks.generator import generate_waypoints, write_waypoints
+from lib import kernel
+from lib.geo import GEO_BACKENDS, GeoAdapter, create_geo_library
+from processor import (FleetStreamProcessor, ParallelWaypointListProcessor,
+                       VectorizedWaypointListProcessor, WaypointBatch,
+                       WaypointListProcessor, WaypointStreamProcessor)
+from utils import convert_data_to_waypoints, iter_waypoints_from_json_file
+from utils.formats import write_trips
+
+PROCESSORS = ('list', 'vectorized', 'parallel', 'stream', 'batch', 'fleet')
+# the compiled kernel only runs with Numba installed
+KERNELS = ('python', 'numba') if kernel.KERNEL_AVAILABLE else ('python',)
+DEFAULT_SIZES = (10000, 100000)
+
+
+@contextmanager
+def _stage(stages: dict, name: str):
+    start = time.perf_counter()
+    yield
+    stages[name] = time.perf_counter() - start
+
+
+def _peak_rss_kb() -> int:
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_ingest(points: int, seed: int, stages: dict):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'waypoints.ndjson')
+        with open(path, 'w') as output:
+            write_waypoints(generate_waypoints(points, seed=seed), output,
+                            json_lines=True)
+        with _stage(stages, 'ingest'):
+            WaypointBatch.from_waypoints(iter_waypoints_from_json_file(path))
+
+
+def _run_geo(points: int, seed: int, backend: str, stages: dict):
+    data_points = list(generate_waypoints(points, seed=seed))
+    lats = [point['lat'] for point in data_points]
+    lngs = [point['lng'] for point in data_points]
+    geo = GeoAdapter(create_geo_library(backend))
+    with _stage(stages, 'distances'):
+        geo.compute_distances_in_meters(lats, lngs)
+
+
+def _run_processor(points: int, seed: int, processor: str, devices: int,
+                   stages: dict):
+    data_points = list(generate_waypoints(points, devices, seed))
+    with _stage(stages, 'convert'):
+        waypoints = convert_data_to_waypoints(data_points)
+    del data_points
+
+    with _stage(stages, 'extract'):
+        if processor == 'stream':
+            stream_processor = WaypointStreamProcessor()
+            trips = [trip for trip in map(stream_processor.process_waypoint,
+                                          waypoints) if trip is not None]
+        elif processor == 'batch':
+            stream_processor = WaypointStreamProcessor()
+            trips = []
+            for batch in WaypointBatch.iter_batches(waypoints, 10000):
+                trips.extend(stream_processor.process_batch(batch))
+        elif processor == 'fleet':
+            fleet_processor = FleetStreamProcessor()
+            trips = []
+            for waypoint in waypoints:
+                trips.extend(fleet_processor.process_waypoint(waypoint))
+            trips.extend(fleet_processor.flush())
+        elif processor == 'parallel':
+            trips = ParallelWaypointListProcessor(
+                waypoints, os.cpu_count(),
+                VectorizedWaypointListProcessor).get_trips()
+        elif processor == 'vectorized':
+            trips = VectorizedWaypointListProcessor(waypoints).get_trips()
+        else:
+            trips = WaypointListProcessor(waypoints).get_trips()
+
+    with _stage(stages, 'output'):
+        write_trips(trips, io.StringIO())
+    return len(trips)
+
+
+def _run_kernel(points: int, seed: int, name: str, stages: dict):
+    waypoints = WaypointBatch.from_waypoints(convert_data_to_waypoints(
+        generate_waypoints(points, seed=seed)))
+    processor = VectorizedWaypointListProcessor(waypoints)
+    processor.use_kernel = name == 'numba'
+    distances = processor._segment_distances()
+    # compile or load the kernel from the cache beforehand
+    processor._extract_trips(waypoints[-1], None, distances)
+    with _stage(stages, 'extract'):
+        trips, _ = processor._extract_trips(waypoints[-1], None, distances)
+    return len(trips)
+
+
+def run_case(case: dict) -> dict:
+    """
+    Run one benchmark case and return its result. Cases are run in a
+    process of their own, so that the peak RSS belongs to the case.
+
+    :param case: dict with the kind of benchmark, number of points, seed
+    and the name of the processor or geo backend
+    """
+    stages = {}
+    trips = None
+    if case['kind'] == 'ingest':
+        _run_ingest(case['points'], case['seed'], stages)
+    elif case['kind'] == 'geo':
+        _run_geo(case['points'], case['seed'], case['name'], stages)
+    elif case['kind'] == 'kernel':
+        trips = _run_kernel(case['points'], case['seed'], case['name'],
+                            stages)
+    else:
+        trips = _run_processor(case['points'], case['seed'], case['name'],
+                               case.get('devices', 1), stages)
+
+    seconds = sum(stages.values())
+    return dict(case, trips=trips, seconds=seconds, stages=stages,
+                points_per_second=case['points'] / seconds if seconds
+                else None,
+                peak_rss_kb=_peak_rss_kb())
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(cases) -> dict:
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        results = [pool.apply(run_case, (case,)) for case in cases]
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def _case_key(result: dict):
+    return (result['kind'], result['name'], result['points'],
+            result.get('devices', 1))
+
+
+def compare(report: dict, baseline: dict):
+    """
+    Print the change of points per second of every case of the report
+    compared to the same case of the baseline.
+    """
+    baseline_results = {_case_key(result): result
+                        for result in baseline['results']}
+    for result in report['results']:
+        previous = baseline_results.get(_case_key(result))
+        if previous is None or not previous['points_per_second']:
+            continue
+        change = result['points_per_second'] / previous[
+            'points_per_second'] - 1
+        print("%-9s %-16s %10d points: %+7.1f%% points/sec" % (
+            result['kind'], result['name'], result['points'], change * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the trip extraction on synthetic waypoints.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help='numbers of waypoints')
+    parser.add_argument('--processors', nargs='+', default=list(PROCESSORS),
+                        choices=PROCESSORS)
+    parser.add_argument('--backends', nargs='+',
+                        default=sorted(GEO_BACKENDS),
+                        choices=sorted(GEO_BACKENDS))
+    parser.add_argument('--devices', type=int, default=100,
+                        help='number of vehicles of the fleet benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to save the results as JSON')
+    parser.add_argument('--compare',
+                        help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    cases = []
+    for points in args.sizes:
+        cases.append({'kind': 'ingest', 'name': 'ndjson',
+                      'points': points, 'seed': args.seed})
+        cases.extend({'kind': 'geo', 'name': backend, 'points': points,
+                      'seed': args.seed} for backend in args.backends)
+        cases.extend({'kind': 'processor', 'name': processor,
+                      'points': points, 'seed': args.seed,
+                      'devices': args.devices if processor == 'fleet' else 1}
+                     for processor in args.processors)
+        cases.extend({'kind': 'kernel', 'name': name, 'points': points,
+                      'seed': args.seed} for name in KERNELS)
+
+    report = run_benchmarks(cases)
+    for result in report['results']:
+        print("%-9s %-16s %10d points %12.0f points/sec %8d KB peak RSS %s"
+              % (result['kind'], result['name'], result['points'],
+                 result['points_per_second'] or 0, result['peak_rss_kb'],
+                 ' '.join('%s=%.3fs' % stage
+                          for stage in sorted(result['stages'].items()))))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(report, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import math
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Tuple
+
+from lib.jumps import JumpWindow
+from lib.timestamp import format_timestamp
+from processor import (DeviceState, FleetStreamProcessor, Waypoint,
+                       waypoint_epoch)
+
+SNAPSHOT_MAGIC = b'TXCP'
+BATCH_MAGIC = b'TXJB'
+VERSION = 3
+STREAM, FLEET = 0, 1
+
+# magic, version, kind of processor, input offset, number of states
+_SNAPSHOT_HEADER = struct.Struct('<4sBBQI')
+# magic, input offset, number of states, payload size
+_BATCH_HEADER = struct.Struct('<4sQII')
+_CRC = struct.Struct('<I')
+# last seen epoch, distance, flags
+_STATE = struct.Struct('<qdB')
+_WAYPOINT = struct.Struct('<qdd')
+# lat, lng, epoch, speed, NaN if unknown, and dropped of a JumpWindow
+_JUMP_WINDOW = struct.Struct('<ddqdI')
+_INT_ID = struct.Struct('<q')
+_STR_ID_SIZE = struct.Struct('<H')
+
+# the waypoints of a state, which are only written if they are set
+_POINTS = ('previous_point', 'move_first', 'move_last', 'stop_first',
+           'stop_last')
+_HAS_LAST_SEEN = 1 << len(_POINTS)
+_EVICTED = _HAS_LAST_SEEN << 1
+_HAS_JUMP_WINDOW = _EVICTED << 1
+
+_NO_ID, _INT_ID_TAG, _STR_ID_TAG = 0, 1, 2
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def _encode_device_id(device_id: Hashable, buffer: bytearray):
+    if device_id is None:
+        buffer.append(_NO_ID)
+    elif isinstance(device_id, int):
+        buffer.append(_INT_ID_TAG)
+        buffer += _INT_ID.pack(device_id)
+    elif isinstance(device_id, str):
+        encoded = device_id.encode()
+        buffer.append(_STR_ID_TAG)
+        buffer += _STR_ID_SIZE.pack(len(encoded)) + encoded
+    else:
+        raise CheckpointError("Unsupported device id: %r" % (device_id,))
+
+
+def _decode_device_id(data: bytes, position: int) -> Tuple[Hashable, int]:
+    tag = data[position]
+    position += 1
+    if tag == _NO_ID:
+        return None, position
+    if tag == _INT_ID_TAG:
+        return _INT_ID.unpack_from(data, position)[0], \
+            position + _INT_ID.size
+    if tag == _STR_ID_TAG:
+        size, = _STR_ID_SIZE.unpack_from(data, position)
+        position += _STR_ID_SIZE.size
+        return data[position:position + size].decode(), position + size
+    raise CheckpointError("Unknown device id tag: %d" % tag)
+
+
+def _encode_state(device_id: Hashable, state: DeviceState,
+                  buffer: bytearray):
+    """
+    Append the state of the trip extraction of a device to the buffer, its
+    waypoints take 24 bytes each and the window of the jump filter 36 bytes.
+    """
+    _encode_device_id(device_id, buffer)
+    if state is None:
+        buffer += _STATE.pack(0, 0.0, _EVICTED)
+        return
+
+    points = [getattr(state, name) for name in _POINTS]
+    flags = 0
+    for bit, point in enumerate(points):
+        if point is not None:
+            flags |= 1 << bit
+    if state.last_seen is not None:
+        flags |= _HAS_LAST_SEEN
+    window = state.jump_window
+    # a window without a waypoint is the same as none
+    if window is not None and window.epoch is not None:
+        flags |= _HAS_JUMP_WINDOW
+    buffer += _STATE.pack(state.last_seen or 0, state.distance, flags)
+    for point in points:
+        if point is not None:
+            buffer += _WAYPOINT.pack(
+                waypoint_epoch(point), point.lat, point.lng)
+    if flags & _HAS_JUMP_WINDOW:
+        buffer += _JUMP_WINDOW.pack(
+            window.lat, window.lng, window.epoch,
+            float('nan') if window.speed is None else window.speed,
+            window.dropped)
+
+
+def _decode_state(data: bytes, position: int, state_class=DeviceState
+                  ) -> Tuple[Hashable, DeviceState, int]:
+    """
+    Read a state written by _encode_state and return the device id, the
+    state, which is None for evicted devices, and the position after it.
+    The state is of the state_class of the processor, which holds its
+    thresholds.
+    """
+    device_id, position = _decode_device_id(data, position)
+    last_seen, distance, flags = _STATE.unpack_from(data, position)
+    position += _STATE.size
+    if flags & _EVICTED:
+        return device_id, None, position
+
+    state = state_class()
+    for bit, name in enumerate(_POINTS):
+        if flags & 1 << bit:
+            epoch, lat, lng = _WAYPOINT.unpack_from(data, position)
+            position += _WAYPOINT.size
+            setattr(state, name, Waypoint(format_timestamp(epoch), lat, lng,
+                                          epoch, device_id))
+    state.distance = distance
+    state.last_seen = last_seen if flags & _HAS_LAST_SEEN else None
+    if flags & _HAS_JUMP_WINDOW:
+        window = state.jump_window = JumpWindow()
+        window.lat, window.lng, window.epoch, speed, window.dropped = \
+            _JUMP_WINDOW.unpack_from(data, position)
+        position += _JUMP_WINDOW.size
+        window.speed = None if math.isnan(speed) else speed
+    return device_id, state, position
+
+
+def _state_class(processor):
+    if isinstance(processor, FleetStreamProcessor):
+        processor = processor._processor
+    return processor.state_class
+
+
+def _write_atomically(path: str, data: bytes):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as _file:
+        _file.write(data)
+        _file.flush()
+        os.fsync(_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def dump_state(processor, offset: int) -> bytes:
+    """
+    Return a snapshot of the state of a WaypointStreamProcessor or a
+    FleetStreamProcessor, after it has processed offset waypoints.
+    """
+    buffer = bytearray()
+    if isinstance(processor, FleetStreamProcessor):
+        kind, count = FLEET, len(processor)
+        for device_id, state in processor.device_states():
+            _encode_state(device_id, state, buffer)
+    else:
+        kind, count = STREAM, 1
+        point = processor.state.previous_point
+        _encode_state(point.device_id if point else None, processor.state,
+                      buffer)
+    return _SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, VERSION, kind, offset, count) + bytes(buffer)
+
+
+def _decode_snapshot(data: bytes, processor) -> Tuple[int, Dict]:
+    magic, version, kind, offset, count = \
+        _SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != VERSION:
+        raise CheckpointError("Not a checkpoint of version %d" % VERSION)
+    if kind != (FLEET if isinstance(processor, FleetStreamProcessor)
+                else STREAM):
+        raise CheckpointError("The checkpoint is of another processor")
+
+    position = _SNAPSHOT_HEADER.size
+    if kind == STREAM:
+        _, processor.state, _ = _decode_state(
+            data, position, processor.state_class)
+        return offset, {}
+    states = OrderedDict()
+    for _ in range(count):
+        device_id, state, position = _decode_state(
+            data, position, _state_class(processor))
+        states[device_id] = state
+    return offset, states
+
+
+def load_state(data: bytes, processor) -> int:
+    """
+    Restore a snapshot of dump_state into a new processor of the same kind
+    and return the offset of the next waypoint to process.
+    """
+    offset, states = _decode_snapshot(data, processor)
+    for device_id, state in states.items():
+        processor.set_device_state(device_id, state)
+    return offset
+
+
+def _read_batches(data: bytes) -> Iterable[Tuple[int, bytes, int]]:
+    """
+    Yield the offset, payload and number of states of every complete batch
+    of a journal. A batch torn by a crash ends the journal.
+    """
+    position = 0
+    while position + _BATCH_HEADER.size <= len(data):
+        magic, offset, count, size = _BATCH_HEADER.unpack_from(
+            data, position)
+        start = position + _BATCH_HEADER.size
+        end = start + size
+        if magic != BATCH_MAGIC or end + _CRC.size > len(data):
+            return
+        payload = data[start:end]
+        if _CRC.unpack_from(data, end)[0] != zlib.crc32(payload):
+            return
+        yield offset, payload, count
+        position = end + _CRC.size
+
+
+def restore(path: str, processor) -> int:
+    """
+    Restore the state checkpointed at path into a new processor and return
+    the offset of the next waypoint to process, 0 without a checkpoint.
+
+    :param path: str
+    :param processor: WaypointStreamProcessor or FleetStreamProcessor
+    """
+    try:
+        with open(path, 'rb') as _file:
+            offset, states = _decode_snapshot(_file.read(), processor)
+    except FileNotFoundError:
+        return 0
+    if not isinstance(processor, FleetStreamProcessor):
+        return offset
+
+    try:
+        with open(path + '.journal', 'rb') as _file:
+            journal = _file.read()
+    except FileNotFoundError:
+        journal = b''
+    for batch_offset, payload, count in _read_batches(journal):
+        # a journal left behind by a crash during compaction is older
+        if batch_offset <= offset:
+            continue
+        position = 0
+        for _ in range(count):
+            device_id, state, position = _decode_state(
+                payload, position, _state_class(processor))
+            states.pop(device_id, None)
+            if state is not None:
+                states[device_id] = state
+        offset = batch_offset
+
+    # devices are evicted in the order they were seen last
+    for device_id, state in sorted(
+            states.items(), key=lambda item: item[1].last_seen or 0):
+        processor.set_device_state(device_id, state)
+    return offset
+
+
+class Checkpointer:
+    """
+    Feed waypoints to a processor and checkpoint its state every interval
+    waypoints. The state of a WaypointStreamProcessor is small and written
+    as a whole. A FleetStreamProcessor appends the states of the devices seen
+    since the last checkpoint to a journal next to the snapshot, and rewrites
+    the snapshot after compact_every checkpoints.
+    """
+    INTERVAL = 10000
+    COMPACT_EVERY = 100
+
+    def __init__(self, processor, path: str, interval: int = None,
+                 compact_every: int = None, offset: int = 0):
+        """
+        :param processor: WaypointStreamProcessor or FleetStreamProcessor
+        :param path: str, path of the snapshot
+        :param interval: int, number of waypoints between checkpoints
+        :param compact_every: int, number of journal batches per snapshot
+        :param offset: int, number of waypoints processed before, as returned
+        by restore
+        """
+        self._processor = processor
+        self._path = path
+        self._journal_path = path + '.journal'
+        self._interval = interval or self.INTERVAL
+        self._compact_every = compact_every or self.COMPACT_EVERY
+        self._fleet = isinstance(processor, FleetStreamProcessor)
+        self._offset = offset
+        self._checkpointed_offset = offset
+        self._batches = None
+        self._dirty = set()
+        self._persisted = set()
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    def process_waypoint(self, waypoint: Waypoint):
+        result = self._processor.process_waypoint(waypoint)
+        self._offset += 1
+        if self._fleet:
+            self._dirty.add(waypoint.device_id)
+        if self._offset - self._checkpointed_offset >= self._interval:
+            self.checkpoint()
+        return result
+
+    def checkpoint(self):
+        if (not self._fleet or self._batches is None or
+                self._batches >= self._compact_every):
+            self._write_snapshot()
+        else:
+            self._append_batch()
+        self._checkpointed_offset = self._offset
+        self._dirty.clear()
+
+    def _write_snapshot(self):
+        _write_atomically(self._path, dump_state(
+            self._processor, self._offset))
+        if self._fleet:
+            with open(self._journal_path, 'wb'):
+                pass
+            self._batches = 0
+            self._persisted = {device_id for device_id, _ in
+                               self._processor.device_states()}
+
+    def _append_batch(self):
+        buffer = bytearray()
+        count = 0
+        for device_id in self._dirty | self._persisted:
+            state = self._processor.get_device_state(device_id)
+            if state is None and device_id not in self._persisted:
+                continue
+            if state is None or device_id in self._dirty:
+                _encode_state(device_id, state, buffer)
+                count += 1
+            if state is None:
+                self._persisted.discard(device_id)
+            else:
+                self._persisted.add(device_id)
+
+        with open(self._journal_path, 'ab') as journal:
+            journal.write(_BATCH_HEADER.pack(
+                BATCH_MAGIC, self._offset, count, len(buffer)) +
+                bytes(buffer) + _CRC.pack(zlib.crc32(buffer)))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._batches += 1
@@ -0,0 +1,205 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Hashable, Iterable, List, NamedTuple, Tuple
+
+from processor import Trip, Waypoint, WaypointListProcessor, waypoint_epoch
+
+
+class TripChanges(NamedTuple):
+    added: List[Trip]
+    removed: List[Trip]
+    changed: List[Tuple[Trip, Trip]]
+
+
+class _Segment:
+    """
+    Waypoints from index start to end of a device. The trips are the ones
+    extracted from the waypoints after start, the state is the one after end.
+    """
+    __slots__ = ('start', 'end', 'state', 'trips')
+
+    def __init__(self, start: int, end: int, state: tuple,
+                 trips: List[Trip]):
+        self.start = start
+        self.end = end
+        self.state = state
+        self.trips = trips
+
+
+class _DeviceTrips:
+    """
+    Waypoints of a device ordered by their epoch, the distance from the
+    previous waypoint, which is None until it is computed, and the segments.
+    """
+    __slots__ = ('points', 'epochs', 'distances', 'segments')
+
+    def __init__(self):
+        self.points = []
+        self.epochs = []
+        self.distances = []
+        self.segments = []
+
+
+class IncrementalTripExtractor:
+    """
+    Keeps the waypoints and trips of every device and updates the trips when
+    waypoints arrive late or out of order. The waypoints of a device are split
+    into segments of up to SEGMENT_SIZE waypoints, which keep the state of
+    the trip extraction at their end. New waypoints get the segments
+    re-extracted from the one before the first new waypoint up to the first
+    segment after the last new waypoint which ends with the same state as
+    before, usually the end of the next trip.
+    The trips of a device are the ones WaypointListProcessor extracts from
+    all its waypoints ordered by epoch, waypoints with the same epoch in the
+    order they arrived.
+    """
+    SEGMENT_SIZE = 1000
+
+    def __init__(self, geo_library=None):
+        """
+        :param geo_library: library computing the distances, GeopyLibrary
+        by default
+        """
+        # the trip extraction is run on the waypoints of one segment at a time
+        self._processor = WaypointListProcessor((), geo_library)
+        self.prefilter = self._processor.prefilter
+        self._devices = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def get_trips(self, device_id: Hashable = None) -> List[Trip]:
+        """
+        Return the trips of a device ordered by time.
+
+        :param device_id: Hashable, None for waypoints without device_id
+        """
+        device = self._devices.get(device_id)
+        if device is None:
+            return []
+        return [trip for segment in device.segments for trip in segment.trips]
+
+    def add_waypoints(self, waypoints: Iterable[Waypoint]) -> TripChanges:
+        """
+        Add waypoints of any devices in any order and return the trips which
+        were added, removed or changed as pairs of the old and new trip.
+        Trips are matched by their start waypoint.
+
+        :param waypoints: Iterable[Waypoint]
+        """
+        devices = OrderedDict()
+        for waypoint in waypoints:
+            devices.setdefault(waypoint.device_id, []).append(waypoint)
+
+        changes = TripChanges([], [], [])
+        for device_id, device_points in devices.items():
+            device = self._devices.get(device_id)
+            if device is None:
+                device = self._devices[device_id] = _DeviceTrips()
+            old_trips, new_trips = self._update(device, device_points)
+
+            old_starts = {trip.start: trip for trip in old_trips}
+            new_starts = {trip.start for trip in new_trips}
+            for trip in new_trips:
+                old_trip = old_starts.get(trip.start)
+                if old_trip is None:
+                    changes.added.append(trip)
+                elif old_trip != trip:
+                    changes.changed.append((old_trip, trip))
+            changes.removed.extend(trip for trip in old_trips
+                                   if trip.start not in new_starts)
+        return changes
+
+    def _insert(self, device: _DeviceTrips,
+                waypoints: List[Waypoint]) -> Tuple[int, int]:
+        """
+        Insert the waypoints and return the first and last index of the
+        waypoints, whose distance to the previous waypoint changed.
+        """
+        first_changed = last_changed = None
+        for waypoint in waypoints:
+            epoch = waypoint_epoch(waypoint)
+            index = bisect_right(device.epochs, epoch)
+            device.points.insert(index, waypoint)
+            device.epochs.insert(index, epoch)
+            device.distances.insert(index, None)
+            if index + 1 < len(device.distances):
+                device.distances[index + 1] = None
+
+            for segment in reversed(device.segments):
+                if segment.end < index:
+                    break
+                segment.end += 1
+                if segment.start >= index:
+                    segment.start += 1
+
+            if first_changed is None:
+                first_changed, last_changed = index, index + 1
+            else:
+                if index <= last_changed:
+                    last_changed += 1
+                first_changed = min(first_changed, index)
+                last_changed = max(last_changed, index + 1)
+        return first_changed, last_changed
+
+    def _update(self, device: _DeviceTrips, waypoints: List[Waypoint]
+                ) -> Tuple[List[Trip], List[Trip]]:
+        """
+        Insert the waypoints of a device, re-extract the trips of the
+        affected segments and return their old and new trips.
+        """
+        first_changed, last_changed = self._insert(device, waypoints)
+        points = device.points
+        segments = device.segments
+
+        # the last segment starting before the first new waypoint
+        first = len(segments) - 1
+        while first >= 0 and segments[first].start >= first_changed:
+            first -= 1
+        if first < 0:
+            first, start, state = 0, 0, None
+        else:
+            start = segments[first].start
+            state = segments[first - 1].state if first else None
+        old_ends = {segment.end: position for position, segment in
+                    enumerate(segments[first:], first)}
+
+        processor = self._processor
+        compute_distance = processor._geo.compute_distance_in_meters
+        last = len(points) - 1
+        new_segments = []
+        replaced = len(segments)
+        ends = iter(old_ends)
+        old_end = next(ends, last)
+        while True:
+            # keep the ends of the old segments, to find the same state again
+            while old_end <= start < last:
+                old_end = next(ends, last)
+            end = min(old_end, start + self.SEGMENT_SIZE, last)
+
+            distances = device.distances
+            for index in range(start + 1, end + 1):
+                if distances[index] is None:
+                    distances[index] = compute_distance(
+                        points[index - 1], points[index])
+            processor._waypoints = points[start:end + 1]
+            trips, end_state = processor._extract_trips(
+                points[-1], state, distances[start + 1:end + 1])
+            new_segments.append(_Segment(start, end, end_state, trips))
+            if end >= last:
+                break
+
+            position = old_ends.get(end)
+            if (end >= last_changed and position is not None and
+                    segments[position].state == end_state):
+                replaced = position + 1
+                break
+            start, state = end, end_state
+        processor._waypoints = ()
+
+        old_trips = [trip for segment in segments[first:replaced]
+                     for trip in segment.trips]
+        segments[first:replaced] = new_segments
+        new_trips = [trip for segment in new_segments
+                     for trip in segment.trips]
+        return old_trips, new_trips
@@ -0,0 +1,295 @@
+from typing import Dict, Iterable, Iterator, Sequence, TextIO
+
+import numpy as np
+
+from lib.geo import GeoAdapter, Waypoint
+from processor import (FleetStreamProcessor, ParallelWaypointListProcessor,
+                       WaypointListProcessor, WaypointStreamProcessor)
+
+try:
+    from time import perf_counter_ns
+except ImportError:
+    # Python 3.6 has no clock in integer nanoseconds
+    from time import perf_counter
+
+    def perf_counter_ns() -> int:
+        return int(perf_counter() * 1e9)
+
+READ, DISTANCE, EXTRACT, WRITE = 'read', 'distance', 'extract', 'write'
+STAGES = (READ, DISTANCE, EXTRACT, WRITE)
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in buckets of powers of two nanoseconds.
+    """
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+
+    def record(self, nanoseconds: int):
+        self.buckets[nanoseconds.bit_length()] += 1
+        self.count += 1
+        self.total += nanoseconds
+
+    def add(self, histogram: 'LatencyHistogram'):
+        for bit_length, count in enumerate(histogram.buckets):
+            self.buckets[bit_length] += count
+        self.count += histogram.count
+        self.total += histogram.total
+
+    def percentile(self, percent: float) -> int:
+        """
+        Return the upper bound of the bucket of the percentile in
+        nanoseconds, 0 without latencies.
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for bit_length, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return (1 << bit_length) - 1
+        return 0
+
+
+class Stats:
+    """
+    Counters and latency histograms of the stages of an instrumented
+    processor: reading waypoints, computing distances, extracting trips and
+    writing them. Processors are instrumented by instrument(), otherwise
+    they run without any measurement.
+    """
+
+    def __init__(self):
+        self.points = 0
+        self.segments = 0
+        self.trips = 0
+        self.noise = 0
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self._prefilters = []
+        self._jump_filters = []
+
+    @property
+    def geodesic_calls(self) -> int:
+        return sum(prefilter.exact for prefilter in self._prefilters)
+
+    @property
+    def avoided_geodesic_calls(self) -> int:
+        return sum(prefilter.avoided for prefilter in self._prefilters)
+
+    @property
+    def dropped_jumps(self) -> int:
+        return sum(jump_filter.dropped for jump_filter in self._jump_filters)
+
+    def record(self, stage: str, nanoseconds: int):
+        self.histograms[stage].record(nanoseconds)
+
+    def add(self, stats: 'Stats', extracted: bool = True):
+        """
+        Add the counters and latencies of the stats of another processor,
+        e.g. of a chunk extracted in another process. Its geodesic calls and
+        dropped jumps are not added, they are counted by the processor the
+        chunk belongs to.
+
+        :param stats: Stats
+        :param extracted: bool, False if only the distances of the processor
+        are kept and its trips are extracted again
+        """
+        self.points += stats.points
+        self.histograms[DISTANCE].add(stats.histograms[DISTANCE])
+        if not extracted:
+            return
+        self.segments += stats.segments
+        self.trips += stats.trips
+        self.noise += stats.noise
+        for stage in (READ, EXTRACT, WRITE):
+            self.histograms[stage].add(stats.histograms[stage])
+
+    def read(self, waypoints: Iterable[Waypoint]) -> Iterator[Waypoint]:
+        """
+        Yield the waypoints and record how long it takes to read each one.
+        """
+        iterator = iter(waypoints)
+        histogram = self.histograms[READ]
+        while True:
+            start = perf_counter_ns()
+            try:
+                waypoint = next(iterator)
+            except StopIteration:
+                return
+            histogram.record(perf_counter_ns() - start)
+            self.points += 1
+            yield waypoint
+
+    def write(self, trips: Iterable) -> Iterator:
+        """
+        Yield the trips to a writer and record how long it takes to write
+        each one, the time until the writer asks for the next trip.
+        """
+        histogram = self.histograms[WRITE]
+        for trip in trips:
+            start = perf_counter_ns()
+            yield trip
+            histogram.record(perf_counter_ns() - start)
+
+    def as_dict(self) -> Dict:
+        return {
+            'points': self.points,
+            'segments': self.segments,
+            'geodesic_calls': self.geodesic_calls,
+            'avoided_geodesic_calls': self.avoided_geodesic_calls,
+            'trips': self.trips,
+            'noise': self.noise,
+            'dropped_jumps': self.dropped_jumps,
+            'stages': {
+                stage: {
+                    'count': histogram.count,
+                    'total_ns': histogram.total,
+                    'p50_ns': histogram.percentile(50),
+                    'p99_ns': histogram.percentile(99),
+                } for stage, histogram in self.histograms.items()},
+        }
+
+    def print_breakdown(self, output: TextIO):
+        total = sum(histogram.total for histogram in
+                    self.histograms.values()) or 1
+        output.write("%-9s %10s %10s %7s %9s %9s\n" % (
+            'stage', 'count', 'total ms', 'share', 'p50 us', 'p99 us'))
+        for stage, histogram in self.histograms.items():
+            output.write("%-9s %10d %10.1f %6.1f%% %9.1f %9.1f\n" % (
+                stage, histogram.count, histogram.total / 1e6,
+                100 * histogram.total / total,
+                histogram.percentile(50) / 1e3,
+                histogram.percentile(99) / 1e3))
+        output.write(
+            "points: %d, segments: %d, geodesic calls: %d (%d avoided), "
+            "trips: %d, noise discarded: %d, jumps dropped: %d\n" % (
+                self.points, self.segments, self.geodesic_calls,
+                self.avoided_geodesic_calls, self.trips, self.noise,
+                self.dropped_jumps))
+
+
+class TimedGeoLibrary:
+    """
+    Decorate a library to record the latency of its distance computations.
+    """
+
+    def __init__(self, geo_library, stats: Stats):
+        self._geo = GeoAdapter(geo_library)
+        self._histogram = stats.histograms[DISTANCE]
+
+    def compute_distance_in_meters(self, origin: Waypoint,
+                                   destination: Waypoint) -> float:
+        start = perf_counter_ns()
+        distance = self._geo.compute_distance_in_meters(origin, destination)
+        self._histogram.record(perf_counter_ns() - start)
+        return distance
+
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        start = perf_counter_ns()
+        distances = self._geo.compute_distances_in_meters(lats, lngs)
+        self._histogram.record(perf_counter_ns() - start)
+        return distances
+
+
+class CountingGeoLibrary:
+    """
+    Decorate a library to count its calls and the distances it computes,
+    e.g. the geodesics per waypoint of a processor. The batch interface is
+    only offered if the library has one, so processors call the library the
+    same way as without the decorator.
+    """
+
+    def __init__(self, geo_library):
+        self._geo = geo_library
+        self.calls = 0
+        self.distances = 0
+        if hasattr(geo_library, 'compute_distances_in_meters'):
+            self.compute_distances_in_meters = \
+                self._compute_distances_in_meters
+
+    def compute_distance_in_meters(self, origin: Waypoint,
+                                   destination: Waypoint) -> float:
+        self.calls += 1
+        self.distances += 1
+        return self._geo.compute_distance_in_meters(origin, destination)
+
+    def _compute_distances_in_meters(self, lats: Sequence[float],
+                                     lngs: Sequence[float]) -> np.ndarray:
+        self.calls += 1
+        self.distances += max(len(lats) - 1, 0)
+        return self._geo.compute_distances_in_meters(lats, lngs)
+
+
+class _InstrumentedExtractor:
+    """
+    Mixin of a TripExtractor, which records the latency of every segment
+    and counts the trips, including the ones too short to be kept.
+    """
+    __slots__ = ()
+    stats = None
+
+    def process_segment(self, current_point, next_point, distance,
+                        end=False):
+        start = perf_counter_ns()
+        trip = super().process_segment(current_point, next_point, distance,
+                                       end)
+        stats = self.stats
+        stats.histograms[EXTRACT].record(perf_counter_ns() - start)
+        stats.segments += 1
+        return trip
+
+    def end_trip(self):
+        moved = self.distance > 0
+        trip = super().end_trip()
+        if trip is not None:
+            self.stats.trips += 1
+        elif moved:
+            self.stats.noise += 1
+        return trip
+
+
+def _instrumented_class(extractor_class, stats: Stats):
+    return type(extractor_class.__name__, (
+        _InstrumentedExtractor, extractor_class), {
+        '__slots__': (), 'stats': stats})
+
+
+def instrument(processor, stats: Stats = None) -> Stats:
+    """
+    Instrument a new list, stream or fleet processor and return the stats it
+    records into. The chunks of ParallelWaypointListProcessor are extracted
+    by processors of their own, also in the processes of its pool, which are
+    instrumented by it and whose stats are added to these.
+
+    :param processor: WaypointListProcessor, WaypointStreamProcessor or
+    FleetStreamProcessor
+    :param stats: Stats, new stats by default
+    """
+    stats = stats or Stats()
+    if isinstance(processor, FleetStreamProcessor):
+        instrument(processor._processor, stats)
+        return stats
+
+    if isinstance(processor, ParallelWaypointListProcessor):
+        processor._instrument = instrument
+        processor._stats = stats
+    elif isinstance(processor, WaypointListProcessor):
+        processor.extractor_class = _instrumented_class(
+            processor.extractor_class, stats)
+    elif isinstance(processor, WaypointStreamProcessor):
+        processor.state_class = _instrumented_class(
+            processor.state_class, stats)
+        processor.state = processor.state_class()
+    else:
+        raise TypeError("Can not instrument %r" % processor)
+
+    processor._geo = GeoAdapter(TimedGeoLibrary(processor.prefilter, stats))
+    stats._prefilters.append(processor.prefilter)
+    if processor.jump_filter is not None:
+        stats._jump_filters.append(processor.jump_filter)
+    return stats
@@ -0,0 +1,77 @@
+from typing import Iterable, List
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over a list of numbers, which can grow at its end.
+    Adding to a number, appending one and the sum of a range take
+    O(log n), building the tree of n numbers takes O(n).
+    Node i, counting from 1, holds the sum of the numbers from
+    i - (i & -i) to i - 1.
+    """
+    __slots__ = ('_tree',)
+
+    def __init__(self, values: Iterable[float] = ()):
+        tree = [0]
+        tree.extend(values)
+        size = len(tree) - 1
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                tree[parent] += tree[index]
+        self._tree = tree
+
+    def __len__(self) -> int:
+        return len(self._tree) - 1
+
+    def append(self, value: float = 0):
+        index = len(self._tree)
+        low = index - (index & -index)
+        self._tree.append(value + self.prefix_sum(index - 1) -
+                          self.prefix_sum(low))
+
+    def add(self, index: int, value: float):
+        """
+        Add value to the number at index, counting from 0.
+        """
+        tree = self._tree
+        size = len(tree) - 1
+        index += 1
+        if not 0 < index <= size:
+            raise IndexError("FenwickTree index out of range")
+        while index <= size:
+            tree[index] += value
+            index += index & -index
+
+    def prefix_sum(self, end: int) -> float:
+        """
+        Return the sum of the numbers before index end.
+        """
+        tree = self._tree
+        end = min(end, len(tree) - 1)
+        total = 0
+        while end > 0:
+            total += tree[end]
+            end -= end & -end
+        return total
+
+    def range_sum(self, start: int, end: int) -> float:
+        """
+        Return the sum of the numbers from index start to end, exclusive.
+        """
+        start = max(start, 0)
+        if end <= start:
+            return 0
+        return self.prefix_sum(end) - self.prefix_sum(start)
+
+    def values(self) -> List[float]:
+        """
+        Return the numbers, in O(n).
+        """
+        values = list(self._tree)
+        size = len(values) - 1
+        for index in range(size, 0, -1):
+            parent = index + (index & -index)
+            if parent <= size:
+                values[parent] -= values[index]
+        return values[1:]
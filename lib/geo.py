@@ -1,8 +1,17 @@
 import abc
+import math
+from collections import OrderedDict
 from datetime import datetime
-from typing import NamedTuple
-from geopy.distance import distance
-from pyproj import Geod
+from functools import partial
+from typing import NamedTuple, Sequence
+import numpy as np
+
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+MEAN_EARTH_RADIUS_METERS = 6371008.8
 
 
 class Waypoint(NamedTuple):
@@ -11,6 +20,21 @@ class Waypoint(NamedTuple):
     lng: float
 
 
+def estimate_distance_in_meters(lat1: float, lng1: float, lat2: float,
+                                lng2: float) -> float:
+    """
+    Return the equirectangular distance on the radii of curvature of the
+    WGS84 ellipsoid at the mean latitude, which deviates from the geodesic by
+    less than a micrometer for segments of a few meters.
+    """
+    latitude = math.radians((lat1 + lat2) / 2)
+    w = 1 - WGS84_E2 * math.sin(latitude) ** 2
+    return math.hypot(
+        WGS84_A * (1 - WGS84_E2) / w ** 1.5 * math.radians(lat2 - lat1),
+        WGS84_A / math.sqrt(w) * math.cos(latitude) *
+        math.radians((lng2 - lng1 + 540) % 360 - 180))
+
+
 class GeoLibrary(metaclass=abc.ABCMeta):
     """
     Define Geo library interface that will be used by Client.
@@ -24,6 +48,11 @@ class GeoLibrary(metaclass=abc.ABCMeta):
                                    destination: Waypoint) -> float:
         pass
 
+    @abc.abstractmethod
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        pass
+
 
 class GeoAdapter(GeoLibrary):
     """
@@ -35,17 +64,63 @@ class GeoAdapter(GeoLibrary):
         return self._geo.compute_distance_in_meters(
             origin, destination)
 
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        """
+        Return the distances between every pair of consecutive coordinates,
+        so the result has one element less than the given coordinates.
+        Libraries without a batch interface are called pair by pair.
+        """
+        if hasattr(self._geo, 'compute_distances_in_meters'):
+            return self._geo.compute_distances_in_meters(lats, lngs)
+
+        points = [Waypoint(None, lat, lng) for lat, lng in zip(lats, lngs)]
+        return np.fromiter(
+            (self._geo.compute_distance_in_meters(origin, destination)
+             for origin, destination in zip(points, points[1:])),
+            dtype=np.float64, count=max(len(points) - 1, 0))
+
+    def compute_segment_distances_in_meters(self, lats: np.ndarray,
+                                            lngs: np.ndarray,
+                                            indexes: np.ndarray
+                                            ) -> np.ndarray:
+        """
+        Return the distances of the segments starting at the indexes of the
+        coordinates, in one batch of these segments or pair by pair for
+        libraries without a batch interface.
+        """
+        if hasattr(self._geo, 'compute_distances_in_meters'):
+            # origin and destination of every segment, one after the other
+            segment_lats = np.column_stack(
+                (lats[indexes], lats[indexes + 1])).ravel()
+            segment_lngs = np.column_stack(
+                (lngs[indexes], lngs[indexes + 1])).ravel()
+            return self._geo.compute_distances_in_meters(
+                segment_lats, segment_lngs)[::2]
+
+        return np.fromiter(
+            (self._geo.compute_distance_in_meters(
+                Waypoint(None, lats[index], lngs[index]),
+                Waypoint(None, lats[index + 1], lngs[index + 1]))
+             for index in indexes.tolist()),
+            dtype=np.float64, count=len(indexes))
+
 
 class GeopyLibrary:
     """
     Define an interface using Geopy library functions.
     """
 
+    def __init__(self):
+        # imported on first use, it takes longer than most short jobs
+        from geopy.distance import distance
+        self._distance = distance
+
     def compute_distance_in_meters(self, origin: Waypoint,
                                    destination: Waypoint):
 
-        return distance((origin.lat, origin.lng),
-                        (destination.lat, destination.lng)).meters
+        return self._distance((origin.lat, origin.lng),
+                              (destination.lat, destination.lng)).meters
 
 
 class PyprojLibrary:
@@ -53,9 +128,413 @@ class PyprojLibrary:
     Define an interface using Pyproj library functions.
     """
 
+    def __init__(self):
+        from pyproj import Geod
+        self._geod = Geod(ellps='WGS84')
+
     def compute_distance_in_meters(self, origin: Waypoint,
                                    destination: Waypoint) -> float:
-        geod = Geod(ellps='WGS84')
-        _, _, distance = geod.inv(
+        _, _, distance = self._geod.inv(
             origin.lng, origin.lat, destination.lng, destination.lat)
         return distance
+
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        _, _, distances = self._geod.inv(
+            lngs[:-1], lats[:-1], lngs[1:], lats[1:])
+        return np.asarray(distances, dtype=np.float64)
+
+
+class NumpyLibrary:
+    """
+    Define an interface computing whole coordinate arrays with NumPy.
+
+    Two formulas are available:
+    - 'vincenty' solves the inverse problem on the WGS84 ellipsoid, it
+      matches the geodesic of GeopyLibrary within 1 millimeter per segment.
+      The few nearly antipodal segments, for which the iteration does not
+      converge, are solved with Karney's algorithm (geographiclib).
+    - 'haversine' uses a sphere of the mean earth radius, it is faster but
+      deviates from the geodesic by up to 0.5% of the distance.
+    """
+    FORMULAS = ('vincenty', 'haversine')
+    MAX_ITERATIONS = 200
+    CONVERGENCE_THRESHOLD = 1e-12
+
+    def __init__(self, formula: str = 'vincenty'):
+        if formula not in self.FORMULAS:
+            raise ValueError("Unknown formula: %s" % formula)
+        self._formula = formula
+
+    def compute_distance_in_meters(self, origin: Waypoint,
+                                   destination: Waypoint) -> float:
+        return float(self.compute_distances_in_meters(
+            (origin.lat, destination.lat), (origin.lng, destination.lng))[0])
+
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        lats = np.radians(np.asarray(lats, dtype=np.float64))
+        lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+        if self._formula == 'haversine':
+            return self._haversine(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+        return self._vincenty(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+
+    def _haversine(self, lat1, lng1, lat2, lng2) -> np.ndarray:
+        a = (np.sin((lat2 - lat1) / 2) ** 2 +
+             np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+        return 2 * MEAN_EARTH_RADIUS_METERS * np.arcsin(
+            np.sqrt(np.minimum(a, 1.0)))
+
+    def _vincenty(self, lat1, lng1, lat2, lng2) -> np.ndarray:
+        longitude_difference = lng2 - lng1
+        reduced_lat1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+        reduced_lat2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+        sin_u1, cos_u1 = np.sin(reduced_lat1), np.cos(reduced_lat1)
+        sin_u2, cos_u2 = np.sin(reduced_lat2), np.cos(reduced_lat2)
+
+        lambda_ = longitude_difference
+        converged = np.zeros(lambda_.shape, dtype=bool)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for _ in range(self.MAX_ITERATIONS):
+                sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+                sin_sigma = np.hypot(
+                    cos_u2 * sin_lambda,
+                    cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda)
+                cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+                sigma = np.arctan2(sin_sigma, cos_sigma)
+                sin_alpha = np.where(
+                    sin_sigma == 0, 0.0,
+                    cos_u1 * cos_u2 * sin_lambda / sin_sigma)
+                cos_sq_alpha = 1 - sin_alpha ** 2
+                cos_2sigma_m = np.where(
+                    cos_sq_alpha == 0, 0.0,
+                    cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+                c = WGS84_F / 16 * cos_sq_alpha * (
+                    4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+                previous_lambda = lambda_
+                lambda_ = longitude_difference + (1 - c) * WGS84_F * \
+                    sin_alpha * (sigma + c * sin_sigma * (
+                        cos_2sigma_m + c * cos_sigma * (
+                            -1 + 2 * cos_2sigma_m ** 2)))
+                converged = (np.abs(lambda_ - previous_lambda) <
+                             self.CONVERGENCE_THRESHOLD)
+                if converged.all():
+                    break
+
+        u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        a = 1 + u_sq / 16384 * (
+            4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) *
+            (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = WGS84_B * a * (sigma - delta_sigma)
+
+        for index in np.flatnonzero(~converged):
+            distances[index] = self._karney(
+                lat1[index], lng1[index], lat2[index], lng2[index])
+        return distances
+
+    def _karney(self, lat1, lng1, lat2, lng2) -> float:
+        from geographiclib.geodesic import Geodesic
+        return Geodesic.WGS84.Inverse(
+            np.degrees(lat1), np.degrees(lng1),
+            np.degrees(lat2), np.degrees(lng2))['s12']
+
+
+class PrefilterLibrary:
+    """
+    Decorate a library to skip its exact geodesic where it is not needed.
+    Identical coordinates have no distance at all. Other segments get a
+    cheap equirectangular estimate on the radii of curvature of the WGS84
+    ellipsoid at their mean latitude, which deviates from the geodesic by
+    less than a micrometer for segments of a few meters. Only segments whose
+    estimate is near or above the threshold are computed by the library.
+    The counters report how many exact computations were avoided.
+    """
+    NEAR_THRESHOLD_RATIO = 0.9
+
+    def __init__(self, geo_library, threshold_in_meters: float = 15):
+        self._geo = geo_library
+        self._exact_from = threshold_in_meters * self.NEAR_THRESHOLD_RATIO
+        self.identical = 0
+        self.approximated = 0
+        self.exact = 0
+
+    @property
+    def avoided(self) -> int:
+        return self.identical + self.approximated
+
+    def compute_distance_in_meters(self, origin: Waypoint,
+                                   destination: Waypoint) -> float:
+        if origin.lat == destination.lat and origin.lng == destination.lng:
+            self.identical += 1
+            return 0.0
+
+        estimate = estimate_distance_in_meters(
+            origin.lat, origin.lng, destination.lat, destination.lng)
+        if estimate < self._exact_from:
+            self.approximated += 1
+            return estimate
+
+        self.exact += 1
+        return self._geo.compute_distance_in_meters(origin, destination)
+
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        latitudes = np.radians((lats[:-1] + lats[1:]) / 2)
+        w = 1 - WGS84_E2 * np.sin(latitudes) ** 2
+        distances = np.hypot(
+            WGS84_A * (1 - WGS84_E2) / w ** 1.5 * np.radians(np.diff(lats)),
+            WGS84_A / np.sqrt(w) * np.cos(latitudes) *
+            np.radians((np.diff(lngs) + 540) % 360 - 180))
+
+        identical = (np.diff(lats) == 0) & (np.diff(lngs) == 0)
+        distances[identical] = 0.0
+        exact = np.flatnonzero(distances >= self._exact_from)
+        self.identical += int(identical.sum())
+        self.approximated += len(distances) - len(exact) - int(
+            identical.sum())
+        self.exact += len(exact)
+        if len(exact) == 0:
+            return distances
+
+        adapter = GeoAdapter(self._geo)
+        if (len(exact) > len(distances) // 2 and
+                hasattr(self._geo, 'compute_distances_in_meters')):
+            # a batch of all segments is faster than picking the exact ones
+            exact_distances = adapter.compute_distances_in_meters(lats, lngs)
+            distances[exact] = exact_distances[exact]
+        else:
+            distances[exact] = adapter.compute_segment_distances_in_meters(
+                lats, lngs, exact)
+        return distances
+
+
+class CachingLibrary:
+    """
+    Decorate a library to remember the distances of coordinate pairs, which
+    repeat on the routes and at the parking spots of a fleet. Coordinates are
+    quantized to the given decimals, about 0.1 meters by default, and the
+    distances are computed between the quantized coordinates, so a distance
+    does not depend on what is cached.
+    The least recently used pairs are evicted to keep the cache within
+    max_bytes. With a path, pairs are also kept in a SQLite file, which jobs
+    running one after another or at the same time share, as long as they use
+    the same library and decimals. Pairs computed by a job are written in
+    batches, call flush() or close() when it is done.
+    """
+    DECIMALS = 6
+    MAX_BYTES = 64 * 1024 * 1024
+    # memory of a pair in the cache, measured with tracemalloc
+    ENTRY_BYTES = 330
+    FLUSH_EVERY = 10000
+
+    def __init__(self, geo_library, max_bytes: int = MAX_BYTES,
+                 path: str = None, decimals: int = DECIMALS):
+        """
+        :param geo_library: library computing the distances of new pairs
+        :param max_bytes: int, memory of the cache at most
+        :param path: str, SQLite file of the persistent cache, none by
+        default
+        :param decimals: int, decimals of the quantized coordinates
+        """
+        self._geo = GeoAdapter(geo_library)
+        self._library = type(geo_library).__name__
+        if isinstance(geo_library, NumpyLibrary):
+            self._library += ' ' + geo_library._formula
+        self._max_entries = max(1, max_bytes // self.ENTRY_BYTES)
+        self._scale = 10 ** decimals
+        self._decimals = decimals
+        self._path = path
+        self._database = None
+        self._pending = []
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None:
+            self._connect()
+
+    def __getstate__(self):
+        # processes of a pool get an empty cache and open the file again
+        state = self.__dict__.copy()
+        state.update(_database=None, _pending=[], _cache=OrderedDict())
+        return state
+
+    @property
+    def size(self) -> int:
+        return len(self._cache)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def _key(self, origin_lat: float, origin_lng: float,
+             destination_lat: float, destination_lng: float) -> tuple:
+        scale = self._scale
+        return (round(origin_lat * scale), round(origin_lng * scale),
+                round(destination_lat * scale),
+                round(destination_lng * scale))
+
+    def _connect(self):
+        if self._database is None:
+            import sqlite3
+            self._database = sqlite3.connect(self._path, timeout=30)
+            self._database.execute('PRAGMA journal_mode=WAL')
+            with self._database:
+                self._database.execute(
+                    'CREATE TABLE IF NOT EXISTS meta ('
+                    'name TEXT PRIMARY KEY, value)')
+                self._database.executemany(
+                    'INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                    (('library', self._library),
+                     ('decimals', self._decimals)))
+                self._database.execute(
+                    'CREATE TABLE IF NOT EXISTS distances ('
+                    'origin_lat INTEGER, origin_lng INTEGER, '
+                    'destination_lat INTEGER, destination_lng INTEGER, '
+                    'distance REAL, PRIMARY KEY (origin_lat, origin_lng, '
+                    'destination_lat, destination_lng)) WITHOUT ROWID')
+            meta = dict(self._database.execute('SELECT * FROM meta'))
+            if meta != {'library': self._library,
+                        'decimals': self._decimals}:
+                self._database.close()
+                self._database = None
+                raise ValueError(
+                    "The cache %s holds distances of %s with %d decimals" % (
+                        self._path, meta['library'], meta['decimals']))
+        return self._database
+
+    def _load(self, key: tuple):
+        row = self._connect().execute(
+            'SELECT distance FROM distances WHERE origin_lat = ? AND '
+            'origin_lng = ? AND destination_lat = ? AND destination_lng = ?',
+            key).fetchone()
+        return None if row is None else row[0]
+
+    def _store(self, key: tuple, distance: float):
+        cache = self._cache
+        cache[key] = distance
+        if len(cache) > self._max_entries:
+            cache.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key: tuple):
+        distance = self._cache.get(key)
+        if distance is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return distance
+        if self._path is not None:
+            distance = self._load(key)
+            if distance is not None:
+                self.disk_hits += 1
+                self._store(key, distance)
+                return distance
+        self.misses += 1
+        return None
+
+    def _add(self, key: tuple, distance: float):
+        self._store(key, distance)
+        if self._path is not None:
+            self._pending.append(key + (distance,))
+            if len(self._pending) >= self.FLUSH_EVERY:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the pairs computed since the last flush to the SQLite file.
+        """
+        if self._pending:
+            with self._connect() as database:
+                database.executemany(
+                    'INSERT OR IGNORE INTO distances VALUES (?, ?, ?, ?, ?)',
+                    self._pending)
+            self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._database is not None:
+            self._database.close()
+            self._database = None
+
+    def compute_distance_in_meters(self, origin: Waypoint,
+                                   destination: Waypoint) -> float:
+        key = self._key(origin.lat, origin.lng, destination.lat,
+                        destination.lng)
+        distance = self._lookup(key)
+        if distance is None:
+            scale = self._scale
+            distance = float(self._geo.compute_distance_in_meters(
+                Waypoint(None, key[0] / scale, key[1] / scale),
+                Waypoint(None, key[2] / scale, key[3] / scale)))
+            self._add(key, distance)
+        return distance
+
+    def compute_distances_in_meters(self, lats: Sequence[float],
+                                    lngs: Sequence[float]) -> np.ndarray:
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        quantized_lats = np.round(lats * self._scale).astype(np.int64)
+        quantized_lngs = np.round(lngs * self._scale).astype(np.int64)
+        keys = list(zip(quantized_lats[:-1].tolist(),
+                        quantized_lngs[:-1].tolist(),
+                        quantized_lats[1:].tolist(),
+                        quantized_lngs[1:].tolist()))
+        distances = np.empty(len(keys))
+        # the indexes of the pairs to compute, pairs repeated in the batch
+        # are computed once
+        missing = {}
+        for index, key in enumerate(keys):
+            indexes = missing.get(key)
+            if indexes is not None:
+                indexes.append(index)
+                self.hits += 1
+                continue
+            distance = self._lookup(key)
+            if distance is None:
+                missing[key] = [index]
+            else:
+                distances[index] = distance
+        if not missing:
+            return distances
+
+        computed = self._geo.compute_segment_distances_in_meters(
+            quantized_lats / self._scale, quantized_lngs / self._scale,
+            np.array([indexes[0] for indexes in missing.values()]))
+        for (key, indexes), distance in zip(missing.items(),
+                                            computed.tolist()):
+            distances[indexes] = distance
+            self._add(key, distance)
+        return distances
+
+
+# The geo backends by name. Geopy and pyproj are imported when a library of
+# theirs is created, so a job only imports the backend it uses.
+GEO_BACKENDS = {
+    'geopy': GeopyLibrary,
+    'pyproj': PyprojLibrary,
+    'numpy-vincenty': partial(NumpyLibrary, 'vincenty'),
+    'numpy-haversine': partial(NumpyLibrary, 'haversine'),
+}
+
+
+def create_geo_library(backend: str):
+    """
+    Return a new library of one of the GEO_BACKENDS.
+
+    :param backend: str, name of the backend
+    """
+    try:
+        factory = GEO_BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown geo backend: %s" % backend)
+    return factory()
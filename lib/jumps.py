@@ -0,0 +1,75 @@
+from lib.geo import estimate_distance_in_meters
+
+
+class JumpWindow:
+    """
+    The waypoints of a vehicle a JumpFilter remembers: the last accepted one,
+    the speed it was reached with, unknown after a reset, and the number of
+    waypoints dropped since.
+    """
+    __slots__ = ('lat', 'lng', 'epoch', 'speed', 'dropped')
+
+    def __init__(self):
+        self.lat = self.lng = self.epoch = self.speed = None
+        self.dropped = 0
+
+
+class JumpFilter:
+    """
+    Drop GPS jumps, waypoints which are too far from the last accepted
+    waypoint of the vehicle to be reached by a car. A waypoint is a jump if
+    the speed it implies exceeds max_speed, or if the change of speed implies
+    an acceleration above max_acceleration. Distances are equirectangular
+    estimates, no geodesic is computed.
+    After max_dropped waypoints in a row the next one is accepted in any case
+    and the filter starts over from it, so a vehicle which really moved that
+    far, e.g. after GPS was lost, is not dropped for good.
+    """
+    # meters per second, 252 km/h
+    MAX_SPEED = 70.0
+    # meters per second squared, about 3 g, to tolerate the noise of fixes
+    MAX_ACCELERATION = 30.0
+    MAX_DROPPED = 3
+
+    def __init__(self, max_speed: float = MAX_SPEED,
+                 max_acceleration: float = MAX_ACCELERATION,
+                 max_dropped: int = MAX_DROPPED):
+        """
+        :param max_speed: float, meters per second
+        :param max_acceleration: float, meters per second squared
+        :param max_dropped: int, number of waypoints dropped in a row at most
+        """
+        self.max_speed = max_speed
+        self.max_acceleration = max_acceleration
+        self.max_dropped = max_dropped
+        self.dropped = 0
+
+    def accept(self, window: JumpWindow, lat: float, lng: float,
+               epoch: int) -> bool:
+        """
+        Return whether a waypoint is kept and remember it in the window of
+        its vehicle if it is. Dropped waypoints are counted.
+
+        :param window: JumpWindow of the vehicle
+        :param lat: float
+        :param lng: float
+        :param epoch: int
+        """
+        if window.epoch is not None and window.dropped < self.max_dropped:
+            seconds = max(epoch - window.epoch, 1)
+            speed = estimate_distance_in_meters(
+                window.lat, window.lng, lat, lng) / seconds
+            if speed > self.max_speed or (
+                    window.speed is not None and
+                    abs(speed - window.speed) / seconds >
+                    self.max_acceleration):
+                window.dropped += 1
+                self.dropped += 1
+                return False
+        else:
+            speed = None
+
+        window.lat, window.lng, window.epoch = lat, lng, epoch
+        window.speed = speed
+        window.dropped = 0
+        return True
@@ -0,0 +1,95 @@
+"""
+The trip extraction state machine of processor.TripExtractor over columns
+of waypoints, compiled with Numba if it is installed. Without Numba the
+processors run TripExtractor instead, extract_trips stays a plain Python
+function with the same results.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# no point of the state
+NONE = -1
+
+
+def extract_trips(epochs, lats, lngs, distances, first, state, distance,
+                  end_epoch, end_lat, end_lng, end_at_point, stop_time,
+                  min_distance):
+    """
+    Run the trip extraction over the segments ending at the waypoints after
+    first and return the index of the start and end point and the distance
+    of every trip, the state at the end and its distance.
+
+    :param epochs: int64 array of the waypoints
+    :param lats: float64 array
+    :param lngs: float64 array
+    :param distances: float64 array, the distance of every waypoint from the
+    previous one
+    :param first: int, index of the waypoint the extraction continues from
+    :param state: int64 array of the indexes of the first and last move and
+    stop point, NONE if not set, as of TripExtractor
+    :param distance: float, distance of the current trip
+    :param end_epoch: int, waypoint which ends the current trip in any case
+    :param end_lat: float
+    :param end_lng: float
+    :param end_at_point: bool, whether the end waypoint is given
+    :param stop_time: int, seconds of a stop which ends a trip
+    :param min_distance: float, meters of the shortest trip
+    """
+    size = len(epochs)
+    starts = np.empty(size, np.int64)
+    ends = np.empty(size, np.int64)
+    trip_distances = np.empty(size, np.float64)
+    move_first, move_last, stop_first, stop_last = \
+        state[0], state[1], state[2], state[3]
+    trips = 0
+
+    for index in range(first + 1, size):
+        distance += distances[index]
+        ended = False
+        if (lats[index - 1] != lats[index] or
+                lngs[index - 1] != lngs[index]):
+            if move_first == NONE:
+                move_first = index - 1
+            move_last = index
+
+        elif move_first != NONE:
+            # if car had moved before it has stopped
+            if stop_first == NONE:
+                stop_first = index - 1
+            stop_last = index
+            ended = epochs[index] - epochs[stop_first] > stop_time
+
+        if not ended and end_at_point:
+            ended = (epochs[index] == end_epoch and
+                     lats[index] == end_lat and lngs[index] == end_lng)
+
+        if ended:
+            if distance >= min_distance:
+                starts[trips] = move_first
+                ends[trips] = move_last
+                trip_distances[trips] = distance
+                trips += 1
+            move_first = move_last = stop_last
+            stop_first = stop_last = NONE
+            distance = 0.0
+
+    end_state = np.empty(4, np.int64)
+    end_state[0] = move_first
+    end_state[1] = move_last
+    end_state[2] = stop_first
+    end_state[3] = stop_last
+    return (starts[:trips], ends[:trips], trip_distances[:trips], end_state,
+            distance)
+
+
+if numba is not None:
+    KERNEL_AVAILABLE = True
+    compiled_extract_trips = numba.njit(cache=True, nogil=True)(
+        extract_trips)
+else:
+    KERNEL_AVAILABLE = False
+    compiled_extract_trips = None
@@ -0,0 +1,88 @@
+from typing import Dict
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+SECONDS_PER_DAY = 86400
+
+_days_since_epoch: Dict[str, int] = {}
+
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    """
+    Return the number of days since 1970-01-01 of a proleptic Gregorian date.
+    """
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + \
+        day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - \
+        year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """
+    Return the epoch seconds of an ISO 8601 timestamp in the fixed format
+    YYYY-MM-DDTHH:MM:SSZ, which is the format of the vehicle data.
+    The days of already seen dates are cached, because waypoints of a vehicle
+    share a few dates only.
+
+    :param timestamp: str
+    """
+    if (len(timestamp) != 20 or timestamp[10] != 'T' or
+            timestamp[19] != 'Z' or timestamp[13] != ':' or
+            timestamp[16] != ':'):
+        raise ValueError("Invalid timestamp format: %s" % timestamp)
+
+    date = timestamp[:10]
+    days = _days_since_epoch.get(date)
+    if days is None:
+        if date[4] != '-' or date[7] != '-':
+            raise ValueError("Invalid timestamp format: %s" % timestamp)
+        year, month, day = int(date[:4]), int(date[5:7]), int(date[8:])
+        if not (1 <= month <= 12 and 1 <= day <= 31):
+            raise ValueError("Invalid timestamp format: %s" % timestamp)
+        days = _days_from_civil(year, month, day)
+        _days_since_epoch[date] = days
+
+    return (days * SECONDS_PER_DAY + int(timestamp[11:13]) * 3600 +
+            int(timestamp[14:16]) * 60 + int(timestamp[17:19]))
+
+
+_dates: Dict[int, str] = {}
+
+
+def _civil_from_days(days: int) -> str:
+    """
+    Return the proleptic Gregorian date of a number of days since 1970-01-01
+    in the format YYYY-MM-DD.
+    """
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 -
+                   day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 -
+                                year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + (3 if month_index < 10 else -9)
+    year = year_of_era + era * 400 + (1 if month <= 2 else 0)
+    return "%04d-%02d-%02d" % (year, month, day)
+
+
+def format_timestamp(epoch: int) -> str:
+    """
+    Return the ISO 8601 timestamp in the format YYYY-MM-DDTHH:MM:SSZ of epoch
+    seconds, the inverse of parse_timestamp.
+
+    :param epoch: int
+    """
+    days, seconds = divmod(epoch, SECONDS_PER_DAY)
+    date = _dates.get(days)
+    if date is None:
+        date = _dates[days] = _civil_from_days(days)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return "%sT%02d:%02d:%02dZ" % (date, hours, minutes, seconds)
@@ -1,8 +1,52 @@
-from processor import WaypointListProcessor, WaypointStreamProcessor
-from utils import (load_from_json_file, convert_data_to_waypoints,
-                   trip_waypoint_format)
+from processor import (WaypointListProcessor, WaypointStreamProcessor,
+                       FleetStreamProcessor,
+                       VectorizedWaypointListProcessor,
+                       ParallelWaypointListProcessor,
+                       PartitionedWaypointListProcessor, Waypoint,
+                       WaypointBatch, group_by_device)
+from aggregation import TripAggregator
+from instrumentation import Stats, instrument
+from lib.geo import GEO_BACKENDS, CachingLibrary, create_geo_library
+from lib.jumps import JumpFilter
+from utils.formats import (WAYPOINT_FORMATS, TRIP_FORMATS, COMPRESSIONS,
+                           TripWriter, read_waypoints)
 import argparse
 import json
+import sys
+from itertools import chain, islice
+from typing import Iterable, Sequence
+
+
+def invalid_source(parser, message):
+    print("Error: %s" % message)
+    parser.print_help()
+    exit(0)
+
+
+def waypoint_list(waypoints: Iterable[Waypoint]) -> Sequence[Waypoint]:
+    """
+    Return the waypoints of --list as a WaypointBatch, which they are read
+    into one at a time, unless they carry device ids, which a batch has no
+    column for. From the first waypoint with a device id on they are kept in
+    a list grouped by device, so the waypoints of every device are processed
+    on their own, even if the devices are interleaved, e.g. by timestamp.
+
+    :param waypoints: Iterable[Waypoint]
+    """
+    iterator = iter(waypoints)
+    device_points = []
+
+    def without_device_id():
+        for waypoint in iterator:
+            if waypoint.device_id is not None:
+                device_points.append(waypoint)
+                return
+            yield waypoint
+
+    batch = WaypointBatch.from_waypoints(without_device_id())
+    if not device_points:
+        return batch
+    return group_by_device(chain(batch, device_points, iterator))
 
 
 def main():
@@ -12,32 +56,171 @@ def main():
                         help='extrace trips from a stream of Waypoints')
     parser.add_argument('--list', action='store_true',
                         help='extrace trips from a list of Waypoints')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='compute all distances of a list of Waypoints '
+                             'in one vectorized pass')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes extracting trips from a '
+                             'list of Waypoints')
+    parser.add_argument('--partition-hours', type=int,
+                        help='split a list of Waypoints into partitions of '
+                             'hours, e.g. 24 for days, processed by the '
+                             'workers and written as soon as they are done')
     parser.add_argument('--source', dest='source',
-                        help='data source file with vaild json format',
+                        help='data source file with waypoints, a JSON array, '
+                             'newline delimited JSON, CSV or binary',
                         required=True)
+    parser.add_argument('--format', choices=WAYPOINT_FORMATS,
+                        help='format of the source, detected from its '
+                             'extension or content by default')
+    parser.add_argument('--output-format', choices=TRIP_FORMATS,
+                        default='json', help='format of the trips')
+    parser.add_argument('--compression', choices=COMPRESSIONS,
+                        help='compress the trips, zstd needs the zstandard '
+                             'package')
+    parser.add_argument('--flush-interval', type=float,
+                        default=TripWriter.FLUSH_INTERVAL,
+                        help='seconds trips are buffered at most before they '
+                             'are written, 0 writes every trip at once')
+    parser.add_argument('--geo-backend', choices=sorted(GEO_BACKENDS),
+                        help='library computing the distances, geopy for '
+                             'lists and streams, numpy-vincenty for '
+                             'vectorized lists by default')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of waypoints a stream processes at once')
+    parser.add_argument('--distance-cache', metavar='FILE',
+                        help='SQLite file caching the distances of '
+                             'coordinate pairs, shared by jobs')
+    parser.add_argument('--filter-jumps', action='store_true',
+                        help='drop GPS jumps, waypoints implying a speed '
+                             'above %d km/h or an acceleration above '
+                             '%d m/s^2' % (JumpFilter.MAX_SPEED * 3.6,
+                                           JumpFilter.MAX_ACCELERATION))
+    parser.add_argument('--rollup', metavar='FILE',
+                        help='JSON file with the trips and meters of every '
+                             'vehicle per day and month')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in every stage to stderr')
     args = parser.parse_args()
 
-    data_json = load_from_json_file(args.source)
-
-    if isinstance(data_json, list):
-        waypoints = convert_data_to_waypoints(data_json)
-    else:
-        print("Error: %s" % data_json)
-        parser.print_help()
-        exit(0)
-
-    if args.list:
-        list_processor = WaypointListProcessor(waypoints)
-        trips = list_processor.get_trips()
-        print(json.dumps(trip_waypoint_format(trips)))
-    elif args.stream:
-        stream_processor = WaypointStreamProcessor()
-        trips = [stream_processor.process_waypoint(
-            waypoint) for waypoint in waypoints]
-        trips = filter(None, trips)
-        print(json.dumps(trip_waypoint_format(trips)))
-    else:
-        parser.print_help()
+    try:
+        waypoints = read_waypoints(args.source, args.format)
+    except FileNotFoundError:
+        invalid_source(parser, "There is no file: %s" % args.source)
+    except ValueError as error:
+        invalid_source(parser, str(error))
+
+    try:
+        trip_writer = TripWriter(sys.stdout, args.output_format,
+                                 args.compression, args.flush_interval)
+    except ImportError as error:
+        invalid_source(parser, "The %s compression needs the %s package" % (
+            args.compression, error.name))
+
+    geo_library = None
+    if args.geo_backend:
+        geo_library = create_geo_library(args.geo_backend)
+    if args.distance_cache:
+        try:
+            geo_library = CachingLibrary(
+                geo_library or create_geo_library(
+                    'numpy-vincenty' if args.list and args.vectorized
+                    else 'geopy'), path=args.distance_cache)
+        except ValueError as error:
+            invalid_source(parser, str(error))
+    jump_filter = JumpFilter() if args.filter_jumps else None
+    aggregator = TripAggregator() if args.rollup else None
+    stats = Stats() if args.profile else None
+    if stats and not isinstance(waypoints, WaypointBatch):
+        waypoints = stats.read(waypoints)
+
+    try:
+        if args.list:
+            if not isinstance(waypoints, WaypointBatch):
+                waypoints = waypoint_list(waypoints)
+            if args.vectorized:
+                processor_class = VectorizedWaypointListProcessor
+            else:
+                processor_class = WaypointListProcessor
+            if args.partition_hours:
+                list_processor = PartitionedWaypointListProcessor(
+                    waypoints, args.workers, processor_class, geo_library,
+                    jump_filter, args.partition_hours * 3600)
+            elif args.workers > 1 or isinstance(waypoints, list):
+                # the waypoints of every device are processed on their own,
+                # by a single worker without a pool of processes
+                list_processor = ParallelWaypointListProcessor(
+                    waypoints, args.workers, processor_class, geo_library,
+                    jump_filter)
+            else:
+                list_processor = processor_class(
+                    waypoints, geo_library=geo_library,
+                    jump_filter=jump_filter)
+            if stats:
+                instrument(list_processor, stats)
+            if args.partition_hours:
+                # trips of a partition are written once all before are done
+                trips = list_processor.iter_trips()
+            else:
+                trips = list_processor.get_trips()
+        elif args.stream:
+            first_point = None
+            if not isinstance(waypoints, WaypointBatch):
+                iterator = iter(waypoints)
+                first_point = next(iterator, None)
+                waypoints = chain(
+                    () if first_point is None else [first_point], iterator)
+            if first_point is not None and first_point.device_id is not None:
+                # every device runs through the trip extraction on its own
+                stream_processor = FleetStreamProcessor(
+                    geo_library=geo_library, jump_filter=jump_filter)
+                if stats:
+                    instrument(stream_processor, stats)
+                trips = chain.from_iterable(map(
+                    stream_processor.process_waypoint, waypoints))
+            else:
+                # waypoints are read and trips are written one batch at a time
+                stream_processor = WaypointStreamProcessor(geo_library,
+                                                           jump_filter)
+                if stats:
+                    instrument(stream_processor, stats)
+                if isinstance(waypoints, WaypointBatch):
+                    batches = WaypointBatch.iter_batches(waypoints,
+                                                         args.batch_size)
+                else:
+                    batches = iter(lambda: list(islice(
+                        waypoints, args.batch_size)), [])
+                trips = chain.from_iterable(map(
+                    stream_processor.process_batch, batches))
+        else:
+            parser.print_help()
+            return
+        if aggregator:
+            trips = aggregator.aggregate(trips)
+        for trip in stats.write(trips) if stats else trips:
+            trip_writer.write(trip)
+        trip_writer.close()
+    except json.decoder.JSONDecodeError:
+        invalid_source(
+            parser, "The file %s has invaild json format" % args.source)
+    except ValueError as error:
+        invalid_source(parser, "The file %s has invaild content: %s" % (
+            args.source, error))
+    finally:
+        if isinstance(geo_library, CachingLibrary):
+            geo_library.close()
+    if aggregator:
+        with open(args.rollup, 'w') as output:
+            json.dump(aggregator.as_dict(), output, indent=2)
+    if stats:
+        stats.print_breakdown(sys.stderr)
+        if isinstance(geo_library, CachingLibrary):
+            sys.stderr.write(
+                "distance cache: %d hits (%d from disk), %d misses, "
+                "%d evictions\n" % (
+                    geo_library.hits + geo_library.disk_hits,
+                    geo_library.disk_hits, geo_library.misses,
+                    geo_library.evictions))
 
 
 if __name__ == "__main__":
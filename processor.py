@@ -1,13 +1,22 @@
 from abc import ABCMeta, abstractmethod
-from datetime import datetime
-from typing import Union, NamedTuple, Tuple
-from lib.geo import GeoAdapter, GeopyLibrary
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import compress, groupby, islice
+from operator import attrgetter
+from typing import (Hashable, Iterable, Iterator, List, Optional, Sequence,
+                    Sized, Union, NamedTuple, Tuple)
+from lib.geo import GeoAdapter, GeopyLibrary, NumpyLibrary, PrefilterLibrary
+from lib.jumps import JumpFilter, JumpWindow
+from lib.timestamp import format_timestamp, parse_timestamp
 
 
 class Waypoint(NamedTuple):
-    timestamp: datetime
+    timestamp: str
     lat: float
     lng: float
+    epoch: Optional[int] = None
+    device_id: Optional[Hashable] = None
 
 
 class Trip(NamedTuple):
@@ -16,6 +25,361 @@ class Trip(NamedTuple):
     end: Waypoint
 
 
+class WaypointBatch(Sequence):
+    """
+    Columnar storage of waypoints, which keeps the epoch seconds as int64 and
+    the coordinates as float64, 24 bytes per waypoint. The columns are any
+    buffers of these types, e.g. arrays or NumPy arrays.
+    Indexing returns a Waypoint view, whose timestamp is formatted from the
+    epoch, and slicing returns a WaypointBatch sharing the columns.
+    """
+    __slots__ = ('epochs', 'lats', 'lngs')
+
+    def __init__(self, epochs=(), lats=(), lngs=()):
+        self.epochs = self._column(epochs, 'q')
+        self.lats = self._column(lats, 'd')
+        self.lngs = self._column(lngs, 'd')
+        if not len(self.epochs) == len(self.lats) == len(self.lngs):
+            raise ValueError("The columns have different lengths")
+
+    @staticmethod
+    def _column(values, typecode: str) -> memoryview:
+        try:
+            column = memoryview(values)
+        except TypeError:
+            column = memoryview(array(typecode, values))
+        if column.format != typecode:
+            # NumPy int64 columns use the format of a long on most platforms
+            column = column.cast('B').cast(typecode)
+        return column
+
+    @classmethod
+    def from_waypoints(cls, waypoints: Iterable[Waypoint]) -> 'WaypointBatch':
+        """
+        Build the columns of the waypoints, which are consumed one at a time.
+
+        :param waypoints: Iterable[Waypoint]
+        """
+        epochs, lats, lngs = array('q'), array('d'), array('d')
+        for waypoint in waypoints:
+            epochs.append(waypoint_epoch(waypoint))
+            lats.append(waypoint.lat)
+            lngs.append(waypoint.lng)
+        return cls(epochs, lats, lngs)
+
+    @classmethod
+    def iter_batches(cls, waypoints: Iterable[Waypoint],
+                     size: int) -> Iterator['WaypointBatch']:
+        """
+        Yield batches of up to size waypoints, slices of a WaypointBatch or
+        built from the waypoints, which are consumed one batch at a time.
+
+        :param waypoints: Iterable[Waypoint] or WaypointBatch
+        :param size: int
+        """
+        if isinstance(waypoints, WaypointBatch):
+            for start in range(0, len(waypoints), size):
+                yield waypoints[start:start + size]
+            return
+        iterator = iter(waypoints)
+        while True:
+            batch = cls.from_waypoints(islice(iterator, size))
+            if not len(batch):
+                return
+            yield batch
+
+    @property
+    def nbytes(self) -> int:
+        return self.epochs.nbytes + self.lats.nbytes + self.lngs.nbytes
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return WaypointBatch(self.epochs[index], self.lats[index],
+                                 self.lngs[index])
+        epoch = self.epochs[index]
+        return Waypoint(format_timestamp(epoch), self.lats[index],
+                        self.lngs[index], epoch)
+
+    def __iter__(self) -> Iterator[Waypoint]:
+        for epoch, lat, lng in zip(self.epochs, self.lats, self.lngs):
+            yield Waypoint(format_timestamp(epoch), lat, lng, epoch)
+
+    def __reduce__(self):
+        # memoryviews can not be pickled, the columns are copied into arrays
+        return (WaypointBatch, tuple(
+            array(column.format, column.tobytes())
+            for column in (self.epochs, self.lats, self.lngs)))
+
+
+def waypoint_epoch(waypoint: Waypoint) -> int:
+    """
+    Return the epoch seconds of a waypoint. Waypoints created by the ingestion
+    carry them already, others get their timestamp parsed.
+    """
+    if waypoint.epoch is None:
+        return parse_timestamp(waypoint.timestamp)
+    return waypoint.epoch
+
+
+def group_by_device(waypoints: Iterable[Waypoint]) -> List[Waypoint]:
+    """
+    Return the waypoints grouped by device, the devices in the order of their
+    first waypoint and the waypoints of every device in their own order,
+    e.g. of a fleet ordered by timestamp.
+
+    :param waypoints: Iterable[Waypoint]
+    """
+    devices = OrderedDict()
+    for waypoint in waypoints:
+        device_points = devices.get(waypoint.device_id)
+        if device_points is None:
+            device_points = devices[waypoint.device_id] = []
+        device_points.append(waypoint)
+    if len(devices) == 1:
+        return device_points
+    return [waypoint for device_points in devices.values()
+            for waypoint in device_points]
+
+
+class TripExtractor:
+    """
+    State machine of the trip extraction, which the list and stream
+    processors drive one segment between two consecutive waypoints at a
+    time. A trip spans the waypoints the car moved between and ends once the
+    car stood still for longer than STOP_TIME_IN_SECONDS. Trips shorter than
+    DISTANCE_SHOULD_BE_IGNORED_METERS are dropped.
+    Only the first and last waypoint of the current moves and stops are kept,
+    the trips depend on nothing else.
+    """
+    __slots__ = ('move_first', 'move_last', 'stop_first', 'stop_last',
+                 'distance')
+    STOP_TIME_IN_SECONDS = 3 * 60
+    DISTANCE_SHOULD_BE_IGNORED_METERS = 15
+
+    def __init__(self, state: tuple = None):
+        """
+        :param state: tuple, as returned by the state property, to continue
+        from, a new trip extraction by default
+        """
+        if state is None:
+            self.move_first = self.move_last = None
+            self.stop_first = self.stop_last = None
+            self.distance = 0.0
+        else:
+            (self.move_first, self.move_last, self.stop_first,
+             self.stop_last, self.distance) = state
+
+    @property
+    def state(self) -> tuple:
+        return (self.move_first, self.move_last, self.stop_first,
+                self.stop_last, self.distance)
+
+    def process_segment(self, current_point: Waypoint, next_point: Waypoint,
+                        distance: float, end: bool = False
+                        ) -> Union[Trip, None]:
+        """
+        Process the segment between two consecutive waypoints and return the
+        trip it completes, if any.
+
+        :param current_point: Waypoint
+        :param next_point: Waypoint
+        :param distance: float, distance between the waypoints in meters
+        :param end: bool, whether the next point ends the current trip in any
+        case, like the last waypoint of a list
+        """
+        self.distance += distance
+        if (current_point.lat != next_point.lat or
+                current_point.lng != next_point.lng):
+            if self.move_first is None:
+                self.move_first = current_point
+            self.move_last = next_point
+
+        elif self.move_first is not None:
+            # if car had moved before it has stopped
+            if self.stop_first is None:
+                self.stop_first = current_point
+            self.stop_last = next_point
+            if (waypoint_epoch(next_point) -
+                    waypoint_epoch(self.stop_first) >
+                    self.STOP_TIME_IN_SECONDS):
+                return self.end_trip()
+
+        if end:
+            return self.end_trip()
+        return None
+
+    def end_trip(self) -> Union[Trip, None]:
+        """
+        End the current trip, return it unless it is too short and start the
+        next trip from the last stop point.
+        """
+        trip = None
+        if self.distance >= self.DISTANCE_SHOULD_BE_IGNORED_METERS:
+            trip = Trip(round(self.distance, 3), self.move_first,
+                        self.move_last)
+        self.move_first = self.move_last = self.stop_last
+        self.stop_first = self.stop_last = None
+        self.distance = 0.0
+        return trip
+
+
+class DeviceState(TripExtractor):
+    """
+    State of the trip extraction of the waypoint stream of one device: the
+    TripExtractor, the previous waypoint, the epoch it was seen last and the
+    window of the jump filter, if any.
+    """
+    __slots__ = ('previous_point', 'last_seen', 'jump_window')
+
+    def __init__(self, state: tuple = None):
+        super().__init__(state)
+        self.previous_point = None
+        self.last_seen = None
+        self.jump_window = None
+
+
+def _with_thresholds(extractor_class, stop_time: float,
+                     min_distance: float):
+    """
+    Return a subclass of a TripExtractor class with the stop time in seconds
+    and the minimum distance of a trip of a processor, or the class itself
+    if they are its own.
+    """
+    if (extractor_class.STOP_TIME_IN_SECONDS == stop_time and
+            extractor_class.DISTANCE_SHOULD_BE_IGNORED_METERS ==
+            min_distance):
+        return extractor_class
+    return type(extractor_class.__name__, (extractor_class,), {
+        '__slots__': (), 'STOP_TIME_IN_SECONDS': stop_time,
+        'DISTANCE_SHOULD_BE_IGNORED_METERS': min_distance})
+
+
+def _car_in_move(extractor_class, current_point: Waypoint,
+                 next_point: Waypoint) -> bool:
+    # the trip extraction starts a move at the first segment the car moved
+    extractor = extractor_class()
+    extractor.process_segment(current_point, next_point, 0.0)
+    return extractor.move_first is not None
+
+
+def _car_trip_has_ended(extractor_class, stop_points: List[Waypoint]) -> bool:
+    if len(stop_points) < 2:
+        return False
+
+    # the car moved up to the first stop point and stood still since
+    first_point = stop_points[0]
+    extractor = extractor_class((first_point, first_point, None, None, 0.0))
+    extractor.process_segment(first_point, stop_points[-1]._replace(
+        lat=first_point.lat, lng=first_point.lng), 0.0)
+    return extractor.stop_first is None
+
+
+def _drop_batch_jumps(jump_filter: JumpFilter, batch: WaypointBatch,
+                      window: JumpWindow) -> WaypointBatch:
+    accept = jump_filter.accept
+    kept = [accept(window, lat, lng, epoch) for epoch, lat, lng in
+            zip(batch.epochs, batch.lats, batch.lngs)]
+    return WaypointBatch(array('q', compress(batch.epochs, kept)),
+                         array('d', compress(batch.lats, kept)),
+                         array('d', compress(batch.lngs, kept)))
+
+
+def _kernel(extractor_class=TripExtractor):
+    """
+    Return lib.kernel if Numba is installed, which is imported on first use,
+    and it extracts the trips of the extractor class, which must not change
+    the methods of TripExtractor but its thresholds.
+    """
+    if (extractor_class.process_segment is not TripExtractor.process_segment
+            or extractor_class.end_trip is not TripExtractor.end_trip):
+        return None
+    from lib import kernel
+    return kernel if kernel.KERNEL_AVAILABLE else None
+
+
+def _extract_kernel_trips(head: List[Waypoint], batch: WaypointBatch,
+                          state: tuple, distances: Iterable[float],
+                          last_point: Waypoint = None,
+                          extractor_class=TripExtractor,
+                          points: Sequence[Waypoint] = None
+                          ) -> Tuple[List[Trip], tuple]:
+    """
+    Run the compiled kernel of lib.kernel over the columns of a WaypointBatch
+    and return the trips and the state at the end, like
+    WaypointListProcessor._extract_trips. The points of the state and the
+    head are put in front of the columns, so the extraction continues from
+    any state.
+
+    :param head: List[Waypoint], the previous waypoint of a stream, which
+    the extraction continues from, or none to start at the batch
+    :param batch: WaypointBatch
+    :param state: tuple of the points and the distance of a TripExtractor
+    :param distances: Iterable[float], the distances of the segments from
+    the previous waypoint or the first one of the batch on
+    :param last_point: Waypoint, which ends the last trip, none for a stream
+    :param extractor_class: TripExtractor class, whose thresholds are used
+    :param points: Sequence[Waypoint], the waypoints of the batch the trips
+    are built of, e.g. with their device ids, the views of the batch by
+    default
+    """
+    import numpy as np
+    kernel = _kernel()
+
+    prefix = []
+    indexes = np.full(4, kernel.NONE, np.int64)
+    for position, point in enumerate(state[:4]):
+        if point is not None:
+            indexes[position] = len(prefix)
+            prefix.append(point)
+    prefix.extend(head)
+    first = len(prefix) - 1 if head else len(prefix)
+
+    epochs = np.asarray(batch.epochs)
+    lats = np.asarray(batch.lats)
+    lngs = np.asarray(batch.lngs)
+    if prefix:
+        epochs = np.concatenate((np.array(
+            [waypoint_epoch(point) for point in prefix], np.int64), epochs))
+        lats = np.concatenate(([point.lat for point in prefix], lats))
+        lngs = np.concatenate(([point.lng for point in prefix], lngs))
+    segment_distances = np.zeros(len(epochs))
+    if isinstance(distances, Iterator):
+        distances = np.fromiter(distances, np.float64,
+                                len(epochs) - first - 1)
+    segment_distances[first + 1:] = distances
+
+    end_at_point = (last_point is not None and last_point.epoch is not None
+                    and last_point.device_id is None)
+    starts, ends, trip_distances, end_state, distance = \
+        kernel.compiled_extract_trips(
+            epochs, lats, lngs, segment_distances, first, indexes,
+            float(state[4]),
+            waypoint_epoch(last_point) if end_at_point else 0,
+            float(last_point.lat) if end_at_point else 0.0,
+            float(last_point.lng) if end_at_point else 0.0, end_at_point,
+            extractor_class.STOP_TIME_IN_SECONDS,
+            extractor_class.DISTANCE_SHOULD_BE_IGNORED_METERS)
+
+    if points is None:
+        points = batch
+
+    def point(index):
+        index = int(index)
+        if index == kernel.NONE:
+            return None
+        if index < len(prefix):
+            return prefix[index]
+        return points[index - len(prefix)]
+
+    trips = [Trip(round(float(trip_distance), 3), point(start), point(end))
+             for start, end, trip_distance in zip(starts, ends,
+                                                  trip_distances)]
+    return trips, tuple(map(point, end_state)) + (float(distance),)
+
+
 class ListProcessor(metaclass=ABCMeta):
     def __init__(self, waypoints: Tuple[Waypoint]):
         """
@@ -24,7 +388,7 @@ class ListProcessor(metaclass=ABCMeta):
         to the whole list of waypoints at all time during the trip extraction
         process.
 
-        :param waypoints: Tuple[Waypoint]
+        :param waypoints: Tuple[Waypoint] or WaypointBatch
         """
         self._waypoints = waypoints
 
@@ -51,142 +415,622 @@ class StreamProcessor(metaclass=ABCMeta):
         """
         ...
 
+    def process_batch(self, waypoints: Iterable[Waypoint]) -> List[Trip]:
+        """
+        Process the next waypoints of the stream and return the trips
+        completed by them.
+
+        :param waypoints: Iterable[Waypoint] or WaypointBatch
+        """
+        return [trip for trip in map(self.process_waypoint, waypoints)
+                if trip is not None]
+
 
 class WaypointStreamProcessor(StreamProcessor):
     STOP_TIME_IN_MINTUES = 3
     DISTANCE_SHOULD_BE_IGNORED_METERS = 15
+    # smaller batches are processed one waypoint at a time, which is faster
+    MIN_BATCH_SIZE = 100
+    # class of the state, replaced to instrument the trip extraction
+    state_class = DeviceState
 
-    def __init__(self):
-        self._geo = GeoAdapter(GeopyLibrary())
-        self.stop_points = []
-        self.move_points = []
-        self.current_point = None
-        self.next_point = None
-        self.distance = 0.0
+    def __init__(self, geo_library=None, jump_filter: JumpFilter = None):
+        """
+        :param geo_library: library computing the distances, GeopyLibrary
+        by default
+        :param jump_filter: JumpFilter dropping GPS jumps, none by default
+        """
+        self.prefilter = PrefilterLibrary(
+            geo_library or GeopyLibrary(),
+            self.DISTANCE_SHOULD_BE_IGNORED_METERS)
+        self._geo = GeoAdapter(self.prefilter)
+        self.jump_filter = jump_filter
+        # the states extract the trips by the thresholds of the processor
+        self.state_class = _with_thresholds(
+            self.state_class, self.STOP_TIME_IN_MINTUES * 60,
+            self.DISTANCE_SHOULD_BE_IGNORED_METERS)
+        self.state = self.state_class()
         self.trip = None
 
+    def process_waypoint(self, waypoint: Waypoint) -> Union[Trip, None]:
+        self.trip = self._process(self.state, waypoint)
+        return self.trip
+
     def _car_in_move(self,
                      current_point: Waypoint, next_point: Waypoint) -> bool:
-        return (current_point.lat != next_point.lat or
-                current_point.lng != next_point.lng)
+        return _car_in_move(self.state_class, current_point, next_point)
 
-    def _car_trip_has_ended(self, stop_points: Waypoint) -> bool:
-        if len(stop_points) < 2:
-            return False
+    def _car_trip_has_ended(self, stop_points: List[Waypoint]) -> bool:
+        return _car_trip_has_ended(self.state_class, stop_points)
 
-        time_difference = datetime.strptime(
-            stop_points[-1].timestamp, "%Y-%m-%dT%H:%M:%SZ") - \
-            datetime.strptime(
-            stop_points[0].timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        return time_difference.total_seconds()/60 > self.STOP_TIME_IN_MINTUES
+    def process_batch(self, waypoints: Iterable[Waypoint]) -> List[Trip]:
+        """
+        Process the next waypoints of the stream at once and return the trips
+        completed by them, the same ones process_waypoint returns for each
+        of them. The distances are computed in one call of the library, best
+        one with a batch interface, and the trips are extracted by the
+        compiled kernel of lib.kernel if Numba is installed.
 
-    def process_waypoint(self, waypoint: Waypoint) -> Union[Trip, None]:
-        self.trip = None
+        :param waypoints: WaypointBatch or Iterable[Waypoint], whose columns
+        are built, the trips are of the waypoints with their device ids
+        """
+        if not isinstance(waypoints, Sized):
+            waypoints = list(waypoints)
+        if len(waypoints) < self.MIN_BATCH_SIZE:
+            return super().process_batch(waypoints)
+        state = self.state
+        if self.jump_filter is not None:
+            if state.jump_window is None:
+                state.jump_window = JumpWindow()
+            if isinstance(waypoints, WaypointBatch):
+                waypoints = _drop_batch_jumps(self.jump_filter, waypoints,
+                                              state.jump_window)
+            else:
+                accept = self.jump_filter.accept
+                window = state.jump_window
+                waypoints = [waypoint for waypoint in waypoints if accept(
+                    window, waypoint.lat, waypoint.lng,
+                    waypoint_epoch(waypoint))]
+        if not len(waypoints):
+            return []
+        points = waypoints
+        if not isinstance(waypoints, WaypointBatch):
+            waypoints = WaypointBatch.from_waypoints(points)
+
+        import numpy as np
+        previous_point = state.previous_point
+        head = [] if previous_point is None else [previous_point]
+        lats, lngs = waypoints.lats, waypoints.lngs
+        if head:
+            lats = np.concatenate(([previous_point.lat], lats))
+            lngs = np.concatenate(([previous_point.lng], lngs))
+        distances = self._geo.compute_distances_in_meters(lats, lngs)
 
-        if not any([self.current_point, self.next_point]):
-            self.next_point = waypoint
-            self.current_point = waypoint
+        if _kernel(type(state)) is not None:
+            trips, extractor_state = _extract_kernel_trips(
+                head, waypoints, state.state, distances,
+                extractor_class=type(state), points=points)
+            (state.move_first, state.move_last, state.stop_first,
+             state.stop_last, state.distance) = extractor_state
         else:
-            self.current_point = self.next_point
-            self.next_point = waypoint
+            trips = []
+            process_segment = state.process_segment
+            current_point = previous_point if head else points[0]
+            for next_point, distance in zip(
+                    points if head else islice(points, 1, None),
+                    distances.tolist()):
+                trip = process_segment(current_point, next_point, distance)
+                if trip is not None:
+                    trips.append(trip)
+                current_point = next_point
+        state.previous_point = points[-1]
+        return trips
 
-        self.distance += self._geo.compute_distance_in_meters(
-            self.current_point, self.next_point)
+    def _process(self, state: DeviceState,
+                 waypoint: Waypoint) -> Union[Trip, None]:
+        if self.jump_filter is not None:
+            if state.jump_window is None:
+                state.jump_window = JumpWindow()
+            if not self.jump_filter.accept(state.jump_window, waypoint.lat,
+                                           waypoint.lng,
+                                           waypoint_epoch(waypoint)):
+                return None
+        previous_point = state.previous_point
+        state.previous_point = waypoint
+        if previous_point is None:
+            return None
+        return state.process_segment(
+            previous_point, waypoint,
+            self._geo.compute_distance_in_meters(previous_point, waypoint))
 
-        if self._car_in_move(self.current_point, self.next_point):
-            # only keep the last two point
-            self.move_points = self.move_points[:2]
-            self.move_points.extend([self.current_point, self.next_point])
+    def flush(self) -> Union[Trip, None]:
+        """
+        Return the open trip at the end of the stream, which the list
+        processor ends at the last waypoint, and start a new stream.
+        """
+        trip = self.state.end_trip()
+        self.state = self.state_class()
+        return trip
 
-        elif len(self.move_points) != 0:
-            # if car had moved before it has stopped
-            self.stop_points = self.stop_points[:2]
-            self.stop_points.extend([self.current_point, self.next_point])
-
-        if self._car_trip_has_ended(self.stop_points):
-            # only add a trip with total distance >= 15 meters
-            # the start and end point should not be the same
-            if (self.distance >= self.DISTANCE_SHOULD_BE_IGNORED_METERS):
-                start_point = self.move_points[0]
-                end_point = self.move_points[-1]
-                self.trip = Trip(
-                    round(self.distance, 3), start_point, end_point)
-
-            # Starting next trip
-            # The last stop point should be the begining of the next trip
-            self.move_points = self.stop_points[-1:]
-            self.stop_points = []
-            self.distance = 0.0
-        return self.trip
+
+class FleetStreamProcessor:
+    """
+    Stream processor for interleaved waypoints of many devices. Waypoints are
+    routed by their device_id to the state of their device, which is run
+    through the trip extraction of WaypointStreamProcessor.
+    Devices which did not send a waypoint for longer than the idle timeout
+    are evicted and their open trip is closed. When max_devices is given,
+    the least recently seen device is evicted to stay within the limit.
+    """
+    IDLE_TIMEOUT_IN_MINUTES = 60
+
+    def __init__(self, idle_timeout_in_minutes: float = None,
+                 max_devices: int = None, geo_library=None,
+                 jump_filter: JumpFilter = None):
+        if idle_timeout_in_minutes is None:
+            idle_timeout_in_minutes = self.IDLE_TIMEOUT_IN_MINUTES
+        self._idle_timeout = idle_timeout_in_minutes * 60
+        self._max_devices = max_devices
+        self._processor = WaypointStreamProcessor(geo_library, jump_filter)
+        self.prefilter = self._processor.prefilter
+        self.jump_filter = jump_filter
+        # devices ordered by the time they were seen last
+        self._devices = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def device_states(self) -> Iterator[Tuple[Hashable, DeviceState]]:
+        """
+        Return the devices and their states, the least recently seen first.
+        """
+        return iter(self._devices.items())
+
+    def get_device_state(self, device_id: Hashable) -> Optional[DeviceState]:
+        return self._devices.get(device_id)
+
+    def set_device_state(self, device_id: Hashable, state: DeviceState):
+        """
+        Set the state of a device, which becomes the most recently seen one.
+        """
+        self._devices.pop(device_id, None)
+        self._devices[device_id] = state
+
+    def process_waypoint(self, waypoint: Waypoint) -> List[Trip]:
+        """
+        Process a waypoint of any device and return the trips completed by
+        it, together with the trips closed by evicted devices.
+
+        :param waypoint: Waypoint
+        """
+        epoch = waypoint_epoch(waypoint)
+        state = self._devices.get(waypoint.device_id)
+        if state is None:
+            state = self._devices[
+                waypoint.device_id] = self._processor.state_class()
+        else:
+            self._devices.move_to_end(waypoint.device_id)
+
+        trip = self._processor._process(state, waypoint)
+        state.last_seen = epoch
+
+        trips = self.evict_idle_devices(epoch)
+        if trip is not None:
+            trips.append(trip)
+        return trips
+
+    def evict_idle_devices(self, epoch: int) -> List[Trip]:
+        """
+        Evict the devices which were idle for longer than the timeout at the
+        given epoch, or which exceed max_devices, and return their open trips.
+
+        :param epoch: int
+        """
+        trips = []
+        while self._devices:
+            device_id, state = next(iter(self._devices.items()))
+            if (epoch - state.last_seen <= self._idle_timeout and
+                    (self._max_devices is None or
+                     len(self._devices) <= self._max_devices)):
+                break
+            del self._devices[device_id]
+            trip = state.end_trip()
+            if trip is not None:
+                trips.append(trip)
+        return trips
+
+    def flush(self) -> List[Trip]:
+        """
+        Evict all devices and return their open trips.
+        """
+        trips = [state.end_trip() for state in self._devices.values()]
+        self._devices.clear()
+        return [trip for trip in trips if trip is not None]
 
 
 class WaypointListProcessor(ListProcessor):
     STOP_TIME_IN_MINTUES = 3
     DISTANCE_SHOULD_BE_IGNORED_METERS = 15
+    # replaced to instrument the trip extraction
+    extractor_class = TripExtractor
+    # extract the trips of a WaypointBatch by the compiled lib.kernel
+    use_kernel = True
 
-    def __init__(self, waypoints):
-        self._geo = GeoAdapter(GeopyLibrary())
+    def __init__(self, waypoints, geo_library=None,
+                 jump_filter: JumpFilter = None):
+        """
+        :param waypoints: Tuple[Waypoint] or WaypointBatch
+        :param geo_library: library computing the distances, GeopyLibrary
+        by default
+        :param jump_filter: JumpFilter dropping GPS jumps from the waypoints
+        up front, none by default
+        """
+        self.prefilter = PrefilterLibrary(
+            geo_library or GeopyLibrary(),
+            self.DISTANCE_SHOULD_BE_IGNORED_METERS)
+        self._geo = GeoAdapter(self.prefilter)
+        self.jump_filter = jump_filter
+        # the trips are extracted by the thresholds of the processor
+        self.extractor_class = _with_thresholds(
+            self.extractor_class, self.STOP_TIME_IN_MINTUES * 60,
+            self.DISTANCE_SHOULD_BE_IGNORED_METERS)
+        if jump_filter is not None:
+            waypoints = self._drop_jumps(waypoints)
         super().__init__(waypoints)
 
     def _car_in_move(self,
                      current_point: Waypoint, next_point: Waypoint) -> bool:
-        return (current_point.lat != next_point.lat or
-                current_point.lng != next_point.lng)
+        return _car_in_move(self.extractor_class, current_point, next_point)
+
+    def _car_trip_has_ended(self, stop_points: List[Waypoint]) -> bool:
+        return _car_trip_has_ended(self.extractor_class, stop_points)
 
-    def _last_value_in_list(self,
-                            next_point: Waypoint,
-                            last_point: Waypoint) -> bool:
-        return next_point == last_point
+    def _drop_jumps(self, waypoints):
+        if isinstance(waypoints, WaypointBatch):
+            return _drop_batch_jumps(self.jump_filter, waypoints,
+                                     JumpWindow())
 
-    def _car_trip_has_ended(self, stop_points: Waypoint) -> bool:
-        if len(stop_points) < 2:
-            return False
+        accept = self.jump_filter.accept
+        windows = {}
+        kept = []
+        for waypoint in waypoints:
+            window = windows.get(waypoint.device_id)
+            if window is None:
+                window = windows[waypoint.device_id] = JumpWindow()
+            if accept(window, waypoint.lat, waypoint.lng,
+                      waypoint_epoch(waypoint)):
+                kept.append(waypoint)
+        return kept
 
-        time_difference = datetime.strptime(
-            stop_points[-1].timestamp, "%Y-%m-%dT%H:%M:%SZ") - \
-            datetime.strptime(
-            stop_points[0].timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        return time_difference.total_seconds()/60 > self.STOP_TIME_IN_MINTUES
+    def _segment_distances(self) -> Iterable[float]:
+        return (self._geo.compute_distance_in_meters(current_point, next_point)
+                for current_point, next_point in zip(
+                    self._waypoints, islice(self._waypoints, 1, None)))
 
     def get_trips(self) -> Tuple[Trip]:
+        trips, _ = self._extract_trips(self._waypoints[-1])
+        return trips
+
+    def _extract_trips(self, last_point: Waypoint, state: tuple = None,
+                       distances: Iterable[float] = None
+                       ) -> Tuple[List[Trip], tuple]:
+        """
+        Extract the trips of the waypoints and return them, together with the
+        state at the end: the move points, the stop points and the distance
+        since the last trip ended. The extraction continues from the given
+        state or starts over.
+
+        :param last_point: Waypoint, which ends the last trip
+        :param state: tuple
+        :param distances: Iterable[float], the segment distances if they were
+        computed before
+        """
+        if distances is None:
+            distances = self._segment_distances()
+        if (self.use_kernel and isinstance(self._waypoints, WaypointBatch)
+                and _kernel(self.extractor_class) is not None):
+            return _extract_kernel_trips(
+                [], self._waypoints, state or TripExtractor().state,
+                distances, last_point, self.extractor_class)
+
         trips = []
-        stop_points = []
-        move_points = []
-        distance = 0
+        extractor = self.extractor_class(state)
+        process_segment = extractor.process_segment
         current_point = self._waypoints[0]
-        last_point = self._waypoints[-1]
-
-        for next_point in self._waypoints[1:]:
-            distance += self._geo.compute_distance_in_meters(
-                current_point, next_point)
-
-            if self._car_in_move(current_point, next_point):
-                # only keep the last two point
-                move_points = move_points[:2]
-                move_points.extend([current_point, next_point])
-
-            elif len(move_points) != 0:
-                # if car had moved before it has stopped
-                stop_points = stop_points[:2]
-                stop_points.extend([current_point, next_point])
-
-            if (self._car_trip_has_ended(stop_points) or
-                    self._last_value_in_list(next_point, last_point)):
-
-                # only add a trip with total distance >= 15 meters
-                # the start and end point should not be the same
-                if (distance >= self.DISTANCE_SHOULD_BE_IGNORED_METERS):
-                    start_point = move_points[0]
-                    end_point = move_points[-1]
-                    trips.append(Trip(
-                        round(distance, 3), start_point, end_point))
-
-                # Starting next trip
-                # The last stop point should be the begining of the next trip
-                move_points = stop_points[-1:]
-                stop_points = []
-                distance = 0
-
+        for next_point, segment_distance in zip(
+                islice(self._waypoints, 1, None), distances):
+            trip = process_segment(current_point, next_point,
+                                   segment_distance, next_point == last_point)
+            if trip is not None:
+                trips.append(trip)
             current_point = next_point
 
-        return trips
+        return trips, extractor.state
+
+
+class VectorizedWaypointListProcessor(WaypointListProcessor):
+    """
+    List processor, which computes the distances of all segments up front in
+    one NumPy pass and then runs the trip extraction over them.
+    The distances match WaypointListProcessor within the tolerance of
+    NumpyLibrary.
+    """
+
+    def __init__(self, waypoints, formula: str = 'vincenty',
+                 geo_library=None, jump_filter: JumpFilter = None):
+        """
+        :param waypoints: Tuple[Waypoint] or WaypointBatch
+        :param formula: str, formula of the NumpyLibrary
+        :param geo_library: library computing the distances instead of
+        NumpyLibrary, best one with a batch interface like PyprojLibrary
+        :param jump_filter: JumpFilter dropping GPS jumps, none by default
+        """
+        super().__init__(waypoints, geo_library or NumpyLibrary(formula),
+                         jump_filter)
+
+    def _segment_distances(self) -> Iterable[float]:
+        if isinstance(self._waypoints, WaypointBatch):
+            lats, lngs = self._waypoints.lats, self._waypoints.lngs
+        else:
+            lats = [point.lat for point in self._waypoints]
+            lngs = [point.lng for point in self._waypoints]
+        return self._geo.compute_distances_in_meters(lats, lngs).tolist()
+
+
+def _extract_chunk_trips(task) -> Tuple[List[Trip], tuple, List[float],
+                                        PrefilterLibrary, object]:
+    processor_class, geo_library, waypoints, last_point, state, \
+        instrument = task
+    processor = processor_class(waypoints, geo_library=geo_library)
+    stats = None if instrument is None else instrument(processor)
+    distances = list(processor._segment_distances())
+    trips = None
+    if state is not None:
+        trips, state = processor._extract_trips(last_point, state, distances)
+    if hasattr(geo_library, 'flush'):
+        # a CachingLibrary of a process of the pool writes what it computed
+        geo_library.flush()
+    return trips, state, distances, processor.prefilter, stats
+
+
+class ParallelWaypointListProcessor(WaypointListProcessor):
+    """
+    List processor, which extracts the trips of chunks of the waypoints on a
+    pool of processes. Chunks are cut at safe points, wherever possible:
+    - the end of a trip, where the car stood still for longer than
+      STOP_TIME_IN_MINTUES, so the next chunk starts over from the stop
+      point the trip ended at; the ends are found on the epochs and
+      coordinates up front,
+    - a change of the device_id, the waypoints are grouped by device up
+      front and a trip never spans two devices.
+    Chunks which have to be cut elsewhere, or which turn out to start from
+    another state, only get their distances computed by the pool and their
+    trips extracted afterwards. The trips are exactly the ones of a serial
+    run of processor_class over the waypoints of each device.
+    """
+    CHUNKS_PER_WORKER = 4
+    MIN_CHUNK_SIZE = 10000
+    SAFE_CUT_SEARCH_RATIO = 0.25
+    # instruments the processors of the chunks and returns their stats,
+    # which are added to _stats, set by instrumentation.instrument
+    _instrument = None
+    _stats = None
+
+    def __init__(self, waypoints, workers: int = None,
+                 processor_class=WaypointListProcessor, geo_library=None,
+                 jump_filter: JumpFilter = None):
+        if not isinstance(waypoints, WaypointBatch):
+            # the waypoints of a device may be interleaved with others
+            waypoints = group_by_device(waypoints)
+        # the jumps are dropped before the waypoints are split into chunks
+        super().__init__(waypoints, geo_library, jump_filter)
+        self._workers = workers
+        self._processor_class = processor_class
+        self._geo_library = geo_library
+
+    def _columns(self, start: int, end: int) -> tuple:
+        """
+        Return the epochs, lats and lngs of the waypoints from start to end
+        as NumPy arrays, views of the columns of a WaypointBatch.
+        """
+        import numpy as np
+        if isinstance(self._waypoints, WaypointBatch):
+            return (np.asarray(self._waypoints.epochs[start:end]),
+                    np.asarray(self._waypoints.lats[start:end]),
+                    np.asarray(self._waypoints.lngs[start:end]))
+        points = self._waypoints[start:end]
+        return (np.fromiter(map(waypoint_epoch, points), np.int64,
+                            len(points)),
+                np.fromiter((point.lat for point in points), np.float64,
+                            len(points)),
+                np.fromiter((point.lng for point in points), np.float64,
+                            len(points)))
+
+    def _safe_cuts(self, epochs, lats, lngs) -> List[int]:
+        """
+        Return the indexes of the waypoints of a device at which the trip
+        extraction ends a trip, in order. The trip extraction sets the first
+        stop point at the first stop after the car moved or a trip ended and
+        ends the trip at the first stop point longer than the stop time
+        after it, so the ends depend on the epochs and coordinates only and
+        are found by NumPy, except for the walk from one end to the next.
+        """
+        import numpy as np
+        size = len(epochs)
+        stopped = (lats[1:] == lats[:-1]) & (lngs[1:] == lngs[:-1])
+        moved = np.flatnonzero(~stopped)
+        if not len(moved):
+            return []
+        # the first stop segment from every segment on, size - 1 if none
+        next_stop = np.minimum.accumulate(np.append(
+            np.where(stopped, np.arange(size - 1), size - 1),
+            size - 1)[::-1])[::-1]
+        stop_ends = np.searchsorted(
+            epochs, epochs[next_stop] +
+            self._processor_class.STOP_TIME_IN_MINTUES * 60, side='right')
+        # the end of the trip after every waypoint, size if there is none
+        trip_ends = next_stop[np.maximum(stop_ends, next_stop + 1) - 1] + 1
+        trip_ends[next_stop == size - 1] = size
+        trip_ends = trip_ends.tolist()
+
+        cuts = []
+        cut = trip_ends[moved[0] + 1]
+        while cut < size - 1:
+            cuts.append(cut)
+            cut = trip_ends[cut]
+        return cuts
+
+    def _safe_cut(self, cuts: List[int], cut: int,
+                  search_end: int) -> Tuple[int, tuple]:
+        """
+        Return the first safe cut from cut on before search_end and the state
+        the next chunk starts from, or cut and None if there is none.
+        """
+        index = bisect_left(cuts, cut)
+        if index < len(cuts) and cuts[index] < search_end:
+            # the trip ended at the cut, the next one starts from there
+            point = self._waypoints[cuts[index]]
+            return cuts[index], (point, point, None, None, 0.0)
+        return cut, None
+
+    def _split(self) -> List[Tuple[int, int, int, tuple]]:
+        """
+        Return the chunks as start and end index, the index of the last point
+        of their device and the state they start from, which is None if it is
+        not known before the previous chunk is done.
+        Consecutive chunks of a device share one waypoint.
+        """
+        if isinstance(self._waypoints, WaypointBatch):
+            # the waypoints of a batch belong to one device
+            if not len(self._waypoints):
+                return []
+            return list(self._split_device(0, len(self._waypoints)))
+        chunks = []
+        end = 0
+        for _, device_points in groupby(self._waypoints,
+                                        attrgetter('device_id')):
+            start, end = end, end + sum(1 for _ in device_points)
+            chunks.extend(self._split_device(start, end))
+        return chunks
+
+    def _split_device(self, start: int, end: int
+                      ) -> Iterator[Tuple[int, int, int, tuple]]:
+        chunk_size = max(self.MIN_CHUNK_SIZE, -(-len(self._waypoints) // (
+            (self._workers or 1) * self.CHUNKS_PER_WORKER)))
+        search_size = max(1, int(chunk_size * self.SAFE_CUT_SEARCH_RATIO))
+        last = end - 1
+        cuts = []
+        if chunk_size < last - start:
+            # devices fitting into one chunk are not searched
+            cuts = [start + cut for cut in
+                    self._safe_cuts(*self._columns(start, end))]
+        chunk_start, state = start, TripExtractor().state
+        while chunk_start + chunk_size < last:
+            cut, next_state = self._safe_cut(
+                cuts, chunk_start + chunk_size,
+                min(chunk_start + chunk_size + search_size, last))
+            yield chunk_start, cut + 1, last, state
+            chunk_start, state = cut, next_state
+        yield chunk_start, end, last, state
+
+    def get_trips(self) -> Tuple[Trip]:
+        return list(self.iter_trips())
+
+    def iter_trips(self) -> Iterator[Trip]:
+        """
+        Yield the trips chunk by chunk in the order of the waypoints, as soon
+        as a chunk and all chunks before it are done.
+        """
+        chunks = self._split()
+        tasks = [(self._processor_class, self._geo_library,
+                  self._waypoints[start:end], self._waypoints[last], state,
+                  self._instrument)
+                 for start, end, last, state in chunks]
+
+        if (self._workers or 1) > 1 and len(tasks) > 1:
+            # multiprocessing is only imported by jobs using a pool
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(self._workers) as executor:
+                yield from self._stitch(tasks, executor.map(
+                    _extract_chunk_trips, tasks))
+        else:
+            yield from self._stitch(tasks, map(_extract_chunk_trips, tasks))
+
+    def _stitch(self, tasks: List[tuple], results: Iterable[tuple]
+                ) -> Iterator[Trip]:
+        state = None
+        for task, result in zip(tasks, results):
+            processor_class, geo_library, waypoints, last_point, \
+                chunk_state, instrument = task
+            chunk_trips, end_state, distances, prefilter, stats = result
+            self.prefilter.identical += prefilter.identical
+            self.prefilter.approximated += prefilter.approximated
+            self.prefilter.exact += prefilter.exact
+            extracted = not (chunk_state is None or (
+                chunk_state != state and
+                chunk_state != TripExtractor().state))
+            if stats is not None:
+                self._stats.add(stats, extracted)
+            if not extracted:
+                # the chunk continues from the end of the previous chunk
+                processor = processor_class(waypoints,
+                                            geo_library=geo_library)
+                stats = None if instrument is None else instrument(processor)
+                chunk_trips, end_state = processor._extract_trips(
+                    last_point, state, distances)
+                if stats is not None:
+                    self._stats.add(stats)
+            yield from chunk_trips
+            state = end_state
+
+
+class PartitionedWaypointListProcessor(ParallelWaypointListProcessor):
+    """
+    Parallel list processor for archives of many days, which cuts the
+    waypoints of every device into partitions of time, e.g. one per day,
+    instead of chunks of a number of waypoints. A partition ends at the
+    first safe cut after its end of time, usually the stop which spans the
+    night. Partitions without a safe cut near their end of time are cut
+    there anyway and their trips are stitched by extracting the next
+    partition from the state the previous one ended with.
+    The trips are yielded by iter_trips in the order of the waypoints as
+    soon as a partition and all partitions before it are done.
+    """
+    PARTITION_SECONDS = 24 * 60 * 60
+
+    def __init__(self, waypoints, workers: int = None,
+                 processor_class=WaypointListProcessor, geo_library=None,
+                 jump_filter: JumpFilter = None,
+                 partition_seconds: int = PARTITION_SECONDS):
+        """
+        :param partition_seconds: int, length of the partitions, which are
+        aligned to multiples of it since the epoch, i.e. days start at
+        midnight UTC
+        """
+        super().__init__(waypoints, workers, processor_class, geo_library,
+                         jump_filter)
+        self._partition_seconds = partition_seconds
+
+    def _split_device(self, start: int, end: int
+                      ) -> Iterator[Tuple[int, int, int, tuple]]:
+        import numpy as np
+        seconds = self._partition_seconds
+        search_seconds = int(seconds * self.SAFE_CUT_SEARCH_RATIO)
+        last = end - 1
+        epochs, lats, lngs = self._columns(start, end)
+        cuts = [start + cut for cut in self._safe_cuts(epochs, lats, lngs)]
+        chunk_start, state = start, TripExtractor().state
+        while True:
+            partition_end = (int(epochs[chunk_start - start]) // seconds +
+                             1) * seconds
+            cut = max(start + int(np.searchsorted(epochs, partition_end)),
+                      chunk_start + 1)
+            if cut >= last:
+                break
+            # up to the first segment ending after the search
+            cut, next_state = self._safe_cut(cuts, cut, min(
+                start + int(np.searchsorted(
+                    epochs, partition_end + search_seconds)) + 1, last))
+            yield chunk_start, cut + 1, last, state
+            chunk_start, state = cut, next_state
+        yield chunk_start, end, last, state
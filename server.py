@@ -0,0 +1,217 @@
+from lib.geo import PyprojLibrary
+from processor import FleetStreamProcessor
+from utils import convert_data_to_waypoint, trip_format
+import argparse
+import asyncio
+import json
+import signal
+
+
+class TripServer:
+    """
+    Asyncio service, which receives newline delimited waypoints over TCP or
+    Unix sockets and feeds them to a FleetStreamProcessor, which extracts
+    the trips of every device_id. Devices which stop sending are evicted
+    after the idle timeout of the fleet and their open trips are closed.
+    A connection sending {"subscribe": true} receives every completed trip
+    as a JSON line.
+
+    Every connection has a bounded queue of received waypoints and every
+    subscriber a bounded queue of trips. When a queue is full the server
+    stops reading from the connection feeding it, so slow processing or slow
+    subscribers push back on the clients instead of buffering without limit.
+    """
+    QUEUE_SIZE = 1000
+    DRAIN_TIMEOUT = 5
+
+    def __init__(self, queue_size: int = None, geo_library=None,
+                 idle_timeout_in_minutes: float = None,
+                 max_devices: int = None):
+        """
+        :param queue_size: int, the QUEUE_SIZE by default
+        :param geo_library: library computing the distances, PyprojLibrary
+        by default
+        :param idle_timeout_in_minutes: float, after which silent devices are
+        evicted, the one of FleetStreamProcessor by default
+        :param max_devices: int, the number of devices tracked at most,
+        unlimited by default
+        """
+        self._queue_size = queue_size or self.QUEUE_SIZE
+        self._fleet = FleetStreamProcessor(
+            idle_timeout_in_minutes, max_devices,
+            geo_library or PyprojLibrary())
+        self._servers = []
+        # readers of the open connections
+        self._connections = {}
+        self._subscriber_readers = set()
+        self._subscribers = {}
+        self._closing = False
+        self.connections = 0
+        self.waypoints = 0
+        self.trips = 0
+
+    async def start_tcp(self, host: str, port: int):
+        server = await asyncio.start_server(self._handle, host, port)
+        self._servers.append(server)
+        return server
+
+    async def start_unix(self, path: str):
+        server = await asyncio.start_unix_server(self._handle, path)
+        self._servers.append(server)
+        return server
+
+    async def close(self, timeout: float = None):
+        """
+        Stop accepting connections and give the clients the timeout to finish
+        sending. Then stop reading, process the waypoints received so far,
+        deliver their trips to the subscribers and close all connections.
+
+        :param timeout: float, seconds, the DRAIN_TIMEOUT by default
+        """
+        self._closing = True
+        for server in self._servers:
+            server.close()
+        producers = [connection for connection, reader in
+                     self._connections.items()
+                     if reader not in self._subscriber_readers]
+        if producers:
+            await asyncio.wait(producers, timeout=self.DRAIN_TIMEOUT
+                               if timeout is None else timeout)
+        for reader in self._connections.values():
+            reader.feed_eof()
+        if self._connections:
+            await asyncio.wait(list(self._connections))
+        subscriptions = list(self._subscribers.values())
+        for queue in list(self._subscribers):
+            await queue.put(None)
+        if subscriptions:
+            await asyncio.wait(subscriptions)
+        for server in self._servers:
+            await server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        connection = asyncio.get_event_loop().create_future()
+        self._connections[connection] = reader
+        self.connections += 1
+        queue = asyncio.Queue(self._queue_size)
+        consumer = asyncio.ensure_future(self._consume(queue))
+        subscription = None
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                    if data.get('subscribe'):
+                        subscription = subscription or \
+                            self._subscribe(writer)
+                        self._subscriber_readers.add(reader)
+                        continue
+                    waypoint = convert_data_to_waypoint(data)
+                except (ValueError, KeyError, TypeError,
+                        AttributeError) as error:
+                    writer.write(json.dumps(
+                        {'error': 'invalid waypoint: %s' % error}).encode() +
+                        b'\n')
+                    continue
+                await queue.put(waypoint)
+        except ConnectionError:
+            pass
+        finally:
+            await queue.put(None)
+            await consumer
+            self._subscriber_readers.discard(reader)
+            del self._connections[connection]
+            connection.set_result(None)
+            if subscription is None:
+                writer.close()
+            elif not self._closing:
+                # the subscriber has gone
+                subscription.cancel()
+
+    async def _consume(self, queue: asyncio.Queue):
+        while True:
+            waypoint = await queue.get()
+            if waypoint is None:
+                return
+            self.waypoints += 1
+            for trip in self._fleet.process_waypoint(waypoint):
+                await self._publish(trip)
+
+    async def _publish(self, trip):
+        self.trips += 1
+        data = trip_format(trip)
+        if trip.start.device_id is not None:
+            data['device_id'] = trip.start.device_id
+        line = json.dumps(data).encode() + b'\n'
+        for queue in list(self._subscribers):
+            await queue.put(line)
+
+    def _subscribe(self, writer) -> asyncio.Future:
+        queue = asyncio.Queue(self._queue_size)
+        subscription = asyncio.ensure_future(self._deliver(queue, writer))
+        self._subscribers[queue] = subscription
+        return subscription
+
+    async def _deliver(self, queue: asyncio.Queue, writer):
+        try:
+            while True:
+                line = await queue.get()
+                if line is None:
+                    break
+                writer.write(line)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self._subscribers[queue]
+            # release publishers waiting for the queue
+            while not queue.empty():
+                queue.get_nowait()
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='extract trips from waypoints received as newline '
+                    'delimited JSON over TCP or Unix sockets.')
+    parser.add_argument('--tcp', metavar='HOST:PORT',
+                        help='address to listen on for TCP connections')
+    parser.add_argument('--unix', metavar='PATH',
+                        help='path of a Unix socket to listen on')
+    parser.add_argument('--queue-size', type=int,
+                        default=TripServer.QUEUE_SIZE,
+                        help='maximum number of queued waypoints per '
+                             'connection and trips per subscriber')
+    parser.add_argument('--idle-timeout', type=float,
+                        default=FleetStreamProcessor.IDLE_TIMEOUT_IN_MINUTES,
+                        help='minutes after which a device, which stopped '
+                             'sending, is evicted and its open trip closed')
+    parser.add_argument('--max-devices', type=int,
+                        help='maximum number of devices tracked, the least '
+                             'recently seen one is evicted beyond it')
+    args = parser.parse_args()
+    if not (args.tcp or args.unix):
+        parser.error('one of --tcp or --unix is required')
+
+    loop = asyncio.get_event_loop()
+    server = TripServer(args.queue_size,
+                        idle_timeout_in_minutes=args.idle_timeout,
+                        max_devices=args.max_devices)
+    if args.tcp:
+        host, _, port = args.tcp.rpartition(':')
+        loop.run_until_complete(server.start_tcp(host, int(port)))
+    if args.unix:
+        loop.run_until_complete(server.start_unix(args.unix))
+
+    stopped = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    loop.run_until_complete(stopped.wait())
+    loop.run_until_complete(server.close())
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# path of the thresholds of the performance tests, which only run if it is
+# set, e.g. to tests/performance.json
+PERFORMANCE_VARIABLE = 'PERFORMANCE_THRESHOLDS'
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'performance: thresholds of the speed and memory of the '
+                   'processors, run only if %s is set and the tests are not '
+                   'traced, e.g. by coverage' % PERFORMANCE_VARIABLE)
+
+
+def _traced(config) -> bool:
+    # pytest-cov traces the tests with --cov, as debuggers do
+    return (bool(getattr(config.option, 'cov_source', None)) or
+            sys.gettrace() is not None)
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get(PERFORMANCE_VARIABLE) and not _traced(config):
+        return
+    skip = pytest.mark.skip(reason="performance tests run untraced with %s "
+                                   "set" % PERFORMANCE_VARIABLE)
+    for item in items:
+        if 'performance' in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,120 @@
+import random
+
+import pytest
+from aggregation import Totals, TripAggregator
+from benchmarks.generator import generate_waypoints
+from incremental import IncrementalTripExtractor
+from lib.geo import PyprojLibrary
+from lib.timestamp import format_timestamp, parse_timestamp
+from processor import FleetStreamProcessor, Trip, Waypoint
+from utils import convert_data_to_waypoints
+
+
+def _trip(start: str, distance: float, device_id=None) -> Trip:
+    epoch = parse_timestamp(start)
+    return Trip(distance, Waypoint(start, 51.5, 12.4, epoch, device_id),
+                Waypoint(format_timestamp(epoch + 600), 51.6, 12.4,
+                         epoch + 600, device_id))
+
+
+@pytest.fixture(scope='module')
+def trips():
+    fleet_processor = FleetStreamProcessor(geo_library=PyprojLibrary())
+    trips = []
+    for waypoint in convert_data_to_waypoints(
+            generate_waypoints(20000, devices=4)):
+        trips.extend(fleet_processor.process_waypoint(waypoint))
+    return trips + fleet_processor.flush()
+
+
+class TestTripAggregator:
+
+    def _rescan(self, trips, device_id, start, end):
+        selected = [trip for trip in trips
+                    if trip.start.device_id == device_id and
+                    start <= trip.start.epoch <= end]
+        return len(selected), sum(trip.distance for trip in selected)
+
+    def test_same_totals_as_rescan(self, trips):
+        aggregator = TripAggregator()
+        assert list(aggregator.aggregate(trips)) == trips
+        assert sorted(aggregator.devices) == [0, 1, 2, 3]
+
+        rng = random.Random(0)
+        epochs = [trip.start.epoch for trip in trips]
+        for _ in range(50):
+            device_id = rng.randrange(4)
+            start, end = sorted(rng.sample(epochs, 2))
+            # whole days
+            start -= start % 86400
+            end += 86399 - end % 86400
+            totals = aggregator.totals(device_id, start, end)
+            expected = self._rescan(trips, device_id, start, end)
+            assert totals.trips == expected[0]
+            assert totals.distance == pytest.approx(expected[1])
+
+        totals = aggregator.totals(0)
+        assert totals.trips == self._rescan(trips, 0, 0, max(epochs))[0]
+        assert sum(totals.trips for _, totals in
+                   aggregator.bucket_totals(0)) == totals.trips
+        assert aggregator.totals('unknown') == Totals(0, 0.0)
+
+    def test_days_and_months(self):
+        aggregator = TripAggregator()
+        for trip in (_trip("2018-08-31T10:00:00Z", 1000.0),
+                     _trip("2018-08-31T18:00:00Z", 500.0),
+                     _trip("2018-09-02T08:00:00Z", 250.0),
+                     _trip("2018-12-31T08:00:00Z", 100.0),
+                     _trip("2019-01-01T08:00:00Z", 50.0),
+                     # earlier than all buckets before
+                     _trip("2018-07-01T08:00:00Z", 25.0)):
+            aggregator.add(trip)
+
+        assert [(format_timestamp(epoch), totals) for epoch, totals in
+                aggregator.bucket_totals(None, "2018-08-31T23:00:00Z",
+                                         "2018-09-30T00:00:00Z")] == [
+            ("2018-08-31T00:00:00Z", Totals(2, 1500.0)),
+            ("2018-09-02T00:00:00Z", Totals(1, 250.0))]
+        assert list(aggregator.monthly_totals(None)) == [
+            ("2018-07", Totals(1, 25.0)), ("2018-08", Totals(2, 1500.0)),
+            ("2018-09", Totals(1, 250.0)), ("2018-12", Totals(1, 100.0)),
+            ("2019-01", Totals(1, 50.0))]
+        assert aggregator.totals(None, "2018-09-01T00:00:00Z",
+                                 "2018-12-31T00:00:00Z") == Totals(2, 350.0)
+
+        aggregator.remove(_trip("2018-08-31T18:00:00Z", 500.0))
+        assert aggregator.as_dict()[0]['months'][1] == {
+            'month': '2018-08', 'trips': 1, 'distance': 1000.0}
+
+    def test_hourly_buckets(self):
+        aggregator = TripAggregator(3600)
+        aggregator.add(_trip("2018-08-31T10:00:00Z", 1000.0, 'car'))
+        aggregator.add(_trip("2018-08-31T10:59:59Z", 500.0, 'car'))
+        aggregator.add(_trip("2018-08-31T11:00:00Z", 250.0, 'car'))
+        assert aggregator.totals('car', "2018-08-31T10:30:00Z",
+                                 "2018-08-31T10:30:00Z") == Totals(2, 1500.0)
+        assert list(aggregator.monthly_totals('car')) == [
+            ("2018-08", Totals(3, 1750.0))]
+
+    def test_incremental_changes(self):
+        waypoints = convert_data_to_waypoints(
+            list(generate_waypoints(3000, devices=2)))
+        rng = random.Random(0)
+        cuts = sorted(rng.sample(range(1, len(waypoints)), 20))
+        batches = [waypoints[start:end] for start, end in
+                   zip([0] + cuts, cuts + [len(waypoints)])]
+        rng.shuffle(batches)
+
+        extractor = IncrementalTripExtractor(PyprojLibrary())
+        aggregator = TripAggregator()
+        for batch in batches:
+            aggregator.apply(extractor.add_waypoints(batch))
+
+        expected = TripAggregator()
+        for device_id in (0, 1):
+            for trip in extractor.get_trips(device_id):
+                expected.add(trip)
+            assert aggregator.totals(device_id).trips == \
+                expected.totals(device_id).trips
+            assert aggregator.totals(device_id).distance == pytest.approx(
+                expected.totals(device_id).distance)
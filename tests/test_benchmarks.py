@@ -0,0 +1,52 @@
+from benchmarks.generator import generate_waypoints
+from benchmarks.run import run_case
+from utils import convert_data_to_waypoints
+
+
+class TestGenerator():
+
+    def test_deterministic(self):
+        assert list(generate_waypoints(5000, seed=1)) == list(
+            generate_waypoints(5000, seed=1))
+        assert list(generate_waypoints(100, seed=1)) != list(
+            generate_waypoints(100, seed=2))
+
+    def test_single_vehicle(self):
+        waypoints = convert_data_to_waypoints(generate_waypoints(20000))
+        assert len(waypoints) == 20000
+        assert all(waypoint.device_id is None for waypoint in waypoints)
+        assert all(current.epoch < following.epoch for current, following
+                   in zip(waypoints, waypoints[1:]))
+        # parked and stopped vehicles repeat their position
+        assert any(current[1:3] == following[1:3] for current, following
+                   in zip(waypoints, waypoints[1:]))
+
+    def test_fleet(self):
+        waypoints = convert_data_to_waypoints(
+            generate_waypoints(5000, devices=10))
+        assert {waypoint.device_id for waypoint in waypoints} == set(
+            range(10))
+        assert all(current.timestamp <= following.timestamp
+                   for current, following in zip(waypoints, waypoints[1:]))
+
+
+class TestRunCase():
+
+    def test_processor_case(self):
+        result = run_case({'kind': 'processor', 'name': 'vectorized',
+                           'points': 2000, 'seed': 0})
+        assert result['trips'] > 0
+        assert set(result['stages']) == {'convert', 'extract', 'output'}
+        assert result['points_per_second'] > 0
+        assert result['peak_rss_kb'] > 0
+
+    def test_geo_case(self):
+        result = run_case({'kind': 'geo', 'name': 'numpy-haversine',
+                           'points': 2000, 'seed': 0})
+        assert set(result['stages']) == {'distances'}
+
+    def test_kernel_case(self):
+        result = run_case({'kind': 'kernel', 'name': 'python',
+                           'points': 2000, 'seed': 0})
+        assert result['trips'] > 0
+        assert set(result['stages']) == {'extract'}
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+from benchmarks.generator import generate_waypoints
+from checkpoint import (Checkpointer, CheckpointError, dump_state, load_state,
+                        restore)
+from lib.jumps import JumpFilter
+from processor import FleetStreamProcessor, WaypointStreamProcessor
+from utils import convert_data_to_waypoints, trip_format
+
+
+def _trips(results, fleet):
+    if fleet:
+        return [trip_format(trip) for trips in results for trip in trips]
+    return [trip_format(trip) for trip in results if trip is not None]
+
+
+class TestCheckpoint:
+
+    def _run_with_restarts(self, make_processor, waypoints, path, restarts,
+                           **kwargs):
+        """Process the waypoints, restarting from the checkpoint on crash."""
+        fleet = isinstance(make_processor(), FleetStreamProcessor)
+        trips = []
+        offset = 0
+        for crash_at in restarts + [len(waypoints)]:
+            processor = make_processor()
+            offset = restore(path, processor)
+            # trips of waypoints after the checkpoint are emitted again
+            del trips[offset:]
+            checkpointer = Checkpointer(processor, path, offset=offset,
+                                        **kwargs)
+            for waypoint in waypoints[offset:crash_at]:
+                trips.append(checkpointer.process_waypoint(waypoint))
+        return _trips(trips, fleet)
+
+    def test_stream_processor_restarts(self, tmpdir):
+        waypoints = convert_data_to_waypoints(
+            list(generate_waypoints(3000, seed=3)))
+        processor = WaypointStreamProcessor()
+        expected = _trips(map(processor.process_waypoint, waypoints), False)
+        assert expected
+
+        trips = self._run_with_restarts(
+            WaypointStreamProcessor, waypoints,
+            str(tmpdir.join('stream.ckpt')), [700, 1234, 2999], interval=100)
+        assert trips == expected
+
+    @pytest.mark.parametrize("compact_every", [1, 3, 100])
+    def test_fleet_processor_restarts(self, tmpdir, compact_every):
+        waypoints = convert_data_to_waypoints(
+            list(generate_waypoints(6000, devices=30, seed=4)))
+        make_processor = lambda: FleetStreamProcessor(  # noqa: E731
+            idle_timeout_in_minutes=10, max_devices=20)
+        processor = make_processor()
+        expected = _trips(map(processor.process_waypoint, waypoints), True)
+        assert expected
+
+        trips = self._run_with_restarts(
+            make_processor, waypoints, str(tmpdir.join('fleet.ckpt')),
+            [1500, 1501, 4321], interval=250, compact_every=compact_every)
+        assert trips == expected
+
+    # seeds with jumps right after a restart
+    @pytest.mark.parametrize("fleet, seed", [(False, 3), (True, 5)])
+    def test_jump_filter_restarts(self, tmpdir, fleet, seed):
+        waypoints = convert_data_to_waypoints(
+            list(generate_waypoints(3000, devices=3 if fleet else 1,
+                                    seed=seed)))
+
+        def make_processor():
+            if fleet:
+                return FleetStreamProcessor(jump_filter=JumpFilter())
+            return WaypointStreamProcessor(jump_filter=JumpFilter())
+
+        processor = make_processor()
+        expected = _trips(map(processor.process_waypoint, waypoints), fleet)
+        assert processor.jump_filter.dropped > 0
+
+        trips = self._run_with_restarts(
+            make_processor, waypoints, str(tmpdir.join('jumps.ckpt')),
+            list(range(37, len(waypoints), 37)), interval=37,
+            compact_every=3)
+        assert trips == expected
+
+    def test_torn_journal_batch_is_ignored(self, tmpdir):
+        path = str(tmpdir.join('fleet.ckpt'))
+        waypoints = convert_data_to_waypoints(
+            list(generate_waypoints(1000, devices=5, seed=5)))
+        checkpointer = Checkpointer(FleetStreamProcessor(), path,
+                                    interval=100)
+        for waypoint in waypoints[:350]:
+            checkpointer.process_waypoint(waypoint)
+
+        with open(path + '.journal', 'rb+') as journal:
+            journal.truncate(os.path.getsize(path + '.journal') - 3)
+        assert restore(path, FleetStreamProcessor()) == 200
+
+    def test_restore_without_checkpoint(self, tmpdir):
+        assert restore(str(tmpdir.join('missing')),
+                       WaypointStreamProcessor()) == 0
+
+    def test_checkpoint_of_another_processor(self):
+        data = dump_state(WaypointStreamProcessor(), 0)
+        with pytest.raises(CheckpointError):
+            load_state(data, FleetStreamProcessor())
+        with pytest.raises(CheckpointError):
+            load_state(b'JUNK' + data[4:], WaypointStreamProcessor())
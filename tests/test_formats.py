@@ -0,0 +1,161 @@
+import gzip
+import io
+import json
+
+import numpy as np
+import pytest
+
+from processor import Trip, Waypoint, WaypointBatch, WaypointListProcessor
+from utils import (load_from_json_file, convert_data_to_waypoints,
+                   trip_waypoint_format)
+from utils.formats import (TripWriter, detect_format, read_trips,
+                           read_waypoints, write_trips, write_waypoints)
+
+
+class TestFormats():
+
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file('data/waypoints.json'))
+
+    @pytest.mark.parametrize("extension, file_format", [
+        ('json', 'json'), ('jsonl', 'ndjson'), ('csv', 'csv'),
+        ('wpb', 'binary')])
+    def test_round_trip(self, tmpdir, extension, file_format):
+        path = str(tmpdir.join('waypoints.' + extension))
+        waypoints = [point._replace(device_id='car') for point in
+                     self.waypoints]
+        write_waypoints(waypoints, path)
+
+        assert detect_format(path) == file_format
+        if file_format == 'binary':
+            waypoints = self.waypoints
+        assert list(read_waypoints(path)) == waypoints
+
+    @pytest.mark.parametrize("file_format", ['json', 'ndjson', 'csv',
+                                             'binary'])
+    def test_detect_format_by_content(self, tmpdir, file_format):
+        path = str(tmpdir.join('waypoints'))
+        write_waypoints(self.waypoints[:3], path, file_format)
+        assert detect_format(path) == file_format
+        assert list(read_waypoints(path)) == self.waypoints[:3]
+
+    def test_binary_file_is_mapped(self, tmpdir):
+        path = str(tmpdir.join('waypoints.wpb'))
+        write_waypoints(self.waypoints, path)
+        batch = read_waypoints(path)
+
+        assert isinstance(batch, WaypointBatch)
+        assert batch.lats.readonly
+        assert list(batch[1:3]) == self.waypoints[1:3]
+        del batch
+
+        with open(path, 'rb+') as _file:
+            _file.truncate(100)
+        with pytest.raises(ValueError):
+            read_waypoints(path)
+        with pytest.raises(ValueError):
+            list(read_waypoints(path, 'csv'))
+
+    def test_binary_columns_are_aligned(self, tmpdir):
+        path = str(tmpdir.join('waypoints.wpb'))
+        write_waypoints(self.waypoints, path)
+        with open(path, 'rb') as _file:
+            data = _file.read()
+        assert len(data) == 32 + len(self.waypoints) * 24
+        assert data[4:6] == (2).to_bytes(2, 'little')
+
+        batch = read_waypoints(path)
+        for column in (batch.epochs, batch.lats, batch.lngs):
+            assert np.asarray(column).flags.aligned
+
+        with open(path, 'rb+') as _file:
+            # files of version 1 had a header of 28 bytes
+            _file.write(data[:4] + (1).to_bytes(2, 'little'))
+        del batch
+        with pytest.raises(ValueError):
+            read_waypoints(path)
+
+    def test_write_trips(self):
+        trips = [Trip(25.59, Waypoint("2018-08-10T20:04:22Z", 51.5, 12.4),
+                      Waypoint("2018-08-10T20:10:22Z", 51.6, 12.4))]
+        output = io.StringIO()
+        write_trips(trips, output, 'ndjson')
+        assert json.loads(output.getvalue()) == {
+            "start": {"timestamp": "2018-08-10T20:04:22Z",
+                      "lat": 51.5, "lng": 12.4},
+            "end": {"timestamp": "2018-08-10T20:10:22Z",
+                    "lat": 51.6, "lng": 12.4},
+            "distance": 25.59}
+
+        output = io.StringIO()
+        write_trips(trips, output, 'csv')
+        assert output.getvalue() == (
+            "start_timestamp,start_lat,start_lng,end_timestamp,end_lat,"
+            "end_lng,distance\n"
+            "2018-08-10T20:04:22Z,51.5,12.4,2018-08-10T20:10:22Z,51.6,12.4,"
+            "25.59\n")
+
+
+class TestTripWriter():
+
+    trips = WaypointListProcessor(convert_data_to_waypoints(
+        load_from_json_file('data/waypoints.json'))).get_trips()
+
+    def test_same_json_as_dumps(self):
+        output = io.StringIO()
+        write_trips(self.trips, output)
+        assert output.getvalue() == json.dumps(
+            trip_waypoint_format(self.trips)) + '\n'
+
+        output = io.StringIO()
+        write_trips([], output)
+        assert output.getvalue() == '[]\n'
+
+    @pytest.mark.parametrize("file_format", ['json', 'ndjson', 'csv',
+                                             'binary'])
+    @pytest.mark.parametrize("compression", [None, 'gzip', 'zstd'])
+    def test_round_trip(self, tmpdir, file_format, compression):
+        if compression == 'zstd':
+            pytest.importorskip('zstandard')
+        path = str(tmpdir.join('trips'))
+        with open(path, 'wb') as output:
+            write_trips(self.trips, output, file_format, compression)
+        assert list(read_trips(path)) == self.trips
+        assert list(read_trips(path, file_format)) == self.trips
+
+    def test_flush_interval(self):
+        output = io.StringIO()
+        writer = TripWriter(output, 'ndjson', flush_interval=3600)
+        writer.write(self.trips[0])
+        assert output.getvalue() == ''
+        writer.flush()
+        assert output.getvalue().count('\n') == 1
+
+        writer = TripWriter(io.StringIO(), 'ndjson', flush_interval=3600,
+                            buffer_size=1)
+        writer.write(self.trips[0])
+        assert writer._pending == []
+
+        output = io.BytesIO()
+        writer = TripWriter(output, 'ndjson', 'gzip', flush_interval=0)
+        writer.write(self.trips[0])
+        assert json.loads(gzip.GzipFile(fileobj=io.BytesIO(
+            output.getvalue())).readline())['distance'] == \
+            self.trips[0].distance
+
+    def test_binary_needs_binary_output(self):
+        with pytest.raises(ValueError):
+            TripWriter(io.StringIO(), 'binary')
+        with pytest.raises(ValueError):
+            TripWriter(io.StringIO(), 'ndjson', 'gzip')
+        with pytest.raises(ValueError):
+            TripWriter(io.BytesIO(), 'xml')
+
+    def test_truncated_binary_trips(self, tmpdir):
+        path = str(tmpdir.join('trips.tpb'))
+        with open(path, 'wb') as output:
+            write_trips(self.trips, output, 'binary')
+        with open(path, 'rb+') as _file:
+            _file.truncate(100)
+        with pytest.raises(ValueError):
+            list(read_trips(path))
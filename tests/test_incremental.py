@@ -0,0 +1,71 @@
+import random
+
+import pytest
+from benchmarks.generator import generate_waypoints
+from incremental import IncrementalTripExtractor
+from lib.geo import PyprojLibrary
+from processor import Waypoint, WaypointListProcessor
+from utils import convert_data_to_waypoints
+
+
+class SmallSegmentsTripExtractor(IncrementalTripExtractor):
+    SEGMENT_SIZE = 7
+
+
+class TestIncrementalTripExtractor:
+
+    @pytest.mark.parametrize("extractor_class", [
+        IncrementalTripExtractor, SmallSegmentsTripExtractor])
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_out_of_order_batches(self, extractor_class, seed):
+        waypoints = convert_data_to_waypoints(
+            list(generate_waypoints(3000, devices=3, seed=seed)))
+        rng = random.Random(seed)
+        cuts = sorted(rng.sample(range(1, len(waypoints)), 40))
+        batches = [waypoints[start:end] for start, end in
+                   zip([0] + cuts, cuts + [len(waypoints)])]
+        rng.shuffle(batches)
+
+        extractor = extractor_class(PyprojLibrary())
+        trips = {}
+        for batch in batches:
+            changes = extractor.add_waypoints(batch)
+            for trip in changes.removed:
+                del trips[trip.start]
+            for old_trip, trip in changes.changed:
+                assert trips.pop(old_trip.start) == old_trip
+                trips[trip.start] = trip
+            for trip in changes.added:
+                assert trip.start not in trips
+                trips[trip.start] = trip
+
+        assert len(extractor) == 3
+        expected = []
+        for device_id in range(3):
+            device_points = [point for point in waypoints
+                             if point.device_id == device_id]
+            device_trips = WaypointListProcessor(
+                device_points, PyprojLibrary()).get_trips()
+            assert extractor.get_trips(device_id) == device_trips
+            expected.extend(device_trips)
+        assert sorted(trips.values()) == sorted(expected)
+
+    def test_late_waypoints_change_trip(self):
+        points = [Waypoint("2018-08-10T20:04:22Z", 51.54987, 12.41039),
+                  Waypoint("2018-08-10T20:05:22Z", 51.55987, 12.41039),
+                  Waypoint("2018-08-10T20:06:22Z", 51.56987, 12.41039),
+                  Waypoint("2018-08-10T20:10:22Z", 51.56987, 12.41039),
+                  Waypoint("2018-08-10T20:12:22Z", 51.56987, 12.41039)]
+        extractor = IncrementalTripExtractor()
+
+        changes = extractor.add_waypoints(points[:2] + points[3:])
+        assert changes.removed == changes.changed == []
+        assert [trip.end for trip in changes.added] == [points[3]]
+
+        changes = extractor.add_waypoints(points[2:3])
+        assert changes.added == changes.removed == []
+        [(old_trip, trip)] = changes.changed
+        assert (old_trip.end, trip.end) == (points[3], points[2])
+        assert extractor.get_trips() == WaypointListProcessor(
+            points).get_trips()
+        assert extractor.get_trips('unknown') == []
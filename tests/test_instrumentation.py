@@ -0,0 +1,108 @@
+from instrumentation import (CountingGeoLibrary, Stats, instrument,
+                             LatencyHistogram)
+from lib.geo import GeopyLibrary, NumpyLibrary
+from processor import (FleetStreamProcessor, WaypointListProcessor,
+                       WaypointStreamProcessor, TripExtractor, DeviceState,
+                       VectorizedWaypointListProcessor,
+                       ParallelWaypointListProcessor)
+from utils import load_from_json_file, convert_data_to_waypoints
+
+
+class TestInstrumentation:
+
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+
+    def test_list_processor(self):
+        expected = WaypointListProcessor(self.waypoints).get_trips()
+        list_processor = WaypointListProcessor(self.waypoints)
+        stats = instrument(list_processor)
+        assert WaypointListProcessor.extractor_class is TripExtractor
+        assert list_processor.get_trips() == expected
+        assert stats.segments == len(self.waypoints) - 1
+        assert stats.trips == len(expected)
+        assert stats.noise > 0
+        assert stats.geodesic_calls + stats.avoided_geodesic_calls == \
+            len(self.waypoints) - 1
+        assert stats.histograms['distance'].count == len(self.waypoints) - 1
+        assert stats.as_dict()['stages']['extract']['count'] == \
+            stats.segments
+
+    def test_parallel_processor(self, monkeypatch):
+        expected = WaypointListProcessor(self.waypoints)
+        expected_stats = instrument(expected)
+        expected_trips = expected.get_trips()
+        # chunks of the pool, some of them cut where no trip ended
+        monkeypatch.setattr(ParallelWaypointListProcessor, 'MIN_CHUNK_SIZE',
+                            20)
+        for workers in (1, 2):
+            list_processor = ParallelWaypointListProcessor(self.waypoints,
+                                                           workers)
+            stats = instrument(list_processor)
+            assert list_processor.get_trips() == expected_trips
+            assert stats.segments == expected_stats.segments
+            assert stats.trips == expected_stats.trips
+            assert stats.noise == expected_stats.noise
+            assert stats.geodesic_calls == expected_stats.geodesic_calls
+            assert stats.histograms['distance'].count == \
+                len(self.waypoints) - 1
+            assert stats.histograms['extract'].count == stats.segments
+
+    def test_vectorized_processor(self):
+        list_processor = VectorizedWaypointListProcessor(self.waypoints)
+        stats = instrument(list_processor)
+        list_processor.get_trips()
+        assert stats.histograms['distance'].count == 1
+        assert stats.geodesic_calls > 0
+
+    def test_stream_and_fleet_processors(self):
+        stats = Stats()
+        stream_processor = WaypointStreamProcessor()
+        fleet_processor = FleetStreamProcessor()
+        instrument(stream_processor, stats)
+        instrument(fleet_processor, stats)
+        assert WaypointStreamProcessor.state_class is DeviceState
+
+        trips = []
+        for waypoint in stats.read(self.waypoints):
+            trips.append(stream_processor.process_waypoint(waypoint))
+            trips.extend(fleet_processor.process_waypoint(waypoint))
+        trips = list(stats.write(filter(None, trips)))
+        assert stats.points == len(self.waypoints)
+        assert stats.trips == len(trips)
+        assert stats.segments == 2 * (len(self.waypoints) - 1)
+        assert stats.histograms['write'].count == len(trips)
+
+    def test_histogram_percentiles(self):
+        histogram = LatencyHistogram()
+        assert histogram.percentile(50) == 0
+        for nanoseconds in [100] * 98 + [5000, 70000]:
+            histogram.record(nanoseconds)
+        assert histogram.percentile(50) == 127
+        assert histogram.percentile(99) == 8191
+        assert histogram.percentile(100) == 131071
+
+    def test_stream_batches(self):
+        expected = list(filter(None, map(
+            WaypointStreamProcessor().process_waypoint, self.waypoints)))
+        stream_processor = WaypointStreamProcessor()
+        stats = instrument(stream_processor)
+        trips = stream_processor.process_batch(self.waypoints)
+        assert trips == expected
+        assert stats.segments == len(self.waypoints) - 1
+        assert stats.trips == len(trips)
+        assert stats.histograms['distance'].count == 1
+
+    def test_counting_geo_library(self):
+        geo_library = CountingGeoLibrary(GeopyLibrary())
+        assert not hasattr(geo_library, 'compute_distances_in_meters')
+        list_processor = WaypointListProcessor(self.waypoints, geo_library)
+        list_processor.get_trips()
+        assert geo_library.calls == geo_library.distances == \
+            list_processor.prefilter.exact
+
+        geo_library = CountingGeoLibrary(NumpyLibrary())
+        VectorizedWaypointListProcessor(
+            self.waypoints, geo_library=geo_library).get_trips()
+        assert geo_library.calls == 1
+        assert geo_library.distances == len(self.waypoints) - 1
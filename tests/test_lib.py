@@ -1,3 +1,326 @@
+import calendar
+import pickle
+import random
+from datetime import datetime
+
+import pytest
+from pyproj import Geod
+from unittest.mock import Mock, patch
+from lib.geo import (GEO_BACKENDS, CachingLibrary, GeoAdapter, GeopyLibrary,
+                     NumpyLibrary, PyprojLibrary, PrefilterLibrary, Waypoint,
+                     create_geo_library)
+from lib.fenwick import FenwickTree
+from lib.jumps import JumpFilter, JumpWindow
+from lib.timestamp import (parse_timestamp, format_timestamp,
+                           TIMESTAMP_FORMAT)
+from processor import (WaypointListProcessor, VectorizedWaypointListProcessor,
+                       ParallelWaypointListProcessor)
+from utils import load_from_json_file, convert_data_to_waypoints
+
+
 class TestLibGeo():
 
-    pass
+    lats = [52.54987, 52.54987, 54.54987, 54.54991, -33.8688, 40.7128, 0.0]
+    lngs = [12.41039, 12.41039, 12.41039, 12.41036, 151.2093, -74.006, 0.0]
+
+    def _geopy_distances(self):
+        geo = GeoAdapter(GeopyLibrary())
+        return [geo.compute_distance_in_meters(
+            Waypoint(None, self.lats[i], self.lngs[i]),
+            Waypoint(None, self.lats[i + 1], self.lngs[i + 1]))
+            for i in range(len(self.lats) - 1)]
+
+    def test_vincenty_matches_geopy(self):
+        geo = GeoAdapter(NumpyLibrary('vincenty'))
+        distances = geo.compute_distances_in_meters(self.lats, self.lngs)
+        assert distances.tolist() == pytest.approx(
+            self._geopy_distances(), abs=1e-3)
+
+    def test_haversine_matches_geopy(self):
+        geo = GeoAdapter(NumpyLibrary('haversine'))
+        distances = geo.compute_distances_in_meters(self.lats, self.lngs)
+        assert distances.tolist() == pytest.approx(
+            self._geopy_distances(), rel=5e-3)
+
+    def test_nearly_antipodal_points(self):
+        geo = GeoAdapter(NumpyLibrary('vincenty'))
+        origin = Waypoint(None, 0.0, 0.0)
+        destination = Waypoint(None, 0.5, 179.7)
+        assert geo.compute_distance_in_meters(
+            origin, destination) == pytest.approx(
+            GeopyLibrary().compute_distance_in_meters(
+                origin, destination), abs=1e-3)
+
+    def test_batch_fallback_for_pairwise_library(self):
+        geo = GeoAdapter(GeopyLibrary())
+        distances = geo.compute_distances_in_meters(self.lats, self.lngs)
+        assert distances.tolist() == self._geopy_distances()
+
+    def test_pyproj_batch_matches_geopy(self):
+        geo = GeoAdapter(PyprojLibrary())
+        distances = geo.compute_distances_in_meters(self.lats, self.lngs)
+        assert distances.tolist() == pytest.approx(
+            self._geopy_distances(), abs=1e-3)
+
+    def test_pyproj_geod_is_reused(self):
+        with patch('pyproj.Geod', wraps=Geod) as geod:
+            geo = GeoAdapter(PyprojLibrary())
+            for _ in range(3):
+                geo.compute_distance_in_meters(
+                    Waypoint(None, 52.54987, 12.41039),
+                    Waypoint(None, 54.54987, 12.41039))
+            geo.compute_distances_in_meters(self.lats, self.lngs)
+        assert geod.call_count == 1
+
+    def test_unknown_formula(self):
+        with pytest.raises(ValueError):
+            NumpyLibrary('flat')
+
+    @pytest.mark.parametrize("backend", sorted(GEO_BACKENDS))
+    def test_geo_backends(self, backend):
+        geo = GeoAdapter(create_geo_library(backend))
+        assert geo.compute_distances_in_meters(
+            self.lats, self.lngs).tolist() == pytest.approx(
+            self._geopy_distances(), rel=5e-3)
+
+    def test_unknown_geo_backend(self):
+        with pytest.raises(ValueError):
+            create_geo_library('flat')
+
+    def test_vectorized_list_processor_matches_geopy(self):
+        waypoints = convert_data_to_waypoints(
+            load_from_json_file("data/waypoints.json"))
+        expected = WaypointListProcessor(waypoints).get_trips()
+        trips = VectorizedWaypointListProcessor(waypoints).get_trips()
+        assert [(trip.start, trip.end) for trip in trips] == [
+            (trip.start, trip.end) for trip in expected]
+        assert [trip.distance for trip in trips] == pytest.approx(
+            [trip.distance for trip in expected], abs=1e-2)
+
+
+class TestPrefilterLibrary():
+
+    lats = [52.54987, 52.54987, 52.54988, 52.54991, 52.56991, 52.56991,
+            52.56990, 52.56991, 52.56991, 52.57991]
+    lngs = [12.41039, 12.41039, 12.41031, 12.41036, 12.41036, 12.41036,
+            12.41036, 12.41036, 12.41037, 12.41037]
+
+    def _pairs(self):
+        points = [Waypoint(None, lat, lng)
+                  for lat, lng in zip(self.lats, self.lngs)]
+        return list(zip(points, points[1:]))
+
+    def test_distances_match_geopy(self):
+        prefilter = PrefilterLibrary(GeopyLibrary())
+        for origin, destination in self._pairs():
+            assert prefilter.compute_distance_in_meters(
+                origin, destination) == pytest.approx(
+                GeopyLibrary().compute_distance_in_meters(
+                    origin, destination), abs=1e-6)
+        assert (prefilter.identical, prefilter.approximated,
+                prefilter.exact) == (2, 5, 2)
+        assert prefilter.avoided == 7
+
+    def test_batch_matches_pairs(self):
+        for lats, lngs in ((self.lats, self.lngs),
+                           (self.lats[3:6], self.lngs[3:6])):
+            prefilter = PrefilterLibrary(GeopyLibrary())
+            distances = GeoAdapter(prefilter).compute_distances_in_meters(
+                lats, lngs)
+            expected = GeoAdapter(GeopyLibrary()).compute_distances_in_meters(
+                lats, lngs)
+            assert distances.tolist() == pytest.approx(
+                expected.tolist(), abs=1e-6)
+            assert prefilter.identical + prefilter.approximated + \
+                prefilter.exact == len(lats) - 1
+
+    def test_pairwise_library_computes_exact_segments_only(self):
+        geopy = GeopyLibrary()
+        library = Mock(spec=['compute_distance_in_meters'],
+                       compute_distance_in_meters=Mock(
+                           wraps=geopy.compute_distance_in_meters))
+        prefilter = PrefilterLibrary(library)
+        prefilter.compute_distances_in_meters(self.lats, self.lngs)
+        assert library.compute_distance_in_meters.call_count == \
+            prefilter.exact == 2
+
+    def test_exact_library_is_skipped(self):
+        geo_library = Mock(wraps=GeopyLibrary())
+        prefilter = PrefilterLibrary(geo_library, threshold_in_meters=15)
+        for origin, destination in self._pairs():
+            prefilter.compute_distance_in_meters(origin, destination)
+        assert geo_library.compute_distance_in_meters.call_count == 2
+
+
+class TestCachingLibrary():
+
+    lats = [52.54987, 52.54987, 52.54988, 52.56991, 52.54987, 52.54987,
+            52.54988]
+    lngs = [12.41039, 12.41039, 12.41031, 12.41036, 12.41039, 12.41039,
+            12.41031]
+
+    def _pairs(self):
+        points = [Waypoint(None, lat, lng)
+                  for lat, lng in zip(self.lats, self.lngs)]
+        return list(zip(points, points[1:]))
+
+    def test_repeated_pairs_are_cached(self):
+        library = PyprojLibrary()
+        cache = CachingLibrary(library)
+        for origin, destination in self._pairs():
+            assert cache.compute_distance_in_meters(
+                origin, destination) == library.compute_distance_in_meters(
+                origin, destination)
+        assert (cache.hits, cache.misses) == (2, 4)
+        assert cache.hit_rate == pytest.approx(1 / 3)
+
+    def test_batch_matches_pairs(self):
+        cache = CachingLibrary(PyprojLibrary())
+        distances = cache.compute_distances_in_meters(self.lats, self.lngs)
+        assert distances.tolist() == [
+            PyprojLibrary().compute_distance_in_meters(origin, destination)
+            for origin, destination in self._pairs()]
+        assert (cache.hits, cache.misses) == (2, 4)
+        assert cache.compute_distances_in_meters(
+            self.lats, self.lngs).tolist() == distances.tolist()
+        assert cache.misses == 4
+
+    def test_least_recently_used_pair_is_evicted(self):
+        cache = CachingLibrary(PyprojLibrary(),
+                               max_bytes=2 * CachingLibrary.ENTRY_BYTES)
+        first, second, third = self._pairs()[1:4]
+        for origin, destination in (first, second, first, third, first,
+                                    second):
+            cache.compute_distance_in_meters(origin, destination)
+        assert cache.size == 2
+        assert (cache.hits, cache.misses, cache.evictions) == (2, 4, 2)
+
+    def test_file_is_shared(self, tmp_path):
+        path = str(tmp_path / 'distances.sqlite')
+        cache = CachingLibrary(PyprojLibrary(), path=path)
+        expected = cache.compute_distances_in_meters(self.lats, self.lngs)
+        cache.close()
+
+        cache = CachingLibrary(PyprojLibrary(), path=path)
+        assert cache.compute_distances_in_meters(
+            self.lats, self.lngs).tolist() == expected.tolist()
+        assert (cache.hits, cache.disk_hits, cache.misses) == (2, 4, 0)
+        cache.close()
+
+        with pytest.raises(ValueError):
+            CachingLibrary(GeopyLibrary(), path=path)
+        with pytest.raises(ValueError):
+            CachingLibrary(PyprojLibrary(), path=path, decimals=5)
+
+    def test_processes_of_a_pool_write_the_file(self, tmp_path):
+        path = str(tmp_path / 'distances.sqlite')
+        waypoints = convert_data_to_waypoints(
+            load_from_json_file("data/waypoints.json"))
+        expected = WaypointListProcessor(waypoints).get_trips()
+        cache = CachingLibrary(GeopyLibrary(), path=path)
+        assert pickle.loads(pickle.dumps(cache)).size == 0
+
+        processor = ParallelWaypointListProcessor(
+            waypoints, 2, geo_library=cache)
+        processor.MIN_CHUNK_SIZE = 10
+        assert processor.get_trips() == expected
+
+        cache = CachingLibrary(GeopyLibrary(), path=path)
+        assert WaypointListProcessor(waypoints, cache).get_trips() == expected
+        assert cache.misses == 0
+        cache.close()
+
+
+class TestLibTimestamp():
+
+    @pytest.mark.parametrize("timestamp", [
+        "1970-01-01T00:00:00Z", "2018-08-10T20:04:22Z",
+        "2000-02-29T23:59:59Z", "2100-03-01T00:00:01Z",
+        "1969-12-31T23:59:59Z"
+    ])
+    def test_parse_timestamp(self, timestamp):
+        expected = calendar.timegm(
+            datetime.strptime(timestamp, TIMESTAMP_FORMAT).timetuple())
+        assert parse_timestamp(timestamp) == expected
+
+    @pytest.mark.parametrize("timestamp", [
+        "2018-08-10 20:04:22Z", "2018-08-10T20:04:22", "2018/08/10T20:04:22Z",
+        "2018-13-10T20:04:22Z", "2018-08-1xT20:04:22Z"
+    ])
+    def test_parse_invalid_timestamp(self, timestamp):
+        with pytest.raises(ValueError):
+            parse_timestamp(timestamp)
+
+    @pytest.mark.parametrize("timestamp", [
+        "1970-01-01T00:00:00Z", "2018-08-10T20:04:22Z",
+        "2000-02-29T23:59:59Z", "2100-03-01T00:00:01Z",
+        "1969-12-31T23:59:59Z", "1600-01-01T00:00:00Z"
+    ])
+    def test_format_timestamp(self, timestamp):
+        assert format_timestamp(parse_timestamp(timestamp)) == timestamp
+
+
+class TestJumpFilter():
+
+    # 0.001 degrees of latitude are 111 meters
+    def _accepted(self, jump_filter, points):
+        window = JumpWindow()
+        return [jump_filter.accept(window, lat, 12.41039, epoch)
+                for epoch, lat in points]
+
+    def test_jump_is_dropped(self):
+        jump_filter = JumpFilter()
+        assert self._accepted(jump_filter, [
+            (0, 52.0), (10, 52.001), (20, 52.002), (30, 52.05),
+            (40, 52.004)]) == [True, True, True, False, True]
+        assert jump_filter.dropped == 1
+
+    def test_acceleration(self):
+        # 56 meters in 1 second from standstill
+        points = [(0, 52.0), (60, 52.0), (61, 52.0005)]
+        assert self._accepted(JumpFilter(), points) == [True, True, False]
+        assert self._accepted(JumpFilter(max_acceleration=60.0),
+                              points) == [True, True, True]
+
+    def test_max_speed(self):
+        points = [(0, 52.0), (1, 52.001)]
+        assert self._accepted(JumpFilter(), points) == [True, False]
+        assert self._accepted(JumpFilter(max_speed=120.0),
+                              points) == [True, True]
+
+    def test_relocation_is_accepted_after_max_dropped(self):
+        jump_filter = JumpFilter(max_dropped=2)
+        assert self._accepted(jump_filter, [
+            (0, 52.0), (10, 53.0), (20, 53.0), (30, 53.0),
+            (40, 53.001)]) == [True, False, False, True, True]
+        assert jump_filter.dropped == 2
+
+
+class TestFenwickTree():
+
+    def test_same_sums_as_list(self):
+        rng = random.Random(0)
+        values = [rng.randint(-100, 100) for _ in range(50)]
+        tree = FenwickTree(values[:20])
+        for value in values[20:]:
+            tree.append(value)
+        assert len(tree) == 50
+        assert tree.values() == values
+
+        for _ in range(200):
+            index = rng.randrange(50)
+            value = rng.randint(-100, 100)
+            values[index] += value
+            tree.add(index, value)
+            start, end = sorted(rng.sample(range(51), 2))
+            assert tree.range_sum(start, end) == sum(values[start:end])
+            assert tree.prefix_sum(end) == sum(values[:end])
+        assert tree.values() == values
+        assert tree.range_sum(10, 10) == 0
+        assert tree.range_sum(-5, 100) == sum(values)
+
+    def test_index_out_of_range(self):
+        tree = FenwickTree([1, 2])
+        with pytest.raises(IndexError):
+            tree.add(2, 1)
+        assert FenwickTree().prefix_sum(3) == 0
@@ -1,34 +1,214 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
 from unittest import TestCase
 from unittest.mock import patch
 from process import main
 import argparse
 
-from processor import WaypointListProcessor, WaypointStreamProcessor
+from benchmarks.generator import generate_waypoints
+from lib.geo import PyprojLibrary
+from lib.jumps import JumpFilter
+from processor import (WaypointListProcessor, WaypointStreamProcessor,
+                       VectorizedWaypointListProcessor,
+                       ParallelWaypointListProcessor,
+                       PartitionedWaypointListProcessor)
+from utils import (convert_data_to_waypoints, load_from_json_file,
+                   trip_format)
+from utils.formats import write_waypoints
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _arguments(**overrides) -> argparse.Namespace:
+    """
+    Return the parsed arguments of process.py, the defaults of the parser
+    for data/waypoints.json replaced by the given ones.
+    """
+    arguments = dict(list=False, stream=False, vectorized=False, workers=1,
+                     format=None, output_format='json', compression=None,
+                     flush_interval=1.0, profile=False, geo_backend=None,
+                     filter_jumps=False, distance_cache=None,
+                     batch_size=10000, partition_hours=None, rollup=None,
+                     source="data/waypoints.json")
+    arguments.update(overrides)
+    return argparse.Namespace(**arguments)
 
 
 class TestProcessMain(TestCase):
 
     @patch('argparse.ArgumentParser.parse_args',
-           return_value=argparse.Namespace(list=True, source="whatever"))
+           return_value=_arguments(list=True, source="whatever"))
     def test_process_with_invalid_source(self, mock_args):
         with self.assertRaises(SystemExit) as sys_ex:
             main()
         self.assertEqual(sys_ex.exception.code, 0)
 
     @patch('argparse.ArgumentParser.parse_args',
-           return_value=argparse.Namespace(list=False, stream=True,
-                                           source="data/waypoints.json"))
+           return_value=_arguments(stream=True))
     def test_stream_processer(self, mock_args):
-        with patch.object(WaypointStreamProcessor, 'process_waypoint',
+        with patch.object(WaypointStreamProcessor, 'process_batch',
                           return_value=[]) as mock_method:
             main()
         self.assertEqual(mock_method.called, True)
 
     @patch('argparse.ArgumentParser.parse_args',
-           return_value=argparse.Namespace(list=True, stream=False,
-                                           source="data/waypoints.json"))
+           return_value=_arguments(list=True))
     def test_list_processer(self, mock_args):
         with patch.object(WaypointListProcessor, 'get_trips',
                           return_value=[]) as mock_method:
             main()
         self.assertEqual(mock_method.called, True)
+
+    @patch('argparse.ArgumentParser.parse_args',
+           return_value=_arguments(list=True, vectorized=True))
+    def test_vectorized_list_processer(self, mock_args):
+        with patch.object(VectorizedWaypointListProcessor, 'get_trips',
+                          return_value=[]) as mock_method:
+            main()
+        self.assertEqual(mock_method.called, True)
+
+    @patch('argparse.ArgumentParser.parse_args',
+           return_value=_arguments(list=True, workers=4))
+    def test_parallel_list_processer(self, mock_args):
+        with patch.object(ParallelWaypointListProcessor, 'get_trips',
+                          return_value=[]) as mock_method:
+            main()
+        self.assertEqual(mock_method.called, True)
+
+    @patch('argparse.ArgumentParser.parse_args',
+           return_value=_arguments(list=True, workers=4, partition_hours=24))
+    def test_partitioned_list_processer(self, mock_args):
+        with patch.object(PartitionedWaypointListProcessor, 'iter_trips',
+                          return_value=iter([])) as mock_method:
+            main()
+        self.assertEqual(mock_method.called, True)
+
+    @patch('argparse.ArgumentParser.parse_args',
+           return_value=_arguments(stream=True, profile=True))
+    def test_profile(self, mock_args):
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                patch('sys.stdout', new_callable=io.StringIO):
+            main()
+        self.assertIn('geodesic calls', stderr.getvalue())
+        self.assertIn('distance', stderr.getvalue())
+
+    @patch('argparse.ArgumentParser.parse_args',
+           return_value=_arguments(list=True, workers=2, profile=True))
+    def test_profile_of_workers(self, mock_args):
+        trips = WaypointListProcessor(convert_data_to_waypoints(
+            load_from_json_file("data/waypoints.json"))).get_trips()
+        with patch.object(ParallelWaypointListProcessor, 'MIN_CHUNK_SIZE',
+                          20), \
+                patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                patch('sys.stdout', new_callable=io.StringIO):
+            main()
+        # the chunks are instrumented in the processes of the pool
+        self.assertIn('trips: %d,' % len(trips), stderr.getvalue())
+        self.assertNotIn('segments: 0,', stderr.getvalue())
+
+    def test_rollup(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rollup.json')
+            args = _arguments(list=True, output_format='ndjson',
+                              rollup=path)
+            with patch('argparse.ArgumentParser.parse_args',
+                       return_value=args), \
+                    patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                main()
+            with open(path) as _file:
+                rollup = json.load(_file)
+        trips = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(rollup[0]['months'][0]['trips'], len(trips))
+        self.assertAlmostEqual(rollup[0]['months'][0]['distance'], sum(
+            trip['distance'] for trip in trips))
+
+    def test_list_of_devices(self):
+        # the waypoints of the devices are interleaved, ordered by timestamp
+        waypoints = convert_data_to_waypoints(
+            generate_waypoints(6000, devices=3))
+        self.assertNotEqual([waypoint.device_id for waypoint in waypoints],
+                            sorted(waypoint.device_id
+                                   for waypoint in waypoints))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'devices.json')
+            write_waypoints(waypoints, path)
+            for filter_jumps in (False, True):
+                expected = []
+                # the devices in the order of their first waypoint
+                for device_id in OrderedDict.fromkeys(
+                        waypoint.device_id for waypoint in waypoints):
+                    expected.extend(map(trip_format, WaypointListProcessor(
+                        [waypoint for waypoint in waypoints
+                         if waypoint.device_id == device_id],
+                        jump_filter=JumpFilter() if filter_jumps else None
+                    ).get_trips()))
+                for workers in (1, 2):
+                    args = _arguments(list=True, workers=workers,
+                                      filter_jumps=filter_jumps,
+                                      output_format='ndjson', source=path)
+                    with patch('argparse.ArgumentParser.parse_args',
+                               return_value=args), \
+                            patch('sys.stdout',
+                                  new_callable=io.StringIO) as stdout:
+                        main()
+                    trips = [json.loads(line) for line in
+                             stdout.getvalue().splitlines()]
+                    self.assertEqual(trips, expected)
+        self.assertGreater(len(expected), 50)
+
+    def test_stream_of_devices(self):
+        waypoints = convert_data_to_waypoints(
+            generate_waypoints(6000, devices=3))
+        devices = {(waypoint.timestamp, waypoint.lat, waypoint.lng):
+                   waypoint.device_id for waypoint in waypoints}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'devices.ndjson')
+            write_waypoints(waypoints, path)
+            args = _arguments(stream=True, output_format='ndjson',
+                              source=path)
+            with patch('argparse.ArgumentParser.parse_args',
+                       return_value=args), \
+                    patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                main()
+        trips = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertGreater(len(trips), 50)
+        for trip in trips:
+            # no trip starts on one device and ends on another
+            self.assertEqual(
+                devices[trip['start']['timestamp'], trip['start']['lat'],
+                        trip['start']['lng']],
+                devices[trip['end']['timestamp'], trip['end']['lat'],
+                        trip['end']['lng']])
+
+    @patch('argparse.ArgumentParser.parse_args',
+           return_value=_arguments(list=True, geo_backend='pyproj'))
+    def test_geo_backend(self, mock_args):
+        with patch.object(PyprojLibrary, 'compute_distance_in_meters',
+                          return_value=20.0) as mock_method, \
+                patch('sys.stdout', new_callable=io.StringIO):
+            main()
+        self.assertEqual(mock_method.called, True)
+
+
+class TestStartup(TestCase):
+    # time a new interpreter takes to import process.py
+    IMPORT_TIME_BUDGET_SECONDS = 0.3
+
+    def test_import_time(self):
+        result = subprocess.run(
+            [sys.executable, '-c',
+             'import sys, time; start = time.perf_counter(); import process; '
+             'print(time.perf_counter() - start); '
+             'print(" ".join(sorted(set(sys.modules) & '
+             '{"geopy", "pyproj", "numba", "multiprocessing"})))'],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        seconds, modules = result.stdout.split('\n')[:2]
+        # the backends are only imported when they are used
+        self.assertEqual(modules.strip(), '')
+        self.assertLess(float(seconds), self.IMPORT_TIME_BUDGET_SECONDS)
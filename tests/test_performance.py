@@ -0,0 +1,106 @@
+import json
+import os
+import time
+import tracemalloc
+
+import pytest
+from instrumentation import CountingGeoLibrary
+from lib.geo import create_geo_library
+from lib.timestamp import format_timestamp
+from processor import (VectorizedWaypointListProcessor, WaypointBatch,
+                       WaypointListProcessor, WaypointStreamProcessor)
+from tests.conftest import PERFORMANCE_VARIABLE
+from utils import load_from_json_file, convert_data_to_waypoints
+
+# skipped unless PERFORMANCE_THRESHOLDS gives the path of the thresholds,
+# tests/performance.json or the ones of another machine, e.g. a slower CI
+# runner, see conftest.py
+pytestmark = pytest.mark.performance
+
+CONFIG_PATH = os.environ.get(PERFORMANCE_VARIABLE) or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'performance.json')
+
+with open(CONFIG_PATH) as _file:
+    CONFIG = json.load(_file)
+
+
+def _scaled_waypoints(scale: int):
+    """
+    Return the waypoints of data/waypoints.json repeated scale times, every
+    copy an hour after the previous one ends.
+    """
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+    span = waypoints[-1].epoch - waypoints[0].epoch + 3600
+    scaled = []
+    for copy in range(scale):
+        for waypoint in waypoints:
+            epoch = waypoint.epoch + copy * span
+            scaled.append(waypoint._replace(
+                timestamp=format_timestamp(epoch), epoch=epoch))
+    return scaled
+
+
+def _run(name: str, waypoints, geo_library) -> list:
+    if name == 'list':
+        return WaypointListProcessor(waypoints, geo_library).get_trips()
+    if name == 'vectorized':
+        return VectorizedWaypointListProcessor(
+            waypoints, geo_library=geo_library).get_trips()
+    stream_processor = WaypointStreamProcessor(geo_library)
+    if name == 'stream':
+        trips = map(stream_processor.process_waypoint, waypoints)
+    else:
+        trips = (trip for batch in WaypointBatch.iter_batches(
+            waypoints, CONFIG['batch_size'])
+            for trip in stream_processor.process_batch(batch))
+    return [trip for trip in trips if trip is not None]
+
+
+def _geo_library(name: str) -> CountingGeoLibrary:
+    return CountingGeoLibrary(create_geo_library(
+        CONFIG['processors'][name]['geo_backend']))
+
+
+@pytest.fixture(scope='module')
+def waypoints():
+    return _scaled_waypoints(CONFIG['scale'])
+
+
+@pytest.mark.parametrize("name", sorted(CONFIG['processors']))
+class TestPerformance:
+    """
+    Thresholds of the processors over the bundled waypoints, scaled up, from
+    tests/performance.json.
+    """
+
+    def test_points_per_second(self, name, waypoints):
+        minimum = CONFIG['processors'][name]['min_points_per_second']
+        best = 0
+        for _ in range(CONFIG['repeat']):
+            start = time.perf_counter()
+            _run(name, waypoints, _geo_library(name))
+            best = max(best, len(waypoints) / (time.perf_counter() - start))
+            if best >= minimum:
+                break
+        assert best >= minimum
+
+    def test_peak_memory(self, name, waypoints):
+        # tracemalloc slows down the many allocations of geopy tenfold, the
+        # memory of the processors does not depend on the library
+        geo_library = create_geo_library(CONFIG['memory_geo_backend'])
+        # lazy imports, like the one of the compiled kernel, are done before
+        _run(name, waypoints[:1000], geo_library)
+        tracemalloc.start()
+        try:
+            _run(name, waypoints, geo_library)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak <= CONFIG['processors'][name]['max_peak_memory_bytes']
+
+    def test_geodesic_calls(self, name, waypoints):
+        geo_library = _geo_library(name)
+        _run(name, waypoints, geo_library)
+        assert geo_library.distances / len(waypoints) <= \
+            CONFIG['processors'][name]['max_geodesic_calls_per_point']
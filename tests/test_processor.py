@@ -1,8 +1,21 @@
+import pickle
+
+import numpy as np
 import pytest
-from processor import (WaypointListProcessor, Waypoint,
-                       Trip, WaypointStreamProcessor)
+import processor
+from processor import (WaypointListProcessor, Waypoint, FleetStreamProcessor,
+                       Trip, WaypointStreamProcessor, WaypointBatch,
+                       ParallelWaypointListProcessor, TripExtractor,
+                       PartitionedWaypointListProcessor,
+                       VectorizedWaypointListProcessor)
+from benchmarks.generator import generate_waypoints
 from tests.fixtures import (FixtureTestWaypointStreamProcessor,
                             FixtureTestWaypointListProcessor)
+from utils import load_from_json_file, convert_data_to_waypoints
+from lib import kernel
+from lib.jumps import JumpFilter
+from lib.geo import NumpyLibrary, PyprojLibrary
+from lib.timestamp import format_timestamp, parse_timestamp
 
 
 class TestWaypointListProcessor(FixtureTestWaypointListProcessor):
@@ -156,3 +169,520 @@ class TestWaypointStreamProcessor(FixtureTestWaypointStreamProcessor):
                  end=Waypoint(timestamp='2018-08-10T20:31:22Z',
                               lat=60.54987, lng=12.41039)
                  )]
+
+
+class TestTripExtractor(FixtureTestWaypointStreamProcessor):
+
+    def test_flush_ends_open_trip(self):
+        waypoints = self.waypoints_stream_with_two_trips[:-1]
+        stream_processor = WaypointStreamProcessor()
+        trips = list(filter(None, map(stream_processor.process_waypoint,
+                                      waypoints)))
+        trips.append(stream_processor.flush())
+        assert trips == WaypointListProcessor(waypoints).get_trips()
+        assert stream_processor.flush() is None
+
+    def test_state_continues_extraction(self):
+        waypoints = self.waypoints_stream_with_two_trips
+        extractor = TripExtractor()
+        trips = [extractor.process_segment(waypoints[0], waypoints[1], 10.0)]
+        extractor = TripExtractor(extractor.state)
+        trips.extend(
+            extractor.process_segment(current_point, next_point, 10.0)
+            for current_point, next_point in zip(waypoints[1:],
+                                                 waypoints[2:]))
+        assert list(filter(None, trips)) == [
+            Trip(60.0, waypoints[1], waypoints[5]),
+            Trip(30.0, waypoints[6], waypoints[8])]
+
+    @pytest.mark.parametrize("seed", range(8))
+    def test_list_and_stream_give_same_trips(self, seed):
+        waypoints = convert_data_to_waypoints(
+            generate_waypoints(2000 + seed * 500, devices=1, seed=seed))
+        geo_library = PyprojLibrary()
+        expected = WaypointListProcessor(waypoints, geo_library).get_trips()
+        assert expected
+
+        stream_processor = WaypointStreamProcessor(geo_library)
+        trips = [trip for trip in map(stream_processor.process_waypoint,
+                                      waypoints) if trip is not None]
+        trips.append(stream_processor.flush())
+        assert list(filter(None, trips)) == expected
+
+        fleet_processor = FleetStreamProcessor(geo_library=geo_library)
+        trips = []
+        for waypoint in waypoints:
+            trips.extend(fleet_processor.process_waypoint(waypoint))
+        assert trips + fleet_processor.flush() == expected
+
+    @pytest.mark.parametrize("seed", range(2))
+    def test_jump_filter(self, seed):
+        waypoints = convert_data_to_waypoints(
+            generate_waypoints(5000, devices=1, seed=seed))
+        jump_filter = JumpFilter()
+        list_processor = VectorizedWaypointListProcessor(
+            WaypointBatch.from_waypoints(waypoints), jump_filter=jump_filter)
+        expected = list_processor.get_trips()
+        dropped = jump_filter.dropped
+        assert dropped > 0
+        assert sum(trip.distance for trip in expected) < sum(
+            trip.distance for trip in VectorizedWaypointListProcessor(
+                waypoints).get_trips())
+
+        # the trips are the same without the jumps
+        batch_points = set(list_processor._waypoints)
+        kept = [waypoint for waypoint in waypoints
+                if waypoint in batch_points]
+        assert VectorizedWaypointListProcessor(kept).get_trips() == expected
+
+        stream_processor = WaypointStreamProcessor(NumpyLibrary(),
+                                                   JumpFilter())
+        trips = [trip for trip in map(stream_processor.process_waypoint,
+                                      waypoints) if trip is not None]
+        trips.append(stream_processor.flush())
+        assert list(filter(None, trips)) == expected
+        assert stream_processor.jump_filter.dropped == dropped
+
+    def _processor_trips(self, stop_time_in_minutes, min_distance):
+        """
+        Return the trips of data/waypoints.json of every processor, with the
+        thresholds of the processors overridden by subclasses.
+        """
+        thresholds = {'STOP_TIME_IN_MINTUES': stop_time_in_minutes,
+                      'DISTANCE_SHOULD_BE_IGNORED_METERS': min_distance}
+        list_class = type('ListProcessor', (WaypointListProcessor,),
+                          thresholds)
+        vectorized_class = type('VectorizedProcessor', (
+            VectorizedWaypointListProcessor,), thresholds)
+        stream_class = type('StreamProcessor', (WaypointStreamProcessor,),
+                            thresholds)
+        waypoints = convert_data_to_waypoints(
+            load_from_json_file("data/waypoints.json"))
+        batch = WaypointBatch.from_waypoints(waypoints)
+
+        parallel_processor = ParallelWaypointListProcessor(
+            batch, processor_class=list_class)
+        parallel_processor.MIN_CHUNK_SIZE = 20
+        stream_processor = stream_class()
+        stream_trips = [trip for trip in map(
+            stream_processor.process_waypoint, waypoints) if trip]
+        return {
+            'list': list_class(waypoints).get_trips(),
+            'batch': list_class(batch).get_trips(),
+            'vectorized': vectorized_class(batch).get_trips(),
+            'parallel': parallel_processor.get_trips(),
+            'stream': list(filter(None, stream_trips + [
+                stream_processor.flush()])),
+            'stream batch': stream_class().process_batch(batch),
+        }
+
+    def test_thresholds_of_processors(self):
+        trips = self._processor_trips(30, 100000)
+        assert not any(trips.values())
+
+        trips = self._processor_trips(30, 15)
+        assert len(trips['list']) == 4
+        for name in ('batch', 'parallel', 'stream'):
+            assert trips[name] == trips['list'], name
+        assert len(trips['vectorized']) == 4
+        # the last trip of the stream is still open
+        assert trips['stream batch'] == trips['list'][:-1]
+
+    def test_stop_time_of_processors(self):
+        stop_points = [Waypoint("2018-08-10T20:04:22Z", 51.54987, 12.41039),
+                       Waypoint("2018-08-10T20:10:22Z", 51.54987, 12.41039)]
+        thresholds = {'STOP_TIME_IN_MINTUES': 30}
+        for trip_processor in (
+                type('ListProcessor', (WaypointListProcessor,),
+                     thresholds)([]),
+                type('StreamProcessor', (WaypointStreamProcessor,),
+                     thresholds)()):
+            assert not trip_processor._car_trip_has_ended(stop_points)
+
+
+class TestStreamBatches():
+
+    waypoints = convert_data_to_waypoints(
+        generate_waypoints(6000, devices=1, seed=4))
+
+    def _expected(self, jump_filter=None):
+        stream_processor = WaypointStreamProcessor(PyprojLibrary(),
+                                                   jump_filter)
+        trips = [trip for trip in map(stream_processor.process_waypoint,
+                                      self.waypoints) if trip is not None]
+        return trips, stream_processor.state
+
+    def _batch_trips(self, size, jump_filter=None):
+        stream_processor = WaypointStreamProcessor(PyprojLibrary(),
+                                                   jump_filter)
+        trips = []
+        for batch in WaypointBatch.iter_batches(self.waypoints, size):
+            trips.extend(stream_processor.process_batch(batch))
+        return trips, stream_processor.state
+
+    @pytest.mark.parametrize("size", [1, 150, 1000, 6000])
+    def test_batches_match_waypoints(self, size):
+        expected, expected_state = self._expected()
+        assert expected
+        trips, state = self._batch_trips(size)
+        assert trips == expected
+        assert state.state == expected_state.state
+        assert state.previous_point == expected_state.previous_point
+
+    def test_batches_without_kernel(self, monkeypatch):
+        monkeypatch.setattr(processor, '_kernel',
+                            lambda extractor_class=None: None)
+        assert self._batch_trips(1000)[0] == self._expected()[0]
+
+    def test_jump_filter(self):
+        jump_filter = JumpFilter()
+        trips, _ = self._batch_trips(1000, jump_filter)
+        assert jump_filter.dropped > 0
+        assert trips == self._expected(JumpFilter())[0]
+
+    @pytest.mark.parametrize("size", [150, 3000])
+    def test_lists_keep_device_ids(self, size):
+        waypoints = [waypoint._replace(device_id='car7')
+                     for waypoint in self.waypoints[:3000]]
+        for jump_filter in (None, JumpFilter()):
+            stream_processor = WaypointStreamProcessor(PyprojLibrary(),
+                                                       jump_filter)
+            expected = [trip for trip in map(
+                stream_processor.process_waypoint, waypoints) if trip]
+            assert expected
+
+            stream_processor = WaypointStreamProcessor(
+                PyprojLibrary(), jump_filter and JumpFilter())
+            trips = []
+            for start in range(0, len(waypoints), size):
+                trips.extend(stream_processor.process_batch(
+                    iter(waypoints[start:start + size])))
+            assert trips == expected
+            assert stream_processor.state.previous_point.device_id == 'car7'
+
+    def test_iter_batches(self):
+        batches = list(WaypointBatch.iter_batches(
+            iter(self.waypoints), 2500))
+        assert [len(batch) for batch in batches] == [2500, 2500, 1000]
+        assert [len(batch) for batch in WaypointBatch.iter_batches(
+            batches[0], 1000)] == [1000, 1000, 500]
+        assert list(batches[2]) == self.waypoints[5000:]
+
+
+class TestKernel():
+
+    def _batch(self, seed):
+        return WaypointBatch.from_waypoints(convert_data_to_waypoints(
+            generate_waypoints(3000, devices=1, seed=seed)))
+
+    def _extract_trips(self, waypoints, use_kernel, state=None):
+        processor = VectorizedWaypointListProcessor(waypoints)
+        processor.use_kernel = use_kernel
+        return processor._extract_trips(waypoints[-1], state)
+
+    @pytest.mark.parametrize("seed", range(4))
+    def test_kernel_matches_extractor(self, seed):
+        waypoints = self._batch(seed)
+        trips, state = self._extract_trips(waypoints, True)
+        assert trips
+        assert (trips, state) == self._extract_trips(waypoints, False)
+
+        # continue from a state of points at the start of the batch
+        first_point = waypoints[1000]
+        state = (first_point, first_point, None, None, 0.0)
+        assert self._extract_trips(waypoints[1000:], True, state) == \
+            self._extract_trips(waypoints[1000:], False, state)
+        state = (first_point, first_point, first_point, None, 20.0)
+        assert self._extract_trips(waypoints[1000:], True, state) == \
+            self._extract_trips(waypoints[1000:], False, state)
+
+    def test_state_of_earlier_points(self):
+        waypoints = self._batch(0)
+        _, state = self._extract_trips(waypoints[:1500], False)
+        assert self._extract_trips(waypoints[1499:], True, state) == \
+            self._extract_trips(waypoints[1499:], False, state)
+
+    def test_parallel_batch_matches_serial(self):
+        waypoints = self._batch(1)
+        processor = ParallelWaypointListProcessor(
+            waypoints, processor_class=VectorizedWaypointListProcessor)
+        processor.MIN_CHUNK_SIZE = 500
+        assert processor.get_trips() == VectorizedWaypointListProcessor(
+            waypoints).get_trips()
+
+    @pytest.mark.skipif(not kernel.KERNEL_AVAILABLE,
+                        reason="Numba is not installed")
+    def test_python_kernel_matches_compiled(self):
+        waypoints = self._batch(2)
+        distances = np.zeros(len(waypoints))
+        distances[1:] = VectorizedWaypointListProcessor(
+            waypoints)._segment_distances()
+        arguments = (np.asarray(waypoints.epochs), np.asarray(waypoints.lats),
+                     np.asarray(waypoints.lngs), distances, 0,
+                     np.full(4, kernel.NONE, np.int64), 0.0, 0, 0.0, 0.0,
+                     False, 180, 15)
+        expected = kernel.compiled_extract_trips(*arguments)
+        result = kernel.extract_trips(*arguments)
+        assert len(result[0]) > 0
+        for column, expected_column in zip(result, expected):
+            np.testing.assert_array_equal(column, expected_column)
+
+
+class TestFleetStreamProcessor(FixtureTestWaypointStreamProcessor):
+
+    def _stream_trips(self, waypoints):
+        stream_processor = WaypointStreamProcessor()
+        return [trip for trip in map(stream_processor.process_waypoint,
+                                     waypoints) if trip is not None]
+
+    def test_interleaved_devices(self):
+        first = [waypoint._replace(device_id='first') for waypoint in
+                 self.waypoints_stream_with_two_trips]
+        second = [waypoint._replace(device_id='second') for waypoint in
+                  self.waypoints_stream_starts_with_not_moving_points]
+        interleaved = sorted(first + second,
+                             key=lambda waypoint: waypoint.timestamp)
+
+        fleet_processor = FleetStreamProcessor()
+        trips = []
+        for waypoint in interleaved:
+            trips.extend(fleet_processor.process_waypoint(waypoint))
+
+        assert len(fleet_processor) == 2
+        assert sorted(trips) == sorted(
+            self._stream_trips(first) + self._stream_trips(second))
+        assert sorted(trip.start.device_id for trip in trips) == [
+            'first', 'first', 'second']
+
+    def test_idle_device_is_evicted_with_open_trip(self):
+        fleet_processor = FleetStreamProcessor(idle_timeout_in_minutes=10)
+        for waypoint in self.waypoints_stream_with_one_trip[:3]:
+            assert fleet_processor.process_waypoint(
+                waypoint._replace(device_id='idle')) == []
+
+        trips = fleet_processor.process_waypoint(
+            Waypoint("2018-08-10T20:27:22Z", 1.0, 1.0, device_id='other'))
+        assert len(fleet_processor) == 1
+        assert trips == [
+            Trip(distance=556802.412,
+                 start=Waypoint(timestamp='2018-08-10T20:10:22Z',
+                                lat=54.54987, lng=12.41039,
+                                device_id='idle'),
+                 end=Waypoint(timestamp='2018-08-10T20:16:22Z',
+                              lat=59.54987, lng=12.41039,
+                              device_id='idle'))]
+
+    def test_max_devices(self):
+        fleet_processor = FleetStreamProcessor(max_devices=2)
+        for device_id in range(5):
+            fleet_processor.process_waypoint(
+                Waypoint("2018-08-10T20:10:22Z", 1.0, 1.0,
+                         device_id=device_id))
+        assert len(fleet_processor) == 2
+        assert fleet_processor.flush() == []
+        assert len(fleet_processor) == 0
+
+
+class TestParallelWaypointListProcessor(FixtureTestWaypointListProcessor):
+
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+
+    parked_waypoints = [
+        Waypoint("2018-08-10T19:50:22Z", 52.54987, 12.41039),
+        Waypoint("2018-08-10T19:55:22Z", 52.54987, 12.41039),
+        Waypoint("2018-08-10T20:00:22Z", 52.54987, 12.41039),
+    ] + FixtureTestWaypointListProcessor \
+        .waypoints_list_starts_with_not_moving_points
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 20, 10000])
+    def test_same_trips_as_serial_run(self, monkeypatch, chunk_size):
+        monkeypatch.setattr(ParallelWaypointListProcessor,
+                            'MIN_CHUNK_SIZE', chunk_size)
+        for waypoints in (self.waypoints, self.parked_waypoints,
+                          self.waypoints_list_with_two_trips):
+            list_processor = ParallelWaypointListProcessor(waypoints)
+            assert list_processor.get_trips() == WaypointListProcessor(
+                waypoints).get_trips()
+
+    def test_process_pool(self, monkeypatch):
+        monkeypatch.setattr(ParallelWaypointListProcessor,
+                            'MIN_CHUNK_SIZE', 10)
+        list_processor = ParallelWaypointListProcessor(
+            self.waypoints, workers=2)
+        assert len(list_processor._split()) > 2
+        assert list_processor.get_trips() == WaypointListProcessor(
+            self.waypoints).get_trips()
+
+    def test_devices_are_cut(self, monkeypatch):
+        monkeypatch.setattr(ParallelWaypointListProcessor,
+                            'MIN_CHUNK_SIZE', 3)
+        first = [waypoint._replace(device_id=1)
+                 for waypoint in self.waypoints_list_without_stoping_point]
+        second = [waypoint._replace(device_id=2)
+                  for waypoint in self.waypoints_list_with_two_trips]
+        list_processor = ParallelWaypointListProcessor(first + second)
+        assert list_processor.get_trips() == \
+            WaypointListProcessor(first).get_trips() + \
+            WaypointListProcessor(second).get_trips()
+
+    def test_empty_list(self):
+        assert ParallelWaypointListProcessor([]).get_trips() == []
+
+    def test_cuts_at_parked_heartbeats(self, monkeypatch):
+        # heartbeats every minute while parked, none of the gaps is a stop
+        # on its own
+        monkeypatch.setattr(ParallelWaypointListProcessor,
+                            'MIN_CHUNK_SIZE', 1000)
+        waypoints = WaypointBatch.from_waypoints(
+            convert_data_to_waypoints(generate_waypoints(20000)))
+        chunks = ParallelWaypointListProcessor(waypoints, workers=5)._split()
+        assert len(chunks) == 20
+        for start, _, _, state in chunks[1:]:
+            # the state of a serial run at the start of the chunk
+            assert state == VectorizedWaypointListProcessor(
+                waypoints[:start + 1])._extract_trips(waypoints[-1])[1]
+        assert ParallelWaypointListProcessor(
+            waypoints, processor_class=VectorizedWaypointListProcessor
+        ).get_trips() == VectorizedWaypointListProcessor(
+            waypoints).get_trips()
+
+
+class TestPartitionedWaypointListProcessor(FixtureTestWaypointListProcessor):
+
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+
+    def _archive(self, days: int):
+        # the trips of every evening, the car is parked over night and the
+        # next morning it is seen where it stopped
+        archive = []
+        for day in range(days):
+            for waypoint in ([self.waypoints_list_with_two_trips[-1]._replace(
+                    timestamp="2018-08-10T06:00:00Z")] +
+                    self.waypoints_list_with_two_trips):
+                epoch = parse_timestamp(waypoint.timestamp) + day * 86400
+                archive.append(Waypoint(format_timestamp(epoch), waypoint.lat,
+                                        waypoint.lng, epoch))
+        return archive
+
+    @pytest.mark.parametrize("partition_seconds", [60, 600, 3600, 86400])
+    def test_same_trips_as_serial_run(self, partition_seconds):
+        for waypoints in (self.waypoints, self.waypoints_list_with_two_trips,
+                          self._archive(5)):
+            list_processor = PartitionedWaypointListProcessor(
+                waypoints, partition_seconds=partition_seconds)
+            assert list_processor.get_trips() == WaypointListProcessor(
+                waypoints).get_trips()
+
+    def test_cuts_at_night(self):
+        archive = self._archive(4)
+        chunks = PartitionedWaypointListProcessor(archive)._split()
+        assert [archive[start].timestamp for start, _, _, _ in chunks] == [
+            "2018-08-10T06:00:00Z", "2018-08-11T06:00:00Z",
+            "2018-08-12T06:00:00Z", "2018-08-13T06:00:00Z"]
+        assert all(state is not None for _, _, _, state in chunks)
+
+    def test_stream_of_trips(self):
+        archive = self._archive(3)
+        list_processor = PartitionedWaypointListProcessor(archive, workers=2)
+        trips = list_processor.iter_trips()
+        assert next(trips) == WaypointListProcessor(archive).get_trips()[0]
+        assert [next(trips)] + list(trips) == WaypointListProcessor(
+            archive).get_trips()[1:]
+
+    def test_devices_are_cut(self):
+        first = [waypoint._replace(device_id=1)
+                 for waypoint in self._archive(2)]
+        second = [waypoint._replace(device_id=2)
+                  for waypoint in self.waypoints]
+        list_processor = PartitionedWaypointListProcessor(first + second)
+        assert list_processor.get_trips() == \
+            WaypointListProcessor(first).get_trips() + \
+            WaypointListProcessor(second).get_trips()
+
+    def test_empty_list(self):
+        assert list(PartitionedWaypointListProcessor([]).iter_trips()) == []
+
+
+class TestWaypointBatch(FixtureTestWaypointListProcessor):
+
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+
+    def test_waypoint_views(self):
+        batch = WaypointBatch.from_waypoints(iter(self.waypoints))
+        assert len(batch) == len(self.waypoints)
+        assert batch[0] == self.waypoints[0]
+        assert batch[-1] == self.waypoints[-1]
+        assert list(batch) == self.waypoints
+        assert batch.nbytes == 24 * len(batch)
+
+    def test_slices_share_columns(self):
+        batch = WaypointBatch.from_waypoints(self.waypoints)
+        view = batch[1:]
+        assert view.epochs.obj is batch.epochs.obj
+        assert list(view) == self.waypoints[1:]
+
+    def test_numpy_columns(self):
+        batch = WaypointBatch(np.array([1533931462, 1533931522]),
+                              np.array([52.54987, 52.54991]),
+                              np.array([12.41039, 12.41036]))
+        assert list(batch) == [
+            Waypoint("2018-08-10T20:04:22Z", 52.54987, 12.41039, 1533931462),
+            Waypoint("2018-08-10T20:05:22Z", 52.54991, 12.41036, 1533931522)]
+
+    def test_different_column_lengths(self):
+        with pytest.raises(ValueError):
+            WaypointBatch([1, 2], [1.0], [1.0])
+
+    def test_pickle(self):
+        batch = WaypointBatch.from_waypoints(self.waypoints)[10:20]
+        assert list(pickle.loads(pickle.dumps(batch))) == \
+            self.waypoints[10:20]
+
+    @pytest.mark.parametrize("processor_class", [
+        WaypointListProcessor, VectorizedWaypointListProcessor,
+        ParallelWaypointListProcessor])
+    def test_list_processors(self, processor_class):
+        for waypoints in (self.waypoints, self.waypoints_list_with_two_trips):
+            batch = WaypointBatch.from_waypoints(waypoints)
+            assert processor_class(batch).get_trips() == processor_class(
+                list(batch)).get_trips()
+
+
+class TestGeoLibraryArgument(FixtureTestWaypointStreamProcessor):
+
+    waypoints = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+
+    def _assert_same_trips(self, trips, expected):
+        assert [(trip.start, trip.end) for trip in trips] == [
+            (trip.start, trip.end) for trip in expected]
+        assert [trip.distance for trip in trips] == pytest.approx(
+            [trip.distance for trip in expected], abs=1e-2)
+
+    @pytest.mark.parametrize("processor_class", [
+        WaypointListProcessor, VectorizedWaypointListProcessor,
+        ParallelWaypointListProcessor])
+    def test_list_processors(self, processor_class):
+        self._assert_same_trips(
+            processor_class(self.waypoints,
+                            geo_library=PyprojLibrary()).get_trips(),
+            WaypointListProcessor(self.waypoints).get_trips())
+
+    def test_stream_processor(self):
+        stream_processor = WaypointStreamProcessor(PyprojLibrary())
+        expected_processor = WaypointStreamProcessor()
+        for waypoint in self.waypoints_stream_with_two_trips:
+            trip = stream_processor.process_waypoint(waypoint)
+            expected = expected_processor.process_waypoint(waypoint)
+            self._assert_same_trips(filter(None, [trip]),
+                                    filter(None, [expected]))
+
+    def test_prefilter_counters(self):
+        list_processor = WaypointListProcessor(self.waypoints)
+        list_processor.get_trips()
+        prefilter = list_processor.prefilter
+        assert prefilter.avoided > 0
+        assert prefilter.avoided + prefilter.exact == len(self.waypoints) - 1
@@ -0,0 +1,171 @@
+import asyncio
+import json
+
+from benchmarks.generator import generate_waypoints
+from benchmarks.loadgen import run_load
+from lib.geo import PyprojLibrary
+from processor import FleetStreamProcessor, WaypointStreamProcessor
+from server import TripServer
+from tests.fixtures import FixtureTestWaypointStreamProcessor
+from utils import (load_from_json_file, convert_data_to_waypoints,
+                   trip_format, trip_waypoint_format)
+
+
+class TestTripServer():
+
+    data_points = load_from_json_file("data/waypoints.json")
+
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def _expected_trips(self):
+        stream_processor = WaypointStreamProcessor(PyprojLibrary())
+        return trip_waypoint_format(filter(None, map(
+            stream_processor.process_waypoint,
+            convert_data_to_waypoints(self.data_points))))
+
+    async def _wait_for_connections(self, server, connections):
+        while server.connections < connections:
+            await asyncio.sleep(0.01)
+
+    async def _read_lines(self, reader):
+        lines = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                return lines
+            lines.append(json.loads(line))
+
+    async def _subscribe(self, path):
+        """
+        Subscribe to the trips of the server listening on the Unix socket
+        and return the future of the trips it delivers until it closes.
+        """
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b'{"subscribe": true}\n')
+        await writer.drain()
+
+        async def read_trips():
+            trips = await self._read_lines(reader)
+            writer.close()
+            return trips
+
+        trips = asyncio.ensure_future(read_trips())
+        # the subscription is registered before waypoints arrive
+        await asyncio.sleep(0.05)
+        return trips
+
+    def test_unix_socket_trips_are_drained_on_close(self, tmp_path):
+        path = str(tmp_path / "trips.sock")
+
+        async def scenario():
+            server = TripServer(queue_size=2)
+            await server.start_unix(path)
+            trips = await self._subscribe(path)
+
+            _, writer = await asyncio.open_unix_connection(path)
+            for point in self.data_points:
+                writer.write(json.dumps(point).encode() + b'\n')
+            writer.write_eof()
+            await self._wait_for_connections(server, 2)
+            await server.close()
+            return server, await trips
+
+        server, trips = self._run(scenario())
+        assert server.waypoints == len(self.data_points)
+        assert trips == self._expected_trips()
+
+    def test_tcp_invalid_waypoint(self):
+        async def scenario():
+            server = TripServer()
+            tcp_server = await server.start_tcp('127.0.0.1', 0)
+            port = tcp_server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'{"lat": 1.0}\nnot json\n')
+            writer.write(json.dumps(self.data_points[0]).encode() + b'\n')
+            writer.write_eof()
+            lines = await self._read_lines(reader)
+            await server.close()
+            return server, lines
+
+        server, lines = self._run(scenario())
+        assert len(lines) == 2
+        assert all('error' in line for line in lines)
+        assert server.waypoints == 1
+
+    def test_load_generator(self, tmp_path):
+        path = str(tmp_path / "trips.sock")
+
+        async def scenario():
+            server = TripServer(queue_size=10)
+            await server.start_unix(path)
+            trips = await self._subscribe(path)
+            load = asyncio.ensure_future(run_load(
+                2000, devices=5, unix=path, batch_size=100))
+            await self._wait_for_connections(server, 2)
+            result = await load
+            await server.close()
+            return server, result, await trips
+
+        server, result, trips = self._run(scenario())
+        assert result['points'] == 2000
+        assert server.waypoints == 2000
+        fleet_processor = FleetStreamProcessor(geo_library=PyprojLibrary())
+        expected = [
+            dict(trip_format(trip), device_id=trip.start.device_id)
+            for waypoint in convert_data_to_waypoints(
+                generate_waypoints(2000, devices=5))
+            for trip in fleet_processor.process_waypoint(waypoint)]
+        assert len({trip['device_id'] for trip in trips}) > 1
+        assert trips == expected
+
+    def test_open_trip_of_idle_device(self, tmp_path):
+        path = str(tmp_path / "trips.sock")
+        moving = FixtureTestWaypointStreamProcessor \
+            .waypoints_stream_with_one_trip[:3]
+
+        async def scenario():
+            server = TripServer(idle_timeout_in_minutes=10)
+            await server.start_unix(path)
+            trips = await self._subscribe(path)
+            _, writer = await asyncio.open_unix_connection(path)
+            for waypoint in moving:
+                writer.write(json.dumps(dict(
+                    timestamp=waypoint.timestamp, lat=waypoint.lat,
+                    lng=waypoint.lng, device_id='silent')).encode() + b'\n')
+            # another device an hour later
+            writer.write(json.dumps(dict(
+                timestamp="2018-08-10T21:30:00Z", lat=1.0, lng=1.0,
+                device_id='other')).encode() + b'\n')
+            writer.write_eof()
+            await self._wait_for_connections(server, 2)
+            await server.close()
+            return await trips
+
+        trips = self._run(scenario())
+        stream_processor = WaypointStreamProcessor(PyprojLibrary())
+        for waypoint in moving:
+            stream_processor.process_waypoint(waypoint)
+        expected = trip_format(stream_processor.flush())
+        assert trips == [dict(expected, device_id='silent')]
+
+    def test_close_stops_reading_after_timeout(self, tmp_path):
+        path = str(tmp_path / "trips.sock")
+
+        async def scenario():
+            server = TripServer()
+            await server.start_unix(path)
+            _, writer = await asyncio.open_unix_connection(path)
+            writer.write(json.dumps(self.data_points[0]).encode() + b'\n')
+            await writer.drain()
+            await self._wait_for_connections(server, 1)
+            # the client never finishes sending
+            await asyncio.wait_for(server.close(timeout=0.1), 5)
+            return server
+
+        server = self._run(scenario())
+        assert server.waypoints == 1
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from benchmarks.generator import generate_waypoints
+from lib.geo import PyprojLibrary
+from processor import FleetStreamProcessor
+from trip_store import TripStore
+from utils import convert_data_to_waypoints
+from utils.formats import read_trips, write_trips
+
+
+@pytest.fixture(scope='module')
+def trips():
+    fleet_processor = FleetStreamProcessor(geo_library=PyprojLibrary())
+    trips = []
+    for waypoint in convert_data_to_waypoints(
+            generate_waypoints(40000, devices=20, seed=1)):
+        trips.extend(fleet_processor.process_waypoint(waypoint))
+    return trips + fleet_processor.flush()
+
+
+class TestTripStore:
+
+    def _expected(self, trips, contains, start, end):
+        return sorted(
+            (trip.start.epoch, trip.start.device_id) for trip in trips
+            if (contains(trip.start) or contains(trip.end)) and
+            trip.end.epoch >= start and trip.start.epoch <= end)
+
+    def _found(self, store, indexes):
+        return sorted((trip.start.epoch, trip.start.device_id)
+                      for trip in store.get_trips(indexes))
+
+    def test_queries_match_scan(self, trips, tmpdir):
+        store = TripStore.from_trips(trips)
+        assert len(store) == len(trips)
+        assert sorted(store.get_trips(range(len(store)))) == sorted(trips)
+        store.save(str(tmpdir))
+        loaded = TripStore.load(str(tmpdir))
+
+        rng = random.Random(0)
+        first = min(trip.start.epoch for trip in trips)
+        found = 0
+        for _ in range(20):
+            start = first + rng.randint(0, 20000)
+            end = start + rng.randint(0, 80000)
+            lat = 51.3 + rng.random() * 0.4
+            lng = 12.2 + rng.random() * 0.4
+            size = rng.random() * 0.15
+
+            def in_box(point):
+                return (lat <= point.lat <= lat + size and
+                        lng <= point.lng <= lng + size)
+
+            def in_radius(point):
+                return store._haversine(lat, lng, point.lat,
+                                        point.lng) <= 2000
+
+            expected = self._expected(trips, in_box, start, end)
+            found += len(expected)
+            for current_store in (store, loaded):
+                assert self._found(current_store, current_store.query_bbox(
+                    lat, lng, lat + size, lng + size, start,
+                    end)) == expected
+                assert self._found(current_store, current_store.query_radius(
+                    lat, lng, 2000, start, end)) == self._expected(
+                    trips, in_radius, start, end)
+
+            assert self._found(store, store.query_time(start, end)) == \
+                self._expected(trips, lambda point: True, start, end)
+        assert found > 20
+
+    def test_query_by_point_and_timestamp(self, trips):
+        store = TripStore.from_trips(trips)
+        trip = trips[0]
+        indexes = store.query_radius(
+            trip.end.lat, trip.end.lng, 1, trip.end.timestamp,
+            trip.end.timestamp, point='end')
+        assert trip in store.get_trips(indexes)
+        assert trip not in store.get_trips(store.query_radius(
+            trip.end.lat, trip.end.lng, 1, point='end',
+            start=trip.end.epoch + 1))
+
+    @pytest.mark.parametrize("file_format", ['json', 'ndjson', 'csv'])
+    def test_trips_from_processor_output(self, trips, file_format, tmpdir):
+        path = str(tmpdir.join('trips.' + file_format))
+        with open(path, 'w') as output:
+            write_trips(trips, output, file_format)
+        store = TripStore.from_trips(read_trips(path))
+        assert [trip.distance for trip in store.get_trips(
+            range(len(store)))] == [trip.distance for trip in sorted(
+                trips, key=lambda trip: trip.start.epoch)]
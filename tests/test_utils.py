@@ -1,5 +1,11 @@
+import json
+
+import pytest
+
+import utils
 from processor import Waypoint, Trip
-from utils import trip_waypoint_format
+from utils import (trip_waypoint_format, convert_data_to_waypoints,
+                   load_from_json_file, iter_waypoints_from_json_file)
 
 
 class TestUtils():
@@ -29,3 +35,62 @@ class TestUtils():
             }
         ]
         assert trip_waypoint_format(data_points) == expected_result
+
+    def test_convert_data_to_waypoints(self):
+        data_points = [
+            {'timestamp': '2018-08-10T20:04:22Z',
+             'lat': 52.54987, 'lng': 12.41039}
+        ]
+        assert convert_data_to_waypoints(data_points) == [
+            Waypoint(timestamp='2018-08-10T20:04:22Z', lat=52.54987,
+                     lng=12.41039, epoch=1533931462)
+        ]
+
+
+class TestIterWaypointsFromJsonFile():
+
+    expected = convert_data_to_waypoints(
+        load_from_json_file("data/waypoints.json"))
+
+    @pytest.fixture(params=[7, 64 * 1024])
+    def chunk_size(self, request, monkeypatch):
+        monkeypatch.setattr(utils, 'READ_CHUNK_SIZE', request.param)
+
+    def test_json_array(self, chunk_size):
+        waypoints = iter_waypoints_from_json_file("data/waypoints.json")
+        assert list(waypoints) == self.expected
+
+    def test_json_lines(self, chunk_size, tmp_path):
+        source = tmp_path / "waypoints.ndjson"
+        source.write_text('\n'.join(
+            json.dumps(point) for point in
+            load_from_json_file("data/waypoints.json")) + '\n\n')
+        waypoints = iter_waypoints_from_json_file(str(source))
+        assert list(waypoints) == self.expected
+
+    @pytest.mark.parametrize("content, expected", [
+        ('[]', []), ('  [ ]  ', []), ('', []),
+        ('[{"timestamp": "2018-08-10T20:04:22Z", "lat": 1.0, "lng": 2.0}]',
+         [Waypoint('2018-08-10T20:04:22Z', 1.0, 2.0, 1533931462)]),
+    ])
+    def test_small_documents(self, chunk_size, tmp_path, content, expected):
+        source = tmp_path / "waypoints.json"
+        source.write_text(content)
+        assert list(iter_waypoints_from_json_file(str(source))) == expected
+
+    @pytest.mark.parametrize("content", [
+        '[{"timestamp": "2018-08-10T20:04:22Z", "lat": 1.0, "lng": 2.0}',
+        '[{"timestamp": "2018-08-10T20:04:22Z", "lat": 1.0, "lng": 2.0},]',
+        '[{"timestamp": "2018-08-10T20:04:22Z", "lat": 1.0, "lng": 2.0} {}]',
+        '[{"timestamp": "2018-08-10T20:04:22Z", "lat": 1.0,',
+        '{"timestamp": "2018-08-10T20:04:22Z", "lat": 1.0',
+    ])
+    def test_invalid_json(self, chunk_size, tmp_path, content):
+        source = tmp_path / "waypoints.json"
+        source.write_text(content)
+        with pytest.raises(json.decoder.JSONDecodeError):
+            list(iter_waypoints_from_json_file(str(source)))
+
+    def test_missing_file(self):
+        with pytest.raises(FileNotFoundError):
+            iter_waypoints_from_json_file("whatever")
@@ -0,0 +1,259 @@
+import json
+import os
+from typing import Iterable, List, Union
+
+import numpy as np
+
+from lib.geo import MEAN_EARTH_RADIUS_METERS
+from lib.timestamp import format_timestamp, parse_timestamp
+from processor import Trip, Waypoint, waypoint_epoch
+
+START, END, ANY = 'start', 'end', 'any'
+
+Time = Union[int, str, None]
+
+
+def _epoch(time: Time) -> Union[int, None]:
+    if isinstance(time, str):
+        return parse_timestamp(time)
+    return time
+
+
+class TripStore:
+    """
+    Columnar store of trips ordered by their start, with a grid index over
+    the start and end points. Every grid cell spans CELL_SIZE_DEGREES of
+    latitude and longitude, the index keeps the trips sorted by the cell of
+    a point, so the trips of a row of cells are one range found by binary
+    search. Time ranges are found by binary search over the start epochs.
+    Bounding boxes must not cross the antimeridian.
+    """
+    CELL_SIZE_DEGREES = 0.01
+    COLUMNS = ('start_epochs', 'start_lats', 'start_lngs', 'end_epochs',
+               'end_lats', 'end_lngs', 'distances', 'devices')
+    INDEX_COLUMNS = ('start_cells', 'start_order', 'end_cells', 'end_order')
+
+    def __init__(self, columns: dict, device_ids: list, index: dict = None):
+        """
+        :param columns: dict of the COLUMNS, ordered by the start epochs
+        :param device_ids: list, the device id of every number in devices
+        :param index: dict of the INDEX_COLUMNS, built by default
+        """
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self.device_ids = device_ids
+        durations = self.end_epochs - self.start_epochs
+        self._max_duration = int(durations.max()) if len(durations) else 0
+        self._lng_cells = int(np.ceil(360 / self.CELL_SIZE_DEGREES)) + 1
+        if index is None:
+            index = {}
+            for point in (START, END):
+                cells = self._cells(getattr(self, point + '_lats'),
+                                    getattr(self, point + '_lngs'))
+                order = np.argsort(cells, kind='stable')
+                index[point + '_cells'] = cells[order]
+                index[point + '_order'] = order
+        self._index = index
+
+    @classmethod
+    def from_trips(cls, trips: Iterable[Trip]) -> 'TripStore':
+        """
+        Build a store of trips, e.g. the ones returned by a processor.
+
+        :param trips: Iterable[Trip]
+        """
+        rows = []
+        device_numbers = {}
+        for trip in trips:
+            device_id = trip.start.device_id
+            if device_id not in device_numbers:
+                device_numbers[device_id] = len(device_numbers)
+            rows.append((waypoint_epoch(trip.start), trip.start.lat,
+                         trip.start.lng, waypoint_epoch(trip.end),
+                         trip.end.lat, trip.end.lng, trip.distance,
+                         device_numbers[device_id]))
+        rows.sort(key=lambda row: row[0])
+
+        types = ('i8', 'f8', 'f8', 'i8', 'f8', 'f8', 'f8', 'i4')
+        columns = {name: np.array([row[column] for row in rows], dtype)
+                   for column, (name, dtype) in enumerate(
+                       zip(cls.COLUMNS, types))}
+        return cls(columns, list(device_numbers))
+
+    @classmethod
+    def load(cls, path: str) -> 'TripStore':
+        """
+        Load a store saved at path, the columns are mapped into memory.
+
+        :param path: str, directory of the store
+        """
+        def load_column(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        with open(os.path.join(path, 'devices.json')) as _file:
+            device_ids = json.load(_file)
+        return cls({name: load_column(name) for name in cls.COLUMNS},
+                   device_ids,
+                   {name: load_column(name) for name in cls.INDEX_COLUMNS})
+
+    def save(self, path: str):
+        """
+        Save the columns and the index as NumPy files into a directory.
+
+        :param path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.COLUMNS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        for name in self.INDEX_COLUMNS:
+            np.save(os.path.join(path, name + '.npy'), self._index[name])
+        with open(os.path.join(path, 'devices.json'), 'w') as _file:
+            json.dump(self.device_ids, _file)
+
+    def __len__(self) -> int:
+        return len(self.start_epochs)
+
+    def _cells(self, lats, lngs) -> np.ndarray:
+        rows = np.floor((np.asarray(lats) + 90) / self.CELL_SIZE_DEGREES)
+        columns = np.floor((np.asarray(lngs) + 180) / self.CELL_SIZE_DEGREES)
+        return rows.astype(np.int64) * self._lng_cells + columns.astype(
+            np.int64)
+
+    def get_trips(self, indexes: Iterable[int]) -> List[Trip]:
+        """
+        Return the trips at the indexes returned by the queries.
+
+        :param indexes: Iterable[int]
+        """
+        trips = []
+        for index in indexes:
+            device_id = self.device_ids[self.devices[index]]
+            start_epoch = int(self.start_epochs[index])
+            end_epoch = int(self.end_epochs[index])
+            trips.append(Trip(
+                float(self.distances[index]),
+                Waypoint(format_timestamp(start_epoch),
+                         float(self.start_lats[index]),
+                         float(self.start_lngs[index]), start_epoch,
+                         device_id),
+                Waypoint(format_timestamp(end_epoch),
+                         float(self.end_lats[index]),
+                         float(self.end_lngs[index]), end_epoch, device_id)))
+        return trips
+
+    def query_time(self, start: Time = None, end: Time = None) -> np.ndarray:
+        """
+        Return the indexes of the trips which overlap the time range, ordered
+        by their start.
+
+        :param start: int or str, epoch or timestamp, unbounded by default
+        :param end: int or str
+        """
+        start, end = _epoch(start), _epoch(end)
+        first = 0
+        if start is not None:
+            first = np.searchsorted(self.start_epochs,
+                                    start - self._max_duration)
+        last = len(self)
+        if end is not None:
+            last = np.searchsorted(self.start_epochs, end, 'right')
+        indexes = np.arange(first, last)
+        if start is not None:
+            indexes = indexes[self.end_epochs[first:last] >= start]
+        return indexes
+
+    def query_bbox(self, min_lat: float, min_lng: float, max_lat: float,
+                   max_lng: float, start: Time = None, end: Time = None,
+                   point: str = ANY) -> np.ndarray:
+        """
+        Return the indexes of the trips whose start or end point, or any of
+        them, lies within the bounding box, which overlap the time range,
+        ordered by their start.
+
+        :param min_lat: float
+        :param min_lng: float
+        :param max_lat: float
+        :param max_lng: float
+        :param start: int or str, epoch or timestamp, unbounded by default
+        :param end: int or str
+        :param point: str, START, END or ANY
+        """
+        points = (START, END) if point == ANY else (point,)
+        indexes = []
+        for point in points:
+            lats = getattr(self, point + '_lats')
+            lngs = getattr(self, point + '_lngs')
+            candidates = self._grid_candidates(
+                point, min_lat, min_lng, max_lat, max_lng)
+            candidate_lats = lats[candidates]
+            candidate_lngs = lngs[candidates]
+            indexes.append(candidates[
+                (candidate_lats >= min_lat) & (candidate_lats <= max_lat) &
+                (candidate_lngs >= min_lng) & (candidate_lngs <= max_lng)])
+        return self._filter_time(np.unique(np.concatenate(indexes)),
+                                 start, end)
+
+    def query_radius(self, lat: float, lng: float, radius_in_meters: float,
+                     start: Time = None, end: Time = None,
+                     point: str = ANY) -> np.ndarray:
+        """
+        Return the indexes of the trips whose start or end point, or any of
+        them, lies within the radius around a location, which overlap the
+        time range, ordered by their start. Distances are haversine distances
+        on the mean earth radius.
+
+        :param lat: float
+        :param lng: float
+        :param radius_in_meters: float
+        :param start: int or str, epoch or timestamp, unbounded by default
+        :param end: int or str
+        :param point: str, START, END or ANY
+        """
+        lat_delta = np.degrees(radius_in_meters / MEAN_EARTH_RADIUS_METERS)
+        lng_delta = min(180.0, lat_delta / max(
+            np.cos(np.radians(min(abs(lat) + lat_delta, 90.0))), 1e-12))
+        points = (START, END) if point == ANY else (point,)
+        indexes = []
+        for point in points:
+            candidates = self.query_bbox(
+                lat - lat_delta, max(lng - lng_delta, -180.0),
+                lat + lat_delta, min(lng + lng_delta, 180.0), point=point)
+            distances = self._haversine(
+                lat, lng, getattr(self, point + '_lats')[candidates],
+                getattr(self, point + '_lngs')[candidates])
+            indexes.append(candidates[distances <= radius_in_meters])
+        return self._filter_time(np.unique(np.concatenate(indexes)),
+                                 start, end)
+
+    def _grid_candidates(self, point: str, min_lat: float, min_lng: float,
+                         max_lat: float, max_lng: float) -> np.ndarray:
+        cells = self._index[point + '_cells']
+        order = self._index[point + '_order']
+        first_cell, last_cell = self._cells([min_lat, max_lat],
+                                            [min_lng, max_lng])
+        first_row, first_column = divmod(int(first_cell), self._lng_cells)
+        last_row, last_column = divmod(int(last_cell), self._lng_cells)
+        rows = np.arange(first_row, last_row + 1) * self._lng_cells
+        firsts = np.searchsorted(cells, rows + first_column)
+        lasts = np.searchsorted(cells, rows + last_column, 'right')
+        return np.concatenate([order[first:last] for first, last in
+                               zip(firsts, lasts)] or [order[:0]])
+
+    def _filter_time(self, indexes: np.ndarray, start: Time,
+                     end: Time) -> np.ndarray:
+        start, end = _epoch(start), _epoch(end)
+        if start is not None:
+            indexes = indexes[self.end_epochs[indexes] >= start]
+        if end is not None:
+            indexes = indexes[self.start_epochs[indexes] <= end]
+        return indexes
+
+    @staticmethod
+    def _haversine(lat: float, lng: float, lats: np.ndarray,
+                   lngs: np.ndarray) -> np.ndarray:
+        lat, lng = np.radians(lat), np.radians(lng)
+        lats, lngs = np.radians(lats), np.radians(lngs)
+        a = (np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) *
+             np.sin((lngs - lng) / 2) ** 2)
+        return 2 * MEAN_EARTH_RADIUS_METERS * np.arcsin(
+            np.sqrt(np.minimum(a, 1.0)))
@@ -1,6 +1,11 @@
 import json
+from itertools import chain
+from typing import Iterator, TextIO
 
-from processor import Waypoint
+from lib.timestamp import parse_timestamp
+from processor import Trip, Waypoint
+
+READ_CHUNK_SIZE = 64 * 1024
 
 
 def load_from_json_file(file_path):
@@ -13,20 +18,109 @@ def load_from_json_file(file_path):
         return "The file %s has invaild json format" % file_path
 
 
+def convert_data_to_waypoint(point):
+    return Waypoint(epoch=parse_timestamp(point['timestamp']), **point)
+
+
 def convert_data_to_waypoints(data_points):
-    return [Waypoint(**point) for point in data_points]
+    return [convert_data_to_waypoint(point) for point in data_points]
 
 
-def trip_waypoint_format(data_points):
-    return [{
+def iter_waypoints_from_json_file(file_path) -> Iterator[Waypoint]:
+    """
+    Yield the waypoints of a file one at a time, without loading the whole
+    file. The file either contains a JSON array of waypoints or newline
+    delimited JSON with one waypoint per line.
+    The file is opened immediately, so a missing file raises
+    FileNotFoundError on the call, invalid JSON raises JSONDecodeError while
+    iterating.
+
+    :param file_path: str
+    """
+    return _iter_waypoints(open(file_path))
+
+
+def _iter_waypoints(_file: TextIO) -> Iterator[Waypoint]:
+    with _file:
+        buffer = _file.read(READ_CHUNK_SIZE)
+        content = buffer.lstrip()
+        while not content and buffer:
+            buffer = _file.read(READ_CHUNK_SIZE)
+            content = buffer.lstrip()
+
+        if content.startswith('['):
+            points = _iter_json_array(_file, content[1:])
+        else:
+            points = _iter_json_lines(_file, content)
+
+        for point in points:
+            yield convert_data_to_waypoint(point)
+
+
+def _iter_json_array(_file: TextIO, buffer: str) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    position = 0
+    end_of_file = False
+    first_value = True
+    expect_value = True
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+
+        if position < len(buffer):
+            character = buffer[position]
+            if character == ']' and (first_value or not expect_value):
+                return
+            if character == ',' and not expect_value:
+                expect_value = True
+                position += 1
+                continue
+            if not expect_value:
+                raise json.decoder.JSONDecodeError(
+                    "Expecting ',' delimiter", buffer, position)
+            try:
+                point, position = decoder.raw_decode(buffer, position)
+            except json.decoder.JSONDecodeError:
+                # the value may continue in the next chunk
+                if end_of_file:
+                    raise
+            else:
+                first_value = expect_value = False
+                yield point
+                continue
+        elif end_of_file:
+            raise json.decoder.JSONDecodeError(
+                "Expecting ']'", buffer, position)
+
+        chunk = _file.read(READ_CHUNK_SIZE)
+        end_of_file = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def _iter_json_lines(_file: TextIO, buffer: str) -> Iterator[dict]:
+    # complete the last line of the first chunk
+    buffer += _file.readline()
+    for line in chain(buffer.splitlines(), _file):
+        if line.strip():
+            yield json.loads(line)
+
+
+def trip_format(trip: Trip) -> dict:
+    return {
         "start": {
-            "timestamp": point.start.timestamp,
-            "lat": point.start.lat,
-            "lng": point.start.lng,
+            "timestamp": trip.start.timestamp,
+            "lat": trip.start.lat,
+            "lng": trip.start.lng,
         }, "end": {
-            "timestamp": point.end.timestamp,
-            "lat": point.end.lat,
-            "lng": point.end.lng,
+            "timestamp": trip.end.timestamp,
+            "lat": trip.end.lat,
+            "lng": trip.end.lng,
         },
-        "distance": point.distance
-    } for point in data_points]
+        "distance": trip.distance
+    }
+
+
+def trip_waypoint_format(data_points):
+    return [trip_format(point) for point in data_points]
@@ -0,0 +1,485 @@
+import csv
+import gzip
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from json.encoder import encode_basestring_ascii
+from time import monotonic
+from typing import BinaryIO, Iterable, Iterator, TextIO, Union
+
+from lib.timestamp import format_timestamp, parse_timestamp
+from processor import Trip, Waypoint, WaypointBatch, waypoint_epoch
+from utils import iter_waypoints_from_json_file
+
+JSON, NDJSON, CSV, BINARY = 'json', 'ndjson', 'csv', 'binary'
+WAYPOINT_FORMATS = (JSON, NDJSON, CSV, BINARY)
+TRIP_FORMATS = (JSON, NDJSON, CSV, BINARY)
+GZIP, ZSTD = 'gzip', 'zstd'
+COMPRESSIONS = (GZIP, ZSTD)
+
+EXTENSIONS = {
+    '.json': JSON,
+    '.ndjson': NDJSON,
+    '.jsonl': NDJSON,
+    '.csv': CSV,
+    '.wpb': BINARY,
+    '.tpb': BINARY,
+}
+COMPRESSION_EXTENSIONS = {
+    '.gz': GZIP,
+    '.zst': ZSTD,
+}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# The binary format keeps the columns of a WaypointBatch one after another,
+# little endian, behind a header of 32 bytes: the magic, the version and
+# the number of waypoints. The columns start at multiples of 8 bytes of the
+# mapped pages, so they are aligned for NumPy and the kernel.
+BINARY_MAGIC = b'TXWB'
+BINARY_VERSION = 2
+_BINARY_HEADER = struct.Struct('<4sHxxQ16x')
+
+# Binary trips are written as they are produced, so their header of 16
+# bytes has no count. Each record holds the epoch, latitude and longitude of
+# the start and the end and the distance, 56 bytes little endian.
+TRIP_BINARY_MAGIC = b'TXTB'
+TRIP_BINARY_VERSION = 1
+_TRIP_BINARY_HEADER = struct.Struct('<4sH10x')
+_TRIP_RECORD = struct.Struct('<qddqddd')
+
+WAYPOINT_FIELDS = ('timestamp', 'lat', 'lng', 'device_id')
+TRIP_FIELDS = ('start_timestamp', 'start_lat', 'start_lng',
+               'end_timestamp', 'end_lat', 'end_lng', 'distance')
+
+
+def detect_format(file_path: str) -> str:
+    """
+    Return the format of a waypoint file by its extension, or by its first
+    bytes if the extension is unknown.
+
+    :param file_path: str
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+
+    with open(file_path, 'rb') as _file:
+        return _detect_content_format(_file.read(1024 + len(BINARY_MAGIC)))
+
+
+def _detect_content_format(start: bytes) -> str:
+    if start[:len(BINARY_MAGIC)] in (BINARY_MAGIC, TRIP_BINARY_MAGIC):
+        return BINARY
+    start = start.lstrip()
+    if start.startswith(b'['):
+        return JSON
+    if start.startswith(b'{'):
+        return NDJSON
+    return CSV
+
+
+def read_waypoints(file_path: str, file_format: str = None
+                   ) -> Iterable[Waypoint]:
+    """
+    Return the waypoints of a file, a WaypointBatch mapping the file for the
+    binary format, an iterator reading one waypoint at a time otherwise.
+    A missing file raises FileNotFoundError on the call, invalid content
+    raises ValueError.
+
+    :param file_path: str
+    :param file_format: str, one of WAYPOINT_FORMATS, detected by default
+    """
+    file_format = file_format or detect_format(file_path)
+    if file_format == BINARY:
+        return read_waypoint_batch(file_path)
+    if file_format == CSV:
+        return _iter_csv_waypoints(open(file_path, newline=''))
+    if file_format in (JSON, NDJSON):
+        return iter_waypoints_from_json_file(file_path)
+    raise ValueError("Unknown format: %s" % file_format)
+
+
+def read_waypoint_batch(file_path: str) -> WaypointBatch:
+    """
+    Map a binary waypoint file into memory and return a WaypointBatch, whose
+    columns are read from the mapped pages without copying them.
+
+    :param file_path: str
+    """
+    with open(file_path, 'rb') as _file:
+        size = os.fstat(_file.fileno()).st_size
+        if size < _BINARY_HEADER.size:
+            raise ValueError("The file %s is too short" % file_path)
+        # the mapping stays open as long as the columns are referenced
+        data = memoryview(mmap.mmap(_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ))
+
+    magic, version, count = _BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("The file %s is no binary waypoint file of version "
+                         "%d" % (file_path, BINARY_VERSION))
+    if size != _BINARY_HEADER.size + count * 24:
+        raise ValueError("The file %s is truncated" % file_path)
+
+    columns = []
+    position = _BINARY_HEADER.size
+    for typecode in ('q', 'd', 'd'):
+        column = data[position:position + count * 8]
+        position += count * 8
+        if sys.byteorder == 'little':
+            columns.append(column.cast(typecode))
+        else:
+            column = array(typecode, column.tobytes())
+            column.byteswap()
+            columns.append(column)
+    return WaypointBatch(*columns)
+
+
+def _iter_csv_waypoints(_file: TextIO) -> Iterator[Waypoint]:
+    with _file:
+        reader = csv.reader(_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        try:
+            columns = [header.index(field) for field in WAYPOINT_FIELDS[:3]]
+        except ValueError:
+            raise ValueError("The CSV header needs the columns %s" %
+                             ', '.join(WAYPOINT_FIELDS[:3]))
+        timestamp, lat, lng = columns
+        device_id = header.index('device_id') \
+            if 'device_id' in header else None
+
+        for row in reader:
+            if not row:
+                continue
+            point_device_id = None if device_id is None else row[device_id]
+            yield Waypoint(row[timestamp], float(row[lat]), float(row[lng]),
+                           parse_timestamp(row[timestamp]),
+                           point_device_id or None)
+
+
+def write_waypoints(waypoints: Iterable[Waypoint], file_path: str,
+                    file_format: str = None):
+    """
+    Write waypoints to a file in one of WAYPOINT_FORMATS, detected from the
+    extension by default. The binary format keeps no device ids.
+
+    :param waypoints: Iterable[Waypoint]
+    :param file_path: str
+    :param file_format: str
+    """
+    file_format = file_format or EXTENSIONS.get(
+        os.path.splitext(file_path)[1].lower(), JSON)
+    if file_format == BINARY:
+        if not isinstance(waypoints, WaypointBatch):
+            waypoints = WaypointBatch.from_waypoints(waypoints)
+        with open(file_path, 'wb') as output:
+            output.write(_BINARY_HEADER.pack(
+                BINARY_MAGIC, BINARY_VERSION, len(waypoints)))
+            for column in (waypoints.epochs, waypoints.lats, waypoints.lngs):
+                if sys.byteorder == 'little':
+                    output.write(column)
+                else:
+                    column = array(column.format, column.tobytes())
+                    column.byteswap()
+                    output.write(column.tobytes())
+        return
+
+    with open(file_path, 'w', newline='') as output:
+        if file_format == CSV:
+            writer = csv.writer(output)
+            writer.writerow(WAYPOINT_FIELDS)
+            for waypoint in waypoints:
+                writer.writerow((waypoint.timestamp, waypoint.lat,
+                                 waypoint.lng, waypoint.device_id))
+            return
+
+        separator = ''
+        if file_format == JSON:
+            output.write('[')
+        for waypoint in waypoints:
+            point = {"timestamp": waypoint.timestamp, "lat": waypoint.lat,
+                     "lng": waypoint.lng}
+            if waypoint.device_id is not None:
+                point["device_id"] = waypoint.device_id
+            if file_format == JSON:
+                output.write(separator + json.dumps(point))
+                separator = ',\n'
+            else:
+                output.write(json.dumps(point) + '\n')
+        if file_format == JSON:
+            output.write(']\n')
+
+
+def read_trips(file_path: str, file_format: str = None) -> Iterator[Trip]:
+    """
+    Yield the trips of a file written by write_trips, in one of
+    TRIP_FORMATS, detected by default, and compressed by one of COMPRESSIONS
+    or not.
+
+    :param file_path: str
+    :param file_format: str
+    """
+    with _open_decompressed(file_path) as _file:
+        file_format = file_format or _detect_trip_format(file_path, _file)
+        if file_format == BINARY:
+            yield from _iter_binary_trips(_file, file_path)
+            return
+        _file = io.TextIOWrapper(_file, newline='')
+        if file_format == CSV:
+            for row in csv.DictReader(_file):
+                yield Trip(float(row['distance']), *(
+                    _trip_waypoint({name: row[point + '_' + name] for name in
+                                    WAYPOINT_FIELDS[:3]})
+                    for point in ('start', 'end')))
+            return
+        if file_format == JSON:
+            trips = json.load(_file)
+        elif file_format == NDJSON:
+            trips = (json.loads(line) for line in _file if line.strip())
+        else:
+            raise ValueError("Unknown format: %s" % file_format)
+        for trip in trips:
+            yield Trip(trip['distance'], _trip_waypoint(trip['start']),
+                       _trip_waypoint(trip['end']))
+
+
+def _open_decompressed(file_path: str) -> BinaryIO:
+    with open(file_path, 'rb') as _file:
+        start = _file.read(len(ZSTD_MAGIC))
+    if start.startswith(GZIP_MAGIC):
+        return gzip.open(file_path, 'rb')
+    if start == ZSTD_MAGIC:
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(file_path, 'rb')))
+    return open(file_path, 'rb')
+
+
+def _detect_trip_format(file_path: str, _file: BinaryIO) -> str:
+    path, extension = os.path.splitext(file_path)
+    if extension.lower() in COMPRESSION_EXTENSIONS:
+        extension = os.path.splitext(path)[1]
+    if extension.lower() in EXTENSIONS:
+        return EXTENSIONS[extension.lower()]
+    return _detect_content_format(_file.peek(1024 + len(BINARY_MAGIC)))
+
+
+def _iter_binary_trips(_file: BinaryIO, file_path: str) -> Iterator[Trip]:
+    header = _file.read(_TRIP_BINARY_HEADER.size)
+    if len(header) < _TRIP_BINARY_HEADER.size or \
+            _TRIP_BINARY_HEADER.unpack(header) != (
+                TRIP_BINARY_MAGIC, TRIP_BINARY_VERSION):
+        raise ValueError("The file %s is no binary trip file of version %d" %
+                         (file_path, TRIP_BINARY_VERSION))
+    while True:
+        data = _file.read(_TRIP_RECORD.size * 4096)
+        if not data:
+            return
+        if len(data) % _TRIP_RECORD.size:
+            raise ValueError("The file %s is truncated" % file_path)
+        for (start_epoch, start_lat, start_lng, end_epoch, end_lat, end_lng,
+             distance) in _TRIP_RECORD.iter_unpack(data):
+            yield Trip(distance,
+                       Waypoint(format_timestamp(start_epoch), start_lat,
+                                start_lng, start_epoch),
+                       Waypoint(format_timestamp(end_epoch), end_lat, end_lng,
+                                end_epoch))
+
+
+def _trip_waypoint(point: dict) -> Waypoint:
+    timestamp = point['timestamp']
+    return Waypoint(timestamp, float(point['lat']), float(point['lng']),
+                    parse_timestamp(timestamp))
+
+
+def _encode_json_trip(trip: Trip) -> str:
+    # the same text as json.dumps(utils.trip_format(trip))
+    start, end = trip.start, trip.end
+    return (
+        '{"start": {"timestamp": %s, "lat": %s, "lng": %s}, '
+        '"end": {"timestamp": %s, "lat": %s, "lng": %s}, '
+        '"distance": %s}' % (
+            encode_basestring_ascii(start.timestamp), start.lat, start.lng,
+            encode_basestring_ascii(end.timestamp), end.lat, end.lng,
+            trip.distance))
+
+
+def _encode_ndjson_trip(trip: Trip) -> str:
+    return _encode_json_trip(trip) + '\n'
+
+
+def _csv_field(value: str) -> str:
+    if any(character in value for character in ',"\r\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
+
+
+def _encode_csv_trip(trip: Trip) -> str:
+    # the same row as csv.writer writes
+    start, end = trip.start, trip.end
+    return '%s,%s,%s,%s,%s,%s,%s\n' % (
+        _csv_field(start.timestamp), start.lat, start.lng,
+        _csv_field(end.timestamp), end.lat, end.lng, trip.distance)
+
+
+def _encode_binary_trip(trip: Trip) -> bytes:
+    start, end = trip.start, trip.end
+    return _TRIP_RECORD.pack(waypoint_epoch(start), start.lat, start.lng,
+                             waypoint_epoch(end), end.lat, end.lng,
+                             trip.distance)
+
+
+_TRIP_ENCODERS = {
+    JSON: _encode_json_trip,
+    NDJSON: _encode_ndjson_trip,
+    CSV: _encode_csv_trip,
+    BINARY: _encode_binary_trip,
+}
+
+
+class TripWriter:
+    """
+    Write trips one at a time in one of TRIP_FORMATS, optionally compressed
+    by one of COMPRESSIONS. Every trip is encoded straight into text or a
+    binary record and kept in a buffer, which is written to the output and
+    flushed once it holds buffer_size bytes or flush_interval seconds have
+    passed since the last flush, checked whenever a trip is written.
+    A flush_interval of 0 flushes every trip.
+    Text formats are written to text outputs as they are, binary and
+    compressed ones need a binary output or a text output with a buffer,
+    like sys.stdout.
+    """
+    BUFFER_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, output: Union[TextIO, BinaryIO],
+                 file_format: str = JSON, compression: str = None,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 buffer_size: int = BUFFER_SIZE):
+        """
+        :param output: TextIO or BinaryIO, which is not closed
+        :param file_format: str
+        :param compression: str, one of COMPRESSIONS, none by default
+        :param flush_interval: float, seconds
+        :param buffer_size: int, bytes
+        """
+        if file_format not in TRIP_FORMATS:
+            raise ValueError("Unknown format: %s" % file_format)
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression: %s" % compression)
+        self.trips = 0
+        self._encode = _TRIP_ENCODERS[file_format]
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = monotonic()
+
+        empty = b'' if file_format == BINARY else ''
+        self._join = (', ' if file_format == JSON else empty).join
+        self._empty = empty
+        self._separator = empty
+        self._next_separator = ', ' if file_format == JSON else empty
+        self._end = ']\n' if file_format == JSON else empty
+        if file_format == JSON:
+            self._start = '['
+        elif file_format == CSV:
+            self._start = ','.join(TRIP_FIELDS) + '\n'
+        elif file_format == BINARY:
+            self._start = _TRIP_BINARY_HEADER.pack(TRIP_BINARY_MAGIC,
+                                                   TRIP_BINARY_VERSION)
+        else:
+            self._start = empty
+
+        self._compressed = compression is not None
+        if (file_format != BINARY and not self._compressed and
+                isinstance(output, io.TextIOBase)):
+            self._output = output
+            self._encoded = False
+            return
+        if isinstance(output, io.TextIOBase):
+            if not hasattr(output, 'buffer'):
+                raise ValueError("The %s trips need a binary output" % (
+                    compression or file_format))
+            output.flush()
+            output = output.buffer
+        self._buffer = output
+        if compression == GZIP:
+            output = gzip.GzipFile(fileobj=output, mode='wb', mtime=0)
+        elif compression == ZSTD:
+            # zstandard is only needed to write zstd compressed trips
+            import zstandard
+            output = zstandard.ZstdCompressor().stream_writer(
+                output, closefd=False)
+        self._output = output
+        self._encoded = file_format != BINARY
+
+    def write(self, trip: Trip):
+        chunk = self._encode(trip)
+        self._pending.append(chunk)
+        self._pending_size += len(chunk)
+        self.trips += 1
+        if (self._pending_size >= self._buffer_size or
+                monotonic() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered trips and flush the output, and the compressor
+        so far that a reader can decompress them.
+        """
+        self._write_pending(self._empty)
+        self._output.flush()
+        self._last_flush = monotonic()
+
+    def close(self):
+        """
+        Write the buffered trips and the end of the document, the output
+        itself is flushed and stays open.
+        """
+        self._write_pending(self._end)
+        if self._compressed:
+            self._output.close()
+            self._buffer.flush()
+        else:
+            self._output.flush()
+
+    def _write_pending(self, end: Union[str, bytes]):
+        data = self._start
+        if self._pending:
+            data += self._separator + self._join(self._pending)
+            self._separator = self._next_separator
+            self._pending = []
+            self._pending_size = 0
+        data += end
+        self._start = self._empty
+        if data:
+            self._output.write(data.encode() if self._encoded else data)
+
+
+def write_trips(trips: Iterable[Trip], output: Union[TextIO, BinaryIO],
+                file_format: str = JSON, compression: str = None,
+                flush_interval: float = TripWriter.FLUSH_INTERVAL):
+    """
+    Write trips as soon as they are produced in one of TRIP_FORMATS: a JSON
+    array, one JSON object per line, CSV rows with a header or binary
+    records, through a TripWriter.
+
+    :param trips: Iterable[Trip]
+    :param output: TextIO or BinaryIO
+    :param file_format: str
+    :param compression: str, one of COMPRESSIONS, none by default
+    :param flush_interval: float, seconds trips are buffered at most while
+    more are written
+    """
+    writer = TripWriter(output, file_format, compression, flush_interval)
+    for trip in trips:
+        writer.write(trip)
+    writer.close()